@@ -122,8 +122,9 @@ sed -i "s/__current_date__/${dat}/g" README.md
 chmod 0444 README.md
 
 echo "-----------------------------------------------------------------------------------------"
-echo "Building watiba-c script with new version ${new_ver}"  | tee -a ${log}
+echo "Building watiba-c and watiba-run scripts with new version ${new_ver}"  | tee -a ${log}
 sed "s/__version__/${new_ver}/g" < watiba/watiba-c.py > bin/watiba-c
+sed "s/__version__/${new_ver}/g" < watiba/watiba-run.py > bin/watiba-run
 
 git add .
 git commit -m "Build version ${new_ver}"
@@ -25,6 +25,6 @@ setuptools.setup(
         "Operating System :: OS Independent",
     ],
     python_requires='>=3.8',
-    scripts=["bin/watiba-c"],
+    scripts=["bin/watiba-c", "bin/watiba-run"],
     data_files=["version.conf"]
 )
\ No newline at end of file
@@ -0,0 +1,101 @@
+#!/usr/bin/python3
+'''
+Benchmark of the Watiba compiler on a synthetic 100,000 line .wt file.
+
+The file is mostly plain Python, like real Watiba programs, with backticked commands (local and remote), spawn
+blocks, chains, hooks, -ctl statements, docstrings and commands continued onto a second line mixed in.
+
+Author: Ray Walker
+Raythonic@gmail.com
+'''
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from watiba.wtcompiler import compile_source
+
+LINES = 100000
+RUNS = 5
+
+# Blocks of source repeated to make up the file
+BLOCKS = [
+    ["def report_{n}(path, limit=10):",
+     "    '''",
+     "    Summarize `du` output for the path",
+     "    '''",
+     "    total = 0",
+     "    for line in `du -sk {{path}}/*`.stdout:",
+     "        size, name = line.split(maxsplit=1)",
+     "        total += int(size)",
+     "    return total",
+     ""],
+    ["class Host{n}:",
+     "    def __init__(self, name):",
+     "        self.name = name",
+     "        self.cache = {{}}",
+     "",
+     "    def uptime(self):",
+     "        return `uptime`@$self.name .stdout[0]",
+     ""],
+    ["def deploy_{n}(hosts):",
+     "    spawn-ctl {{'max': 8}}",
+     "    p = spawn `tar -zcf /tmp/build_{n}.tgz build`:",
+     "        print(f'{{promise.command}} finished with {{promise.output.exit_code}}')",
+     "        return True",
+     "    p.join()",
+     "    out = chain `scp /tmp/build_{n}.tgz $HOST:/tmp` {{'hosts': hosts}}",
+     "    return out",
+     ""],
+    ["def audit_{n}(match, parms):",
+     "    parms['count'] += 1",
+     "    return True",
+     "",
+     "hook-cmd '^rm ' audit_{n} {{'count':0}}",
+     "watiba-ctl {{'ssh-command': 'ssh'}}",
+     "listing_{n} = -`ls -l \\",
+     "    /tmp`",
+     "if listing_{n}.exit_code != 0:",
+     "    print(f'Failed: {{listing_{n}.stderr}}')",
+     ""],
+    ["def plain_{n}(values):",
+     "    # Nothing Watiba here",
+     "    result = []",
+     "    for i, value in enumerate(values):",
+     "        if value % 2 == 0:",
+     "            result.append(value * i)",
+     "        else:",
+     "            result.append({{'index': i, 'value': value}})",
+     "    return sorted(result, key=str)",
+     ""]
+]
+
+
+# Build the source of a .wt file with at least this many lines, ending on a whole block
+def synthetic_source(lines):
+    source = ["#!/usr/bin/python3", "import os", ""]
+    n = 0
+    while len(source) < lines:
+        block = BLOCKS[n % len(BLOCKS)] if n % 4 else BLOCKS[-1]
+        source += [line.format(n=n) for line in block]
+        n += 1
+    return "\n".join(source) + "\n"
+
+
+if __name__ == "__main__":
+    source = synthetic_source(LINES)
+    lines = source.count("\n")
+    print(f"Compiling {lines} lines ({len(source) / 1e6:.1f} MB), best of {RUNS} runs")
+
+    best = None
+    for _ in range(RUNS):
+        start = time.perf_counter()
+        python = compile_source(source)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    # The generated Python must at least be valid
+    compile(python, "<generated>", "exec")
+
+    print(f"  {best:.3f} sec, {lines / best:,.0f} lines/sec, {len(source) / best / 1e6:.2f} MB/sec")
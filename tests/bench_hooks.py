@@ -0,0 +1,68 @@
+#!/usr/bin/python3
+'''
+Benchmark of hook dispatch with 1,000 hooks registered.
+
+Times Watiba.run_hooks() for commands that match no hooks and commands that match one, next to the cost of
+trying every pattern in turn with re.match().
+
+Author: Ray Walker
+Raythonic@gmail.com
+'''
+
+import os
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from watiba import Watiba
+
+HOOKS = 1000
+CALLS = 20000
+
+
+def audit(match, parms):
+    parms["calls"] += 1
+    return True
+
+
+# Try every pattern against the command, the way hooks were matched before the index
+def match_every_pattern(patterns, command):
+    return [p for p in patterns if re.match(p, command)]
+
+
+def timed(label, func, calls=CALLS):
+    start = time.perf_counter()
+    for _ in range(calls):
+        func()
+    per_call = (time.perf_counter() - start) / calls
+    print(f"  {label:<45} {per_call * 1e6:10.2f} usec/call")
+
+
+if __name__ == "__main__":
+    w = Watiba()
+    parms = {"calls": 0}
+    patterns = []
+
+    # Mostly literal-prefixed patterns, like audit hooks on specific tools, plus some that need a regex
+    for i in range(HOOKS):
+        if i % 10 == 0:
+            pattern = f".*--tool{i}-flag"
+        elif i % 10 == 1:
+            pattern = f"^(sudo )?tool{i} "
+        else:
+            pattern = f"^tool{i} .*"
+        patterns.append(pattern)
+        w.add_hook(pattern, audit, parms)
+
+        # Post hooks are indexed separately and cost pre-hook matching nothing
+        w.add_hook(f"^post{i}", audit, parms, post=True)
+
+    print(f"Hook dispatch, {HOOKS} pre hooks and {HOOKS} post hooks")
+
+    for label, command in (("no hooks match", "ls -lrt /tmp"),
+                           ("one literal-prefixed hook matches", "tool502 --verbose"),
+                           ("one regex hook matches", "make --tool500-flag")):
+        print(f"{label}: `{command}`")
+        timed("Watiba.run_hooks()", lambda: w.run_hooks(command))
+        timed("re.match() against every pattern", lambda: match_every_pattern(patterns, command), CALLS // 100)
@@ -0,0 +1,257 @@
+#!/usr/bin/python3
+'''
+Watiba benchmark suite.  Times the runtime and compiler hot paths without any input or remote host:
+
+    bash         - per-command cost of Watiba.bash() next to a bare subprocess
+    context      - what directory context tracking and the shell session backend add to each command
+    hooks        - run_hooks() with 1,000 hooks registered
+    spawn        - spawn throughput through WTSpawnController, a thread per spawn and on the worker pool
+    join         - time from a promise resolving to join() returning
+    tree         - promise tree statistics on a 100,000 promise tree, and on a 10,000 deep chain
+    chain        - chain() over tests/fake_ssh, one host at a time, in parallel and pooled
+    compiler     - Compiler throughput on a large synthetic .wt file
+
+    tests/bench_suite.py [--quick] [--only bash,spawn,...] [--json results.json] [--compare old.json]
+
+--json writes the results as JSON ("-" for STDOUT) so runs can be kept and compared across versions, and
+--compare prints each result next to the same one in an earlier run.
+
+Author: Ray Walker
+Raythonic@gmail.com
+'''
+
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import statistics
+from subprocess import Popen, PIPE
+
+TESTS = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(TESTS, ".."))
+from watiba import Watiba, WTPromise
+from watiba.wtcompiler import compile_source
+from bench_compiler import synthetic_source
+
+FAKE_SSH = os.path.join(TESTS, "fake_ssh")
+
+
+# Seconds per call of func, best of several rounds so a busy machine disturbs the result less
+def per_call(func, calls, rounds=3):
+    best = None
+    for _ in range(rounds):
+        start = time.perf_counter()
+        for _ in range(calls):
+            func()
+        elapsed = (time.perf_counter() - start) / calls
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def bench_bash(w, scale):
+    calls = max(10, int(200 * scale))
+
+    def popen():
+        p = Popen("true", shell=True, stdout=PIPE, stderr=PIPE, close_fds=True)
+        p.communicate()
+
+    return {"popen_usec": per_call(popen, calls) * 1e6,
+            "bash_usec": per_call(lambda: w.bash("true", context=False), calls) * 1e6,
+            "bash_1mb_output_msec": per_call(lambda: w.bash("head -c 1048576 /dev/zero", context=False),
+                                             max(3, calls // 20)) * 1e3}
+
+
+def bench_context(w, scale):
+    calls = max(10, int(200 * scale))
+    results = {"no_context_usec": per_call(lambda: w.bash("true", context=False), calls) * 1e6,
+               "context_usec": per_call(lambda: w.bash("true"), calls) * 1e6}
+
+    w.set_parms({"session": True})
+    try:
+        results["session_usec"] = per_call(lambda: w.bash("true"), calls) * 1e6
+    finally:
+        w.set_parms({"session": False})
+        w.close_session()
+    return results
+
+
+def bench_hooks(w, scale):
+    def audit(match, parms):
+        return True
+
+    for i in range(1000):
+        w.add_hook(f"^tool{i} .*" if i % 10 else f".*--tool{i}-flag", audit, {})
+    calls = max(100, int(20000 * scale))
+    try:
+        return {"no_match_usec": per_call(lambda: w.run_hooks("ls -lrt /tmp"), calls) * 1e6,
+                "one_match_usec": per_call(lambda: w.run_hooks("tool502 --verbose"), calls) * 1e6}
+    finally:
+        w.remove_hooks()
+
+
+def bench_spawn(w, scale):
+    spawns = max(20, int(500 * scale))
+    results = {}
+    for label, parms in (("thread", {"max": spawns, "pool-size": 0}), ("pool", {"max": spawns, "pool-size": 8})):
+        w.spawn_ctlr.set_parms(parms)
+        start = time.perf_counter()
+        promises = [w.spawn("true", lambda promise, args: True, {}) for _ in range(spawns)]
+        for p in promises:
+            p.join({"timeout": 60})
+        results[f"{label}_spawns_per_sec"] = spawns / (time.perf_counter() - start)
+    w.spawn_ctlr.set_parms({"max": 10, "pool-size": 0})
+    return results
+
+
+def bench_join(w, scale):
+    latencies = []
+    for _ in range(max(10, int(100 * scale))):
+        p = w.spawn("sleep 0.01", lambda promise, args: True, {})
+        p.join({"timeout": 60})
+        latencies.append(time.time() - p.end_time)
+    latencies.sort()
+    return {"median_usec": statistics.median(latencies) * 1e6,
+            "p95_usec": latencies[int(len(latencies) * .95)] * 1e6}
+
+
+def bench_tree(w, scale):
+    size = max(1000, int(100000 * scale))
+
+    # Ten children per promise
+    start = time.perf_counter()
+    promises = [WTPromise("root")]
+    for n in range(1, size):
+        p = WTPromise(f"node {n}")
+        p.relate(promises[(n - 1) // 10])
+        promises.append(p)
+    build = time.perf_counter() - start
+
+    leaf = promises[-1]
+    stats = per_call(lambda: leaf.tree_stats(), 10000)
+    count = per_call(lambda: leaf.spawn_count(), 10000)
+    joined = per_call(lambda: leaf.tree_resolved(), 10000)
+
+    start = time.perf_counter()
+    for p in reversed(promises):
+        p.set_resolved()
+    resolve = time.perf_counter() - start
+
+    if promises[0].resolved_count() != size:
+        raise Exception(f"Tree resolved {promises[0].resolved_count()} of {size} promises")
+
+    # One long chain, each promise the only child of the one before, resolved from the top down so the whole
+    # chain only becomes fully resolved with the last one
+    depth = size // 10
+    start = time.perf_counter()
+    chain = [WTPromise("chain root")]
+    for n in range(1, depth):
+        p = WTPromise(f"link {n}")
+        p.relate(chain[-1])
+        chain.append(p)
+    chain_build = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for p in chain:
+        p.set_resolved()
+    chain_resolve = time.perf_counter() - start
+
+    if not chain[0].tree_resolved() or chain[-1].resolved_count() != depth:
+        raise Exception(f"Chain resolved {chain[-1].resolved_count()} of {depth} promises")
+    return {"promises": size,
+            "relate_usec": build / size * 1e6,
+            "tree_stats_usec": stats * 1e6,
+            "spawn_count_usec": count * 1e6,
+            "tree_resolved_usec": joined * 1e6,
+            "resolve_usec": resolve / size * 1e6,
+            "chain_depth": depth,
+            "chain_relate_usec": chain_build / depth * 1e6,
+            "chain_resolve_usec": chain_resolve / depth * 1e6}
+
+
+def bench_chain(w, scale):
+    hosts = [f"host{n}" for n in range(max(4, int(16 * scale)))]
+    piped = {hosts[0]: {hosts[-1]: "cat > /dev/null"}}
+    results = {}
+
+    w.set_parms({"ssh-command": FAKE_SSH})
+    try:
+        for label, parms, pool in (("sequential", {}, False), ("parallel", {"parallel": 8}, False),
+                                   ("pooled_parallel", {"parallel": 8}, True)):
+            w.set_parms({"ssh-pool": pool})
+            start = time.perf_counter()
+            w.chain("seq 1 1000", {"hosts": hosts, "stdout": piped, **parms})
+            results[f"{label}_msec_per_host"] = (time.perf_counter() - start) / len(hosts) * 1e3
+    finally:
+        w.set_parms({"ssh-command": "ssh", "ssh-pool": False})
+    return results
+
+
+def bench_compiler(w, scale):
+    source = synthetic_source(max(1000, int(100000 * scale)))
+    lines = source.count("\n")
+    best = per_call(lambda: compile_source(source), 1)
+    return {"lines": lines, "lines_per_sec": lines / best, "mb_per_sec": len(source) / best / 1e6}
+
+
+BENCHMARKS = {"bash": bench_bash, "context": bench_context, "hooks": bench_hooks, "spawn": bench_spawn,
+              "join": bench_join, "tree": bench_tree, "chain": bench_chain, "compiler": bench_compiler}
+
+
+def version():
+    try:
+        with open(os.path.join(TESTS, "..", "version.conf")) as f:
+            return f.read().strip()
+    except OSError:
+        return "unknown"
+
+
+# Print each result, and how it changed from an earlier run if there's one to compare with
+def report(results, previous, file=sys.stdout):
+    for name, metrics in results.items():
+        print(f"{name}:", file=file)
+        for metric, value in metrics.items():
+            line = f"  {metric:<30} {value:14,.2f}" if isinstance(value, float) else f"  {metric:<30} {value:11,}"
+            old = previous.get(name, {}).get(metric)
+            if old:
+                line += f"  ({(value - old) / old * 100:+.1f}% from {old:,.2f})"
+            print(line, file=file)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog="bench_suite.py", description="Benchmark the Watiba runtime and compiler")
+    parser.add_argument("--quick", action="store_true", help="run each benchmark at a tenth of its size")
+    parser.add_argument("--only", help="comma separated benchmarks to run: " + ", ".join(BENCHMARKS))
+    parser.add_argument("--json", help="write the results as JSON to this file, or - for STDOUT")
+    parser.add_argument("--compare", help="JSON results of an earlier run to compare with")
+    args = parser.parse_args()
+
+    names = args.only.split(",") if args.only else list(BENCHMARKS)
+    unknown = [name for name in names if name not in BENCHMARKS]
+    if unknown:
+        parser.error(f"unknown benchmark: {', '.join(unknown)}")
+
+    previous = {}
+    if args.compare:
+        with open(args.compare) as f:
+            previous = json.load(f)["results"]
+
+    w = Watiba()
+    scale = .1 if args.quick else 1
+    results = {}
+    for name in names:
+        results[name] = BENCHMARKS[name](w, scale)
+
+    # With JSON on STDOUT, the readable report goes to STDERR
+    report(results, previous, sys.stderr if args.json == "-" else sys.stdout)
+
+    if args.json:
+        document = {"watiba": version(), "python": platform.python_version(), "platform": platform.platform(),
+                    "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"), "quick": args.quick, "results": results}
+        if args.json == "-":
+            json.dump(document, sys.stdout, indent=2)
+            print()
+        else:
+            with open(args.json, "w") as f:
+                json.dump(document, f, indent=2)
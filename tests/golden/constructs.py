@@ -0,0 +1,53 @@
+#!/usr/bin/python3
+import watiba
+_watiba_ = watiba.Watiba()
+import os
+
+# Backticks: local, without directory context, remote and remote by variable
+out = _watiba_.bash('ls -l /tmp', True)
+quiet = _watiba_.bash('cd /tmp', False)
+remote = _watiba_.ssh('uname -r', "build.example.com", True)
+host = "localhost"
+by_var = _watiba_.ssh('hostname', host, True)
+both = _watiba_.bash('echo one', True).stdout + _watiba_.bash('echo two', True).stdout
+for line in _watiba_.bash('ls {os.getcwd()}', True).stdout:
+    print(line)
+
+# Lines inside a triple-quoted string pass through, the line opening one is compiled like any other
+'''
+Docstring with `date` in it
+'''
+text = """one _watiba_.bash('date', True)
+two `uname`"""
+
+# Commands continued on the next line
+listing = _watiba_.bash('ls -l /tmp', True)
+
+total = len(out.stdout) + \
+    len(quiet.stdout)
+
+# Spawns, chains, hooks and -ctl statements
+_watiba_.spawn_ctlr.set_parms({'max': 4})
+_watiba_.set_parms({'ssh-command': 'ssh'})
+def __watiba_resolver_1__(promise, args):
+    print(promise.output.exit_code)
+    return True
+p = _watiba_.spawn('sleep 1', __watiba_resolver_1__, {'name': 'sleeper'}, "localhost")
+def __watiba_resolver_2__(promise, args):
+    return True
+q = _watiba_.spawn('uptime', __watiba_resolver_2__, {}, "build.example.com")
+def __watiba_resolver_3__(promise, args):
+    return True
+r = _watiba_.spawn('echo after', __watiba_resolver_3__, {}, "localhost", after=p)
+c = _watiba_.chain('uname -r', {'hosts': ['a', 'b']})
+pc = _watiba_.chain('uname -r', {**{'hosts': ['a', 'b']}, "parallel": 2})
+
+
+def audit(match, parms):
+    return True
+
+
+_watiba_.add_hook("^rm (\S.*)",audit,{"count":0},recursive=True, post=False)
+_watiba_.add_hook("^ls",audit,{},recursive=True, post=True)
+_watiba_.add_hook("^cp",audit,{},recursive=False, post=False)
+_watiba_.remove_hooks("^rm (\S.*)")
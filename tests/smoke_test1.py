@@ -117,4 +117,19 @@ if o.cwd == "/tmp":
     print(f"ERROR: context should have been lost, but wasn't.")
     sys.exit(1)
 w.bash("cd ..")
-print("Losing directory context passed.\n\n")
\ No newline at end of file
+print("Losing directory context passed.\n\n")
+
+##########################################################################################################
+print("Testing streamed command output")
+
+s = w.bash_stream('echo "line 1" && echo "line 2" >&2 && cd /tmp')
+lines = [line for line in s]
+if ("stdout", "line 1") not in lines or ("stderr", "line 2") not in lines:
+    print(f"ERROR: streamed output is missing lines: {lines}")
+    sys.exit(1)
+
+if s.exit_code != 0 or s.cwd != "/tmp":
+    print(f"ERROR: streamed command did not complete properly.  Exit code: {s.exit_code} CWD: {s.cwd}")
+    sys.exit(1)
+w.bash("cd ..")
+print("Streamed command output passed.\n\n")
\ No newline at end of file
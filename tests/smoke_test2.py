@@ -0,0 +1,1042 @@
+#!/usr/bin/env python3
+#####################################################################################################
+# Automated testing of Watiba class functions that needs no input.  Remote commands run through
+# tests/fake_ssh, which runs them locally.  Pre-compiler not tested here.
+#
+# Author: Ray Walker
+# raythonic@mgail.com
+#####################################################################################################
+
+import watiba as watiba
+import os
+import sys
+import time
+import shutil
+import threading
+import io
+import re
+import random
+import asyncio
+import tempfile
+import contextlib
+import subprocess
+
+fake_ssh = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fake_ssh")
+
+print("Running Smoke Test 2")
+
+print("Instantiating Watiba")
+w = watiba.Watiba()
+
+##########################################################################################################
+print("Testing spawn after other promises")
+
+p1 = w.spawn('sleep 0.2; echo "first"', lambda promise, args: True, {})
+p2 = w.spawn('echo "second"', lambda promise, args: True, {}, after=[p1])
+p2.join({"timeout": 10})
+if p2.run_start < p1.end_time:
+    print(f"ERROR: spawned command started before the promise it was after resolved")
+    sys.exit(1)
+
+pf = w.spawn('false', lambda promise, args: promise.output.exit_code == 0, {})
+pd = w.spawn('echo "never"', lambda promise, args: True, {}, after=pf)
+done = w.spawn('sleep 0.5', lambda promise, args: True, {})
+done.join({"timeout": 10})
+if not pd.failed() or pd.output is not None:
+    print(f"ERROR: command ran, or didn't fail, after a promise that didn't resolve: {pd.failure}")
+    sys.exit(1)
+print("Spawn after passed.\n\n")
+
+##########################################################################################################
+print("Testing command graph")
+
+g = w.graph()
+g.add("a", "sleep 0.2").add("b", "sleep 0.1", after="a").add("c", "sleep 0.3", after=["a"])
+g.add("d", "echo d", after=["b", "c"]).add("e", "exit 2", after=["a"]).add("f", "echo f", after=["e"])
+g.add("h", "echo h", after=["f"]).add("i", "echo i", after=["d", "f"])
+g.add("j", "echo j", resolver=lambda promise, args: False).add("k", "echo k", after="j")
+g.run().join({"timeout": 10})
+
+# A failure skips everything after it, however far down, and only that
+if g.nodes_with("resolved") != ["a", "b", "c", "d"] or g.nodes_with("failed") != ["e", "j"] \
+        or g.nodes_with("skipped") != ["f", "h", "i", "k"]:
+    print(f"ERROR: graph nodes finished wrong: {g.status}")
+    sys.exit(1)
+if g.promises["e"].failure != "Exit code 2" or g.promises["j"].failure != "Resolver did not resolve the promise" \
+        or any(g.promises[name].run_start for name in g.nodes_with("skipped")):
+    print(f"ERROR: graph failures wrong: {g.promises['e'].failure}, {g.promises['j'].failure}")
+    sys.exit(1)
+
+# Each node starts once what it's after has finished, and not before.  b and c, both after a, run side by side.
+for name, node in g.nodes.items():
+    started = g.promises[name].run_start
+    if started and any(started < g.promises[d].end_time for d in node["after"]):
+        print(f"ERROR: graph node {name} started before the nodes it's after finished")
+        sys.exit(1)
+if g.promises["c"].run_start >= g.promises["b"].end_time:
+    print("ERROR: independent graph nodes didn't run side by side")
+    sys.exit(1)
+
+if g.critical_path() != ["a", "c", "d"]:
+    print(f"ERROR: wrong critical path: {g.critical_path()}")
+    sys.exit(1)
+report = io.StringIO()
+g.report(file=report)
+if not report.getvalue().startswith("Graph: 10 nodes, 4 resolved, 2 failed, 4 skipped") \
+        or "Failed: e: Exit code 2" not in report.getvalue() or "Skipped: f, h, i, k" not in report.getvalue():
+    print(f"ERROR: graph report wrong:\n{report.getvalue()}")
+    sys.exit(1)
+
+# Graphs that can't run are rejected before anything is started: cycles (naming the nodes in and after them),
+# nodes after themselves, and nodes after ones that aren't in the graph
+bad_graphs = [(w.graph().add("x", "true").add("y", "true", after=["x", "z"]).add("z", "true", after="y")
+               .add("after-cycle", "true", after="z"), "Dependency cycle among nodes: y, z, after-cycle"),
+              (w.graph().add("self", "true", after="self"), "Dependency cycle among nodes: self"),
+              (w.graph().add("lost", "true", after="nowhere"), "Node lost is after nowhere, which isn't in the graph")]
+for bad, message in bad_graphs:
+    try:
+        bad.run()
+        print(f"ERROR: graph that can't run was run: {message}")
+        sys.exit(1)
+    except watiba.WTGraphException as ex:
+        if ex.message != message or bad.promises:
+            print(f"ERROR: graph rejected with {ex.message}, started {list(bad.promises)}")
+            sys.exit(1)
+
+for change in (lambda: g.add("late", "true"), lambda: w.graph().add("a", "true").add("a", "true"), g.run):
+    try:
+        change()
+        print("ERROR: graph added to while running, given a duplicate node, or run twice")
+        sys.exit(1)
+    except watiba.WTGraphException:
+        pass
+print("Command graph passed.\n\n")
+
+##########################################################################################################
+print("Testing promise tree statistics on a deep chain")
+
+depth = 5000
+started = time.time()
+chain = [watiba.WTPromise("link 0")]
+for n in range(1, depth):
+    link = watiba.WTPromise(f"link {n}")
+    link.relate(chain[-1])
+    chain.append(link)
+
+# Everything but the last link resolved: no subtree is fully resolved yet
+for link in chain[:-1]:
+    link.set_resolved()
+stats = chain[-1].tree_stats()
+if stats != {"total": depth, "resolved": depth - 1, "running": 0, "failed": 0} or chain[0].tree_resolved() \
+        or chain[2500].tree_stats(False)["total"] != depth - 2500:
+    print(f"ERROR: deep chain stats wrong: {stats}, {chain[2500].tree_stats(False)}")
+    sys.exit(1)
+
+joined = []
+t = threading.Thread(target=lambda: joined.append(chain[1000].join({"timeout": 10})))
+t.start()
+time.sleep(0.1)
+chain[-1].set_resolved()
+t.join()
+if joined != [None] or not chain[0].tree_resolved() or chain[0].resolved_count() != depth:
+    print("ERROR: join() on a deep chain wasn't woken when the last link resolved")
+    sys.exit(1)
+
+# A new unresolved link makes the resolved chain above it unresolved again
+extra = watiba.WTPromise("extra")
+extra.relate(chain[-1])
+if chain[0].tree_resolved() or chain[0].spawn_count() != depth + 1:
+    print("ERROR: relating an unresolved promise to a resolved chain wasn't counted")
+    sys.exit(1)
+extra.set_resolved()
+if not chain[0].tree_resolved() or time.time() - started > 5:
+    print(f"ERROR: deep chain too slow ({time.time() - started:.1f}s) or not resolved")
+    sys.exit(1)
+print("Promise tree statistics passed.\n\n")
+
+##########################################################################################################
+print("Testing join and wait timeouts")
+
+
+# Seconds a join() or wait() blocked, and whether it timed out.  (A timeout dumps the tree, kept out of the output.)
+def timed(call, args):
+    started = time.time()
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            call(args)
+        return time.time() - started, False
+    except watiba.WTWaitException:
+        return time.time() - started, True
+
+
+parent, child = watiba.WTPromise("parent"), watiba.WTPromise("child")
+child.relate(parent)
+parent.set_resolved()
+
+# The parent is resolved, so wait() returns at once, but join() waits on the child too
+waited, join_timed_out = timed(parent.wait, {"timeout": 5}), timed(parent.join, {"timeout": 0.3})
+expired = timed(parent.join, {"expire": 2, "sleep": 0.1})
+if waited[1] or waited[0] > 0.1 or not join_timed_out[1] or not 0.3 <= join_timed_out[0] < 2 \
+        or not expired[1] or not 0.2 <= expired[0] < 2:
+    print(f"ERROR: wrong timeouts: wait {waited}, join {join_timed_out}, join with expire {expired}")
+    sys.exit(1)
+
+# Resolving the child wakes join() right away, not at the end of its timeout
+threading.Timer(0.2, child.set_resolved).start()
+joined = timed(parent.join, {"timeout": 10})
+if joined[1] or joined[0] > 2:
+    print(f"ERROR: join wasn't woken when the last promise resolved: {joined}")
+    sys.exit(1)
+print("Join and wait timeouts passed.\n\n")
+
+##########################################################################################################
+print("Testing on_resolved callbacks")
+
+calls = []
+racing = watiba.WTPromise("racing")
+racing.on_resolved(lambda p: calls.append("resolved"), lambda p: calls.append("failed"))
+
+# Resolved by many threads at once, the callback still runs once, and one added afterwards runs right away
+threads = [threading.Thread(target=racing.set_resolution, args=(True,)) for _ in range(8)]
+for t in threads:
+    t.start()
+for t in threads:
+    t.join()
+racing.set_resolved()
+racing.on_resolved(lambda p: calls.append("late"), lambda p: calls.append("late failed"))
+if calls != ["resolved", "late"]:
+    print(f"ERROR: on_resolved callbacks on a resolved promise: {calls}")
+    sys.exit(1)
+
+# A failure calls on_failed once, and nothing is called again if the promise fails again or resolves after all
+calls = []
+failing = watiba.WTPromise("failing")
+failing.on_resolved(lambda p: calls.append("resolved"), lambda p: calls.append("failed"))
+failing.set_failed("first")
+failing.set_failed("second")
+failing.set_resolution(True)
+failing.on_resolved(lambda p: calls.append("late"), lambda p: calls.append("late failed"))
+
+# So does a resolver returning without resolving its promise, even if it's resolved later on
+declined = watiba.WTPromise("declined")
+declined.on_resolved(lambda p: calls.append("declined resolved"), lambda p: calls.append("declined"))
+declined.set_resolution(False)
+declined.set_resolution(False)
+declined.set_resolution(True)
+if calls != ["failed", "late", "declined"]:
+    print(f"ERROR: on_resolved callbacks on failed promises: {calls}")
+    sys.exit(1)
+print("On_resolved callbacks passed.\n\n")
+
+##########################################################################################################
+print("Testing promise watchers")
+
+from watiba.wtwatcher import watch_scheduler, WATCHER_WORKERS, COMPACT_SIZE
+
+fired = []
+lock = threading.Lock()
+running = [0, 0]  # Watchers running now, most at once
+
+
+def watcher(promise, args):
+    with lock:
+        fired.append(promise.command)
+        running[0] += 1
+        running[1] = max(running)
+    time.sleep(args.get("sleep", 0))
+    with lock:
+        running[0] -= 1
+
+
+# Watchers fire in deadline order, not the order they were set, and not for a promise resolved in time
+watched = {name: watiba.WTPromise(name) for name in ["late", "early", "middle", "resolved"]}
+watched["late"].watch(watcher, {"expire": 0.6})
+watched["early"].watch(watcher, {"expire": 0.2})
+watched["resolved"].watch(watcher, {"expire": 0.3})
+watched["middle"].watch(watcher, {"expire": 0.4})
+watched["resolved"].set_resolved()
+time.sleep(1)
+if fired != ["early", "middle", "late"]:
+    print(f"ERROR: watchers fired out of order, or for a resolved promise: {fired}")
+    sys.exit(1)
+
+# Watchers due at once share a bounded pool of threads
+fired.clear()
+for n in range(WATCHER_WORKERS * 3):
+    watiba.WTPromise(f"slow {n}").watch(watcher, {"expire": 0, "sleep": 0.1})
+deadline = time.time() + 10
+while len(fired) < WATCHER_WORKERS * 3 and time.time() < deadline:
+    time.sleep(0.05)
+if len(fired) != WATCHER_WORKERS * 3 or running[1] > WATCHER_WORKERS:
+    print(f"ERROR: {len(fired)} watchers fired, up to {running[1]} at once")
+    sys.exit(1)
+
+# Watches of promises that resolve early don't pile up in the scheduler until their deadlines
+for n in range(COMPACT_SIZE * 4):
+    # (Not named "promise": spawns at the top level of this script would become its children)
+    quick = watiba.WTPromise(f"quick {n}")
+    quick.watch(watcher, {"expire": 60})
+    quick.set_resolved()
+if len(watch_scheduler.watches) > COMPACT_SIZE:
+    print(f"ERROR: {len(watch_scheduler.watches)} cancelled watches left in the scheduler")
+    sys.exit(1)
+print("Promise watchers passed.\n\n")
+
+##########################################################################################################
+print("Testing the spawn worker pool")
+
+# Its own Watiba object: promises left unresolved by earlier tests would count against "max"
+pw = watiba.Watiba()
+
+# "max" holds spawns back in pool mode too: no more than 2 commands at once on 4 workers
+pw.spawn_ctlr.set_parms({"pool-size": 4, "max": 2})
+pooled = [pw.spawn("sleep 0.3", lambda promise, args: True, {}) for _ in range(4)]
+for p in pooled:
+    p.join({"timeout": 10})
+overlap = max(sum(1 for o in pooled if o.run_start <= p.run_start < o.run_end) for p in pooled)
+if overlap != 2:
+    print(f"ERROR: {overlap} pooled commands ran at once with max 2")
+    sys.exit(1)
+
+
+# Resolvers on every worker joining the commands they spawn.  Queued behind them, those would never get a worker.
+def joining_resolver(promise, args):
+    # (Not spawned in a comprehension, which has a frame of its own without "promise" in it)
+    children = []
+    for n in range(2):
+        children.append(pw.spawn(f"echo {n}", lambda promise, args: True, {}))
+    for child in children:
+        child.join({"timeout": 5})
+    args["joined"].append(promise.command)
+    return True
+
+
+pw.spawn_ctlr.set_parms({"pool-size": 2, "max": 10})
+joined = []
+parents = [pw.spawn(f"echo parent {n}", joining_resolver, {"joined": joined}) for n in range(2)]
+try:
+    for p in parents:
+        p.join({"timeout": 10})
+except watiba.WTWaitException:
+    pass
+if sorted(joined) != ["echo parent 0", "echo parent 1"] or any(len(p.children) != 2 for p in parents):
+    print(f"ERROR: resolvers on pool workers deadlocked joining their own spawns: {joined}")
+    sys.exit(1)
+print("Spawn worker pool passed.\n\n")
+
+##########################################################################################################
+print("Testing the hook index")
+
+from watiba.wthooks import WTHookIndex, UNCOMBINABLE
+
+# Literal prefixes (some optional or repeated by a quantifier), patterns merged into one alternation, and patterns
+# that can't be merged: backreferences, named groups, inline flags and conditionals
+hook_patterns = ["rm ", "rm -rf", "ls", "ls*", "lsof", "l+s", "tar -zcvf (\\S.*)", "git (push|pull)", "cp|mv",
+                 "^echo", "^$", "\\w+ --help", ".*sudo", "[a-c]at", "(?:ssh|scp) ", "mk?dir",
+                 "(\\w)\\1", "(?P<tool>make|ninja)", "(?i)DOCKER", "(a)?(?(1)b|c)at", "(?P<x>x)(?P=x)"]
+if sum(1 for p in hook_patterns if UNCOMBINABLE.search(p)) != 5:
+    print("ERROR: hook index test patterns don't cover the patterns that can't be merged")
+    sys.exit(1)
+
+commands = ["rm -rf /tmp/x", "rm x", "rmdir x", "ls -l", "lsof -i", "s", "llls", "tar -zcvf a.tgz b", "git push",
+            "git fetch", "cp a b", "mv a b", "echo hi", "", "grep --help", "sudo ls", "cat x", "bat", "dat",
+            "ssh host", "scp a host:", "mkdir d", "mdir d", "aab", "ab", "make all", "ninja", "docker ps",
+            "Docker ps", "abat", "cat", "xx", "x"]
+rng = random.Random(7)
+commands += ["".join(rng.choice("abclmrstx -") for _ in range(rng.randint(0, 6))) for _ in range(2000)]
+
+
+# The patterns matching the command, the index's way and by trying every one in turn
+def index_matches(index, command):
+    return [pattern for pattern, regex in index.candidates(command) if regex.match(command)]
+
+
+for hooks in (hook_patterns, list(reversed(hook_patterns)), rng.sample(hook_patterns, 9)):
+    index = WTHookIndex([(p, re.compile(p)) for p in hooks])
+    for command in commands:
+        naive = [p for p in hooks if re.match(p, command)]
+        if index_matches(index, command) != naive:
+            print(f"ERROR: hook index matched {command!r} to {index_matches(index, command)}, expected {naive}")
+            sys.exit(1)
+
+# A pattern that doesn't survive being merged with the others is still matched on its own
+index = WTHookIndex([(p, re.compile(p)) for p in ("(a)", "\\d+")])
+index.combined = None
+index.fallback, index.combined_positions = [0, 1], []
+if index_matches(index, "42") != ["\\d+"]:
+    print("ERROR: hook index fallback patterns not matched")
+    sys.exit(1)
+
+# Through Watiba itself: hooks that can't be merged run, in the order they were added
+hooked = []
+hw = watiba.Watiba()
+for pattern in ("(?i)ECHO", "(?P<cmd>echo) ", "echo", "(\\w)\\1"):
+    hw.add_hook(pattern, lambda match, parms: parms["log"].append(parms["name"]) or True,
+                {"log": hooked, "name": pattern})
+hw.bash("echo hooked")
+hw.bash("ee")
+if hooked != ["(?i)ECHO", "(?P<cmd>echo) ", "echo", "(\\w)\\1"]:
+    print(f"ERROR: hooks that can't be merged didn't run in order: {hooked}")
+    sys.exit(1)
+print("Hook index passed.\n\n")
+
+##########################################################################################################
+print("Testing hooks run from several threads")
+
+hw = watiba.Watiba()
+both_hooked = threading.Barrier(2)
+guarded = []
+
+
+# Runs the command again, which mustn't run this hook again, then waits for the other thread to be in it too
+def guard_hook(match, parms):
+    parms["w"].bash("echo guarded again")
+    guarded.append(threading.current_thread().name)
+    both_hooked.wait(5)
+    return True
+
+
+def run_guarded(failures):
+    try:
+        hw.bash("echo guarded")
+    except Exception as ex:
+        failures.append(ex)
+
+
+# A hook that won't run itself again only stops itself in its own thread
+hw.add_hook("^echo guarded", guard_hook, {"w": hw}, recursive=False)
+failures = []
+threads = [threading.Thread(target=run_guarded, args=(failures,), name=f"guarded-{i}") for i in range(2)]
+for t in threads:
+    t.start()
+for t in threads:
+    t.join(10)
+if failures or sorted(guarded) != ["guarded-0", "guarded-1"]:
+    print(f"ERROR: non-recursive hook in two threads at once ran in {guarded}, failures {failures}")
+    sys.exit(1)
+
+# Post hooks in the background: the command returns while they run, and a failure shows up when waited on
+hw.remove_hooks()
+hw.set_parms({"async-post-hooks": True})
+release = threading.Event()
+hw.add_hook("^echo background", lambda match, parms: release.wait(5), {}, post=True)
+hw.add_hook("^echo background fails", lambda match, parms: False, {}, post=True)
+out = hw.bash("echo background")
+if out.post_hooks is None or out.post_hooks.done():
+    print("ERROR: background post hook finished before the command returned")
+    sys.exit(1)
+release.set()
+if out.wait_post_hooks(5)["success"] is not True:
+    print("ERROR: background post hook results wrong")
+    sys.exit(1)
+out = hw.bash("echo background fails")
+try:
+    out.wait_post_hooks(5)
+    print("ERROR: failed background post hook didn't raise")
+    sys.exit(1)
+except Exception as ex:
+    if "post-hooks failed" not in str(ex) or str(ex) not in out.stderr:
+        print(f"ERROR: failed background post hook reported wrong: {ex}, STDERR {out.stderr}")
+        sys.exit(1)
+if hw.bash("echo no hooks").post_hooks is not None:
+    print("ERROR: command with no post hooks has background post hooks")
+    sys.exit(1)
+hw.remove_hooks()
+print("Hooks run from several threads passed.\n\n")
+
+##########################################################################################################
+print("Testing output capture policies")
+
+o = w.bash("seq 1 100", capture={"capture": "tail", "capture-lines": 3})
+if list(o.stdout) != ["98", "99", "100", ""] or o.stdout.dropped != 97:
+    print(f"ERROR: tail policy kept the wrong lines: {list(o.stdout)}, dropped {o.stdout.dropped}")
+    sys.exit(1)
+
+o = w.bash("seq 1 100", capture={"capture": "head", "capture-lines": 3})
+if list(o.stdout) != ["1", "2", "3"] or o.stdout.dropped != 98:
+    print(f"ERROR: head policy kept the wrong lines: {list(o.stdout)}, dropped {o.stdout.dropped}")
+    sys.exit(1)
+
+o = w.bash("seq 1 20000", capture={"capture": "spill", "capture-bytes": 1024})
+if not o.stdout.spilled() or len(o.stdout) != 20001 or o.stdout[19999] != "20000":
+    print(f"ERROR: spill policy lost output: spilled {o.stdout.spilled()}, {len(o.stdout)} lines")
+    sys.exit(1)
+
+o = w.bash("seq 1 3")
+if list(o.stdout) != ["1", "2", "3", ""] or o.raw != b"1\n2\n3\n":
+    print(f"ERROR: all policy lost output: {list(o.stdout)}, {o.raw}")
+    sys.exit(1)
+
+# Output that fits the limits reads the same under every policy: no output, no final newline, empty lines
+for command in ("true", "printf x", "seq 1 3", "printf '1\\n2\\n3'", "printf '\\n\\n'"):
+    kept = [list(w.bash(command, capture={"capture": policy, "capture-lines": 3, "capture-bytes": 2}).stdout)
+            for policy in ("all", "head", "tail", "spill")]
+    if any(lines != kept[0] for lines in kept):
+        print(f"ERROR: capture policies disagree on the output of {command}: {kept}")
+        sys.exit(1)
+
+# The limits, with and without a final newline, with the context marker after the output, on lines split across
+# reads, and on STDERR
+limited = [("seq 1 10", "head", 3, ["1", "2", "3"], 8), ("seq 1 10", "tail", 3, ["8", "9", "10", ""], 7),
+           ("printf '1\\n2\\n3'", "head", 2, ["1", "2"], 1), ("printf '1\\n2\\n3'", "tail", 2, ["2", "3"], 1),
+           ("seq 1 200000", "head", 2, ["1", "2"], 199999),
+           ("seq 1 200000", "tail", 2, ["199999", "200000", ""], 199998)]
+for command, policy, lines, expected, dropped in limited:
+    o = w.bash(f"cd /tmp; {command}", capture={"capture": policy, "capture-lines": lines})
+    if list(o.stdout) != expected or o.stdout.dropped != dropped or o.cwd != "/tmp":
+        print(f"ERROR: {policy} {lines} of {command} kept {list(o.stdout)}, dropped {o.stdout.dropped}, cwd {o.cwd}")
+        sys.exit(1)
+o = w.bash("seq 1 5 >&2", capture={"capture": "tail", "capture-lines": 2})
+if list(o.stderr) != ["4", "5", ""] or o.stderr.dropped != 3 or list(o.stdout) != [""]:
+    print(f"ERROR: tail policy of STDERR kept {list(o.stderr)}, dropped {o.stderr.dropped}")
+    sys.exit(1)
+
+# Spilling starts past the byte limit, not at it
+for limit, spilled in ((5, True), (6, False)):
+    o = w.bash("seq 1 3", False, capture={"capture": "spill", "capture-bytes": limit})
+    if o.stdout.spilled() != spilled or list(o.stdout) != ["1", "2", "3", ""]:
+        print(f"ERROR: spill of 6 bytes over {limit} bytes wrong: spilled {o.stdout.spilled()}, {list(o.stdout)}")
+        sys.exit(1)
+
+# The context marker is found in spilled output, after a final line with no newline
+o = w.bash("cd /usr; seq 1 20000; printf end", capture={"capture": "spill", "capture-bytes": 1024})
+if not o.stdout.spilled() or o.cwd != "/usr" or len(o.stdout) != 20001 or o.stdout[-1] != "end" \
+        or o.stdout[0] != "1" or not o.raw.endswith(b"20000\nend"):
+    print(f"ERROR: spilled output with the context marker wrong: cwd {o.cwd}, last line {o.stdout[-1]}")
+    sys.exit(1)
+
+# STDERR spills on its own, to the directory asked for
+spill_dir = tempfile.mkdtemp(prefix="watiba-spill-")
+o = w.bash("seq 1 20000 >&2", capture={"capture": "spill", "capture-bytes": 100, "capture-dir": spill_dir})
+if not o.stderr.spilled() or o.stdout.spilled() or len(o.stderr) != 20001 \
+        or not os.readlink(f"/proc/self/fd/{o.stderr.file.fileno()}").startswith(spill_dir + "/"):
+    print(f"ERROR: STDERR spill wrong: spilled {o.stderr.spilled()}, {len(o.stderr)} lines")
+    sys.exit(1)
+shutil.rmtree(spill_dir)
+
+try:
+    w.bash("true", capture={"capture": "middle"})
+    print("ERROR: unknown capture policy accepted")
+    sys.exit(1)
+except watiba.WTCaptureException:
+    pass
+print("Output capture policies passed.\n\n")
+
+##########################################################################################################
+print("Testing context tracking of output with no final newline")
+
+o = w.bash("cd /tmp; printf '\\377\\000abc'")
+if o.raw != b"\xff\x00abc" or o.cwd != "/tmp" or o.output_bytes != 5:
+    print(f"ERROR: context marker leaked into the output: {o.raw}, cwd {o.cwd}, {o.output_bytes} bytes")
+    sys.exit(1)
+
+o = w.bash("cd /; printf 'a\\nb'", capture={"capture": "tail", "capture-lines": 1})
+if list(o.stdout) != ["b"] or o.cwd != "/":
+    print(f"ERROR: context marker leaked into the tail policy: {list(o.stdout)}, cwd {o.cwd}")
+    sys.exit(1)
+
+s = w.bash_stream("cd /usr; printf 'x\\n\\ny'")
+if list(s) != [("stdout", "x"), ("stdout", ""), ("stdout", "y")] or s.cwd != "/usr":
+    print(f"ERROR: context marker leaked into the stream, cwd {s.cwd}")
+    sys.exit(1)
+print("Context tracking passed.\n\n")
+
+##########################################################################################################
+print("Testing stopping endless commands")
+
+# Any process still running with this command line?
+def still_running(command):
+    time.sleep(0.2)
+    return subprocess.run(["pgrep", "-f", command], stdout=subprocess.DEVNULL).returncode == 0
+
+def break_stream():
+    for name, line in w.bash_stream("yes endless-stream"):
+        break
+
+t = threading.Thread(target=break_stream, daemon=True)
+t.start()
+t.join(10)
+if t.is_alive() or still_running("[y]es endless-stream"):
+    print("ERROR: breaking out of an endless stream hung, or left the command running")
+    sys.exit(1)
+
+with w.bash_stream("yes endless-stream-closed") as s:
+    next(iter(s))
+if still_running("[y]es endless-stream-closed"):
+    print("ERROR: closing an endless stream left the command running")
+    sys.exit(1)
+
+async def cancel_endless():
+    try:
+        await asyncio.wait_for(w.abash("yes endless-abash > /dev/null"), 0.5)
+    except asyncio.TimeoutError:
+        return True
+
+if not asyncio.run(cancel_endless()) or still_running("[y]es endless-abash"):
+    print("ERROR: cancelling abash() left the command running")
+    sys.exit(1)
+print("Stopping endless commands passed.\n\n")
+
+##########################################################################################################
+print("Testing the shell session backend")
+
+w.set_parms({"session": True})
+o1 = w.bash("cd /tmp; export SMOKE_SESSION=kept; printf 'no newline'")
+o2 = w.bash("echo $SMOKE_SESSION; pwd; echo oops >&2; exit 3")
+w.set_parms({"session": False})
+w.close_session()
+
+if o1.raw != b"no newline" or o1.cwd != "/tmp":
+    print(f"ERROR: session command output or cwd wrong: {o1.raw}, cwd {o1.cwd}")
+    sys.exit(1)
+
+if list(o2.stdout) != ["kept", "/tmp", ""] or list(o2.stderr) != ["oops", ""] or o2.exit_code != 3:
+    print(f"ERROR: session didn't keep shell state: {list(o2.stdout)}, {list(o2.stderr)}, exit {o2.exit_code}")
+    sys.exit(1)
+print("Shell session passed.\n\n")
+
+##########################################################################################################
+print("Testing directory context of spawned commands")
+
+w.bash("cd /tmp")
+
+
+resolver_cwd = []
+
+
+def cwd_resolver(promise, args):
+    resolver_cwd.append(w.bash("pwd").stdout[0])
+    return True
+
+
+p = w.spawn("pwd; cd /usr", cwd_resolver, {})
+p.join({"timeout": 10})
+if p.output.stdout[0] != "/tmp" or resolver_cwd != ["/usr"]:
+    print(f"ERROR: spawned command ran in the wrong directory: {p.output.stdout[0]}, resolver in {resolver_cwd}")
+    sys.exit(1)
+
+if w.cwd() != "/tmp" or w.bash("pwd").stdout[0] != "/tmp":
+    print(f"ERROR: spawned command changed the spawner's directory to {w.cwd()}")
+    sys.exit(1)
+
+# The main thread's own os.chdir() calls move its context, before and after a backticked cd
+w.bash("cd /usr")
+os.chdir("/var")
+if w.cwd() != "/var" or w.bash("pwd").stdout[0] != "/var":
+    print(f"ERROR: os.chdir() after a cd was ignored: {w.cwd()}")
+    sys.exit(1)
+w.bash("cd /tmp")
+if os.getcwd() != "/tmp":
+    print(f"ERROR: cd didn't move Python's CWD: {os.getcwd()}")
+    sys.exit(1)
+print("Spawned command directory context passed.\n\n")
+
+##########################################################################################################
+print("Testing a pooled parallel chain with piping")
+
+work = tempfile.mkdtemp(prefix="smoke-test2-")
+os.environ["FAKE_SSH_LOG"] = os.path.join(work, "ssh.log")
+os.environ["FAKE_SSH_CONTROL_LOG"] = os.path.join(work, "control.log")
+w.set_parms({"ssh-command": fake_ssh, "ssh-pool": True, "ssh-pool-max": 1})
+
+out = w.chain("echo $((6 * 7))", {"hosts": ["h1", "h2", "h3"], "parallel": 3,
+                                  "stdout": {"h2": {"sink": f"cat > {work}/piped"}}})
+# Every master is idle now, so one more host evicts the others to get back down to the maximum.  The next command to
+# it goes over its master.
+w.ssh("true", "h4")
+w.ssh("true", "h4")
+pool = w.connection_pool()
+with open(os.environ["FAKE_SSH_LOG"]) as f:
+    calls = [line for line in f if " -O " not in f" {line}"]
+with open(os.environ["FAKE_SSH_CONTROL_LOG"]) as f:
+    control = [line.split() for line in f]
+with open(f"{work}/piped") as f:
+    piped = f.read()
+sockets = {host: os.path.exists(pool.control_path(("", host, 22))) for host in ("h1", "h2", "h3", "h4")}
+held = (dict(pool.in_use), list(pool.masters))
+
+# Closing the pool tells the last master to exit, without holding the pool's lock while it does
+unlocked = []
+close_master = pool.close_master
+pool.close_master = lambda key, path: (unlocked.append(not pool.lock.locked()), close_master(key, path))
+pool.close()
+del pool.close_master
+with open(os.environ["FAKE_SSH_CONTROL_LOG"]) as f:
+    closed = [line.split() for line in f][len(control):]
+
+w.set_parms({"ssh-command": "ssh", "ssh-pool": False})
+del os.environ["FAKE_SSH_LOG"]
+del os.environ["FAKE_SSH_CONTROL_LOG"]
+shutil.rmtree(work)
+
+if sorted(out) != ["h1", "h2", "h3"] or any(out[h].stdout[0] != "42" for h in out) or piped != "42\n":
+    print(f"ERROR: pooled chain output wrong: {[(h, list(out[h].stdout)) for h in out]}, piped {piped!r}")
+    sys.exit(1)
+
+if len(calls) != 6 or not all("ControlPath=" in line for line in calls):
+    print(f"ERROR: pooled chain didn't run every command over a pooled connection: {calls}")
+    sys.exit(1)
+
+# Each host got a master that persists by itself, the second command to h4 shared its master, and the evicted masters
+# were told to exit
+masters = sorted(record[1] for record in control if record[0] == "master" and record[3] == "300")
+exits = sorted(record[1] for record in control if record[0] == "exit")
+if masters != ["h1", "h2", "h3", "h4", "sink"] or [r[:2] for r in control if r[0] == "mux"] != [["mux", "h4"]] \
+        or exits != ["h1", "h2", "h3", "sink"] or sockets != {"h1": False, "h2": False, "h3": False, "h4": True}:
+    print(f"ERROR: pooled commands didn't share master connections: {control}, sockets {sockets}")
+    sys.exit(1)
+if [r[:2] for r in closed] != [["exit", "h4"]] or unlocked != [True]:
+    print(f"ERROR: closing the pool didn't close its master: {closed}")
+    sys.exit(1)
+
+if held != ({}, [("", "h4", 22)]):
+    print(f"ERROR: pool still holds busy or extra masters: {held}")
+    sys.exit(1)
+print("Pooled chain passed.\n\n")
+
+##########################################################################################################
+print("Testing chain piping over fake ssh")
+
+work = tempfile.mkdtemp(prefix="smoke-test2-")
+os.environ["FAKE_SSH_LOG"] = os.path.join(work, "ssh.log")
+w.set_parms({"ssh-command": fake_ssh})
+
+w.chain("seq 1 1000", {"hosts": ["src"],
+                       "stdout": {"src": {"t1": f"cat > {work}/t1", "t2": f"wc -l > {work}/t2"}}})
+streamed = len(open(os.environ["FAKE_SSH_LOG"]).readlines())
+w.chain("seq 1 1000; echo err >&2", {"hosts": ["src"], "pipe-chunk-lines": 300,
+                                      "stderr": {"src": {"t3": f"cat >> {work}/t3"}},
+                                      "stdout": {"src": {"t4": f"cat >> {work}/t4"}}})
+chunked = len(open(os.environ["FAKE_SSH_LOG"]).readlines()) - streamed
+
+w.set_parms({"ssh-command": "ssh"})
+del os.environ["FAKE_SSH_LOG"]
+piped = {name: open(f"{work}/{name}").read() for name in ("t1", "t2", "t3", "t4")}
+shutil.rmtree(work)
+
+expected = "".join(f"{n}\n" for n in range(1, 1001))
+if piped["t1"] != expected or piped["t2"].strip() != "1000" or piped["t3"] != "err\n" or piped["t4"] != expected:
+    print(f"ERROR: piped output wrong: {[(name, len(text)) for name, text in piped.items()]}")
+    sys.exit(1)
+
+# One command for the source and one per target, then four 300 line chunks of STDOUT and one of STDERR
+if streamed != 3 or chunked != 6:
+    print(f"ERROR: wrong number of remote commands for piping: {streamed} streamed, {chunked} chunked")
+    sys.exit(1)
+print("Chain piping passed.\n\n")
+
+##########################################################################################################
+print("Testing the asyncio API")
+
+
+async def async_resolver(promise, args):
+    await asyncio.sleep(0.1)
+    args["log"].append(promise.output.stdout[0])
+    return True
+
+
+async def async_tests():
+    # Each task keeps its own directory context
+    async def in_dir(directory):
+        await w.abash(f"cd {directory}")
+        return (await w.abash("sleep 0.3; pwd")).stdout[0]
+
+    started = time.time()
+    dirs = await asyncio.gather(in_dir("/usr"), in_dir("/var"), in_dir("/"))
+    elapsed = time.time() - started
+
+    log = []
+    p = await w.aspawn("echo spawned", async_resolver, {"log": log})
+    output = await p
+    await p.ajoin({"timeout": 10})
+
+    w.set_parms({"ssh-command": fake_ssh})
+    try:
+        remote = await w.assh("printf remote", "h1")
+        chained = await w.achain("echo $((6 * 7))", {"hosts": ["h1", "h2"], "parallel": 2})
+    finally:
+        w.set_parms({"ssh-command": "ssh"})
+    return dirs, elapsed, output, log, remote, chained
+
+
+dirs, elapsed, output, log, remote, chained = asyncio.run(async_tests())
+if dirs != ["/usr", "/var", "/"] or elapsed > 0.8 or w.cwd() != "/tmp":
+    print(f"ERROR: abash tasks didn't run side by side in their own directories: {dirs}, {elapsed:.2f}s")
+    sys.exit(1)
+
+if output.stdout[0] != "spawned" or log != ["spawned"]:
+    print(f"ERROR: aspawn or its async resolver failed: {list(output.stdout)}, {log}")
+    sys.exit(1)
+
+if remote.raw != b"remote" or [chained[h].stdout[0] for h in ("h1", "h2")] != ["42", "42"]:
+    print(f"ERROR: assh or achain output wrong: {remote.raw}, {[(h, list(chained[h].stdout)) for h in chained]}")
+    sys.exit(1)
+
+
+# A failed aspawn() command or resolver fails its promise, and "await promise" raises the failure
+async def broken_resolver(promise, args):
+    raise ValueError("broken resolver")
+
+
+async def async_failures():
+    w.add_hook("^echo denied", lambda match, parms: False, {})
+    try:
+        denied = await w.aspawn("echo denied", async_resolver, {"log": []})
+        broken = await w.aspawn("echo broken", broken_resolver, {})
+        raised = []
+        for p in (denied, broken):
+            try:
+                await asyncio.wait_for(p, 5)
+            except asyncio.TimeoutError:
+                raised.append("hung")
+            except Exception as ex:
+                raised.append(str(ex))
+        return denied, broken, raised
+    finally:
+        w.remove_hooks()
+
+
+denied, broken, raised = asyncio.run(async_failures())
+if not denied.failed() or not broken.failed() or "hung" in raised or raised[1] != "broken resolver":
+    print(f"ERROR: failed aspawn() promises wrong: {denied.failed()}, {broken.failed()}, {raised}")
+    sys.exit(1)
+
+
+# A coroutine hook on a synchronous command run from inside an event loop
+async def coroutine_hook(match, parms):
+    await asyncio.sleep(0)
+    parms["ran"] = True
+    return True
+
+
+async def sync_in_loop():
+    hook_parms = {}
+    w.add_hook("^echo in-loop", coroutine_hook, hook_parms)
+    try:
+        return w.bash("echo in-loop").stdout[0], hook_parms
+    finally:
+        w.remove_hooks()
+
+
+if asyncio.run(sync_in_loop()) != ("in-loop", {"ran": True}):
+    print("ERROR: coroutine hook of a synchronous command inside an event loop didn't run")
+    sys.exit(1)
+print("Asyncio API passed.\n\n")
+
+##########################################################################################################
+print("Testing command metrics")
+
+watiba.metrics.reset()
+w.set_parms({"metrics": True})
+w.add_hook("^echo metrics", lambda match, parms: False, {}, post=True)
+try:
+    w.bash("echo metrics; echo err >&2; sleep 0.1")
+    print("ERROR: failed post hook didn't raise")
+    sys.exit(1)
+except Exception:
+    pass
+w.remove_hooks()
+
+p = w.spawn("printf spawned", lambda promise, args: True, {})
+p.join({"timeout": 10})
+w.set_parms({"metrics": False})
+
+o = p.output
+if o.stdout_bytes != 7 or o.stderr_bytes != 0 or o.spawn_latency is None or o.run_time <= 0 or not o.peak_rss:
+    print(f"ERROR: spawned command's metrics wrong: {o.stdout_bytes}, {o.spawn_latency}, {o.run_time}, {o.peak_rss}")
+    sys.exit(1)
+
+m = watiba.metrics.to_dict()
+commands = {tuple(s["labels"].items()): s["value"] for s in m["watiba_commands_total"]["samples"]}
+seconds = m["watiba_command_seconds"]["samples"][0]["value"]
+streams = {s["labels"]["stream"]: s["value"] for s in m["watiba_output_bytes_total"]["samples"]}
+if commands != {(("host", "localhost"), ("status", "ok")): 2} or seconds["count"] != 2 or seconds["sum"] < 0.1 \
+        or streams != {"stdout": 15, "stderr": 4} \
+        or m["watiba_hook_failures_total"]["samples"][0]["labels"] != {"pattern": "^echo metrics", "phase": "post"}:
+    print(f"ERROR: metrics registry wrong: {commands}, {seconds}, {streams}")
+    sys.exit(1)
+
+text = watiba.metrics.prometheus()
+if 'watiba_command_seconds_bucket{host="localhost",le="+Inf"} 2' not in text \
+        or "# TYPE watiba_spawn_latency_seconds histogram" not in text:
+    print(f"ERROR: Prometheus text wrong:\n{text}")
+    sys.exit(1)
+watiba.metrics.reset()
+print("Command metrics passed.\n\n")
+
+##########################################################################################################
+print("Testing trace export")
+
+watiba.tracer.reset()
+w.set_parms({"trace": True})
+w.spawn_ctlr.set_parms({"max": 2})
+traced = [w.spawn("sleep 0.2", lambda promise, args: True, {}) for _ in range(3)]
+traced[2].join({"timeout": 10})
+w.bash("true")
+w.spawn_ctlr.set_parms({"max": 10})
+w.set_parms({"trace": False})
+
+events = watiba.tracer.events()
+spans = [e for e in events if e["ph"] == "X"]
+waits = {}
+for e in events:
+    if e.get("cat") == "queued":
+        waits[e["id"]] = e["ts"] - waits.get(e["id"], 0) if e["ph"] == "e" else e["ts"]
+if [e["cat"] for e in spans].count("spawn") != 3 or [e["cat"] for e in spans].count("resolver") != 3 \
+        or not any(e["cat"] == "bash" and e["name"] == "true" for e in spans):
+    print(f"ERROR: trace is missing spans: {[(e['cat'], e['name']) for e in spans]}")
+    sys.exit(1)
+
+# The third command had to wait in slowdown mode for one of the first two to resolve
+if max(waits.values()) < 100000:
+    print(f"ERROR: trace doesn't show the spawn controller holding a command back: {waits}")
+    sys.exit(1)
+
+# Promise trees that have resolved are kept as their events, not as promises
+watiba.tracer.reset()
+w.set_parms({"trace": True})
+many = [w.spawn("true", lambda promise, args: True, {}) for _ in range(300)]
+for p in many:
+    p.join({"timeout": 10})
+w.spawn("true", lambda promise, args: True, {}).join({"timeout": 10})
+w.set_parms({"trace": False})
+events = watiba.tracer.events()
+numbers = [e["args"]["promise"] for e in events if e.get("cat") == "spawn"]
+if len(watiba.tracer.promises) > 64 or len(numbers) != 301 or len(set(numbers)) != 301:
+    print(f"ERROR: {len(watiba.tracer.promises)} resolved promises kept, {len(set(numbers))} of 301 traced")
+    sys.exit(1)
+watiba.tracer.reset()
+print("Trace export passed.\n\n")
+
+##########################################################################################################
+print("Testing command cache")
+
+cache_dir = tempfile.mkdtemp()
+cache_file = os.path.join(cache_dir, "cache.json")
+w.set_parms({"cache-file": cache_file})
+
+# Commands not opted in always run
+first, second = w.bash("date +%N"), w.bash("date +%N")
+if first.stdout == second.stdout or first.cached:
+    print("ERROR: command that isn't opted in came from the cache")
+    sys.exit(1)
+
+w.add_cache("^date", ttl=1)
+first, second = w.bash("date +%N"), w.bash("date +%N")
+uncached = w.bash("date +%N", cache=False)
+if first.stdout != second.stdout or first.cached or not second.cached or uncached.stdout == first.stdout:
+    print(f"ERROR: cache hit wrong: {first.stdout}, {second.stdout}, {second.cached}, {uncached.stdout}")
+    sys.exit(1)
+
+# Time to live
+time.sleep(1.1)
+if w.bash("date +%N").cached:
+    print("ERROR: expired output came from the cache")
+    sys.exit(1)
+
+# Keyed on the host and the directory context too
+w.set_parms({"ssh-command": fake_ssh})
+if w.ssh("date +%N", "cachehost").cached or not w.ssh("date +%N", "cachehost").cached or w.ssh("date +%N", "otherhost").cached:
+    print("ERROR: remote output cached under the wrong key")
+    sys.exit(1)
+here = w.cwd()
+w.bash(f"cd {cache_dir}")
+if w.bash("date +%N").cached or w.cwd() != cache_dir:
+    print("ERROR: output cached under the wrong directory")
+    sys.exit(1)
+w.bash(f"cd {here}")
+
+# Invalidation, by host and by pattern
+if w.invalidate_cache(host="cachehost") != 1 or w.ssh("date +%N", "cachehost").cached \
+        or not w.ssh("date +%N", "otherhost").cached:
+    print("ERROR: invalidating by host wrong")
+    sys.exit(1)
+
+# ...and on the SSH port and the capture policy
+if w.ssh("date +%N", "otherhost", port=2222).cached or not w.ssh("date +%N", "otherhost", port=2222).cached:
+    print("ERROR: remote output cached without its port")
+    sys.exit(1)
+head = {"capture": "head", "capture-lines": 1}
+if w.bash("date +%N; date +%N", capture=head).cached or not w.bash("date +%N; date +%N", capture=head).cached \
+        or w.bash("date +%N; date +%N", capture={**head, "capture-lines": 2}).cached \
+        or w.bash("date +%N; date +%N", capture={**head, "capture": "tail"}).cached \
+        or len(w.bash("date +%N; date +%N").stdout) != 3:
+    print("ERROR: output cached without its capture policy")
+    sys.exit(1)
+
+# Lines appended to one caller's output aren't seen by the others, the first caller's included
+first = w.bash("date +%N -d @4")
+first.stdout.append("first")
+second = w.bash("date +%N -d @4")
+second.stderr.append("second")
+third = w.bash("date +%N -d @4")
+if not third.cached or list(third.stdout) != list(first.stdout)[:-1] or list(third.stderr) != [""] \
+        or list(second.stdout) != list(third.stdout):
+    print(f"ERROR: cached output shared between callers: {first.stdout}, {second.stderr}, {third.stdout}")
+    sys.exit(1)
+
+w.invalidate_cache("^date")
+if w.cache.stats()["entries"] != 0:
+    print(f"ERROR: invalidating by pattern left {w.cache.stats()}")
+    sys.exit(1)
+
+# Least recently used are dropped first
+w.set_parms({"cache-max": 2})
+w.bash("date +%N -d @1")
+w.bash("date +%N -d @2")
+w.bash("date +%N -d @1")
+w.bash("date +%N -d @3")
+if not w.bash("date +%N -d @1").cached or w.bash("date +%N -d @2").cached:
+    print("ERROR: cache size limit dropped the wrong output")
+    sys.exit(1)
+w.set_parms({"cache-max": 1000})
+
+# Identical commands at the same time run once
+w.add_cache("^sleep")
+w.invalidate_cache()
+before = w.cache.stats()
+results = []
+threads = [threading.Thread(target=lambda: results.append(w.bash("sleep 0.3; date +%N"))) for _ in range(4)]
+for t in threads:
+    t.start()
+for t in threads:
+    t.join()
+after = w.cache.stats()
+if len(set(str(o.stdout) for o in results)) != 1 or after["misses"] - before["misses"] != 1 \
+        or after["coalesced"] - before["coalesced"] != 3:
+    print(f"ERROR: concurrent commands weren't coalesced: {before}, {after}")
+    sys.exit(1)
+
+async def coalesced():
+    w.invalidate_cache()
+    return await asyncio.gather(*[w.abash("sleep 0.3; date +%N") for _ in range(3)])
+
+if len(set(str(o.stdout) for o in asyncio.run(coalesced()))) != 1:
+    print("ERROR: concurrent abash() commands weren't coalesced")
+    sys.exit(1)
+
+# Failed commands aren't kept
+w.add_cache("^false")
+if w.bash("false").cached or w.bash("false").cached:
+    print("ERROR: failed command's output was cached")
+    sys.exit(1)
+
+# Kept between runs
+w.bash("sleep 0; date +%N")
+w.cache.save(cache_file)
+restored = watiba.Watiba()
+restored.set_parms({"cache-file": cache_file})
+restored.add_cache("^sleep")
+o = restored.bash("sleep 0; date +%N")
+if not o.cached or o.stdout != w.bash("sleep 0; date +%N").stdout:
+    print("ERROR: cache file wasn't loaded")
+    sys.exit(1)
+
+w.remove_cache()
+w.invalidate_cache()
+w.set_parms({"cache-file": None, "ssh-command": "ssh"})
+restored.set_parms({"cache-file": None})
+for cached in (w, restored):
+    cached.cache.configure(cached.parms)
+shutil.rmtree(cache_dir)
+print("Command cache passed.\n\n")
@@ -0,0 +1,273 @@
+#!/usr/bin/env python3
+#####################################################################################################
+# Automated testing of the Watiba compiler and its tools (batch compiles, .wt imports, watiba-run,
+# source maps) that needs no input.  Everything is written to a temp directory.
+#
+# Author: Ray Walker
+# raythonic@mgail.com
+#####################################################################################################
+
+import os
+import sys
+import json
+import shutil
+import subprocess
+import hashlib
+import tempfile
+import importlib
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import watiba.wtbatch as wtbatch
+import watiba.wtimport as wtimport
+import watiba.wtcompiler as wtcompiler
+from watiba.wtcompiler import compile_source
+
+print("Running Smoke Test 3")
+work = tempfile.mkdtemp(prefix="watiba-smoke3-")
+golden = os.path.join(os.path.dirname(os.path.abspath(__file__)), "golden")
+
+
+# Write a file under the work directory, and return its path
+def write(name, text):
+    path = os.path.join(work, name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as f:
+        f.write(text)
+    return path
+
+
+##########################################################################################################
+print("Testing batch compiles")
+
+manifest = os.path.join(work, "manifest")
+sources = [write(f"tree/sub{n % 3}/m{n}.wt", f"#!/usr/bin/python3\nx = `echo {n}`\nprint(x.stdout[0])\n") for n in range(6)]
+results = wtbatch.compile_tree([os.path.join(work, "tree")], jobs=3, manifest=manifest)
+if sorted(results.compiled) != sorted(sources) or results.current or results.failed \
+        or not all(os.path.isfile(s[:-3] + ".py") for s in sources):
+    print(f"ERROR: pooled batch compile wrong: {results.compiled}, {results.failed}")
+    sys.exit(1)
+
+# Unchanged sources are skipped, changed ones and ones whose output was edited are compiled again
+write("tree/sub0/m0.wt", "#!/usr/bin/python3\nx = `echo changed`\n")
+with open(sources[1][:-3] + ".py", "a") as f:
+    f.write("# edited\n")
+results = wtbatch.compile_tree([os.path.join(work, "tree", "**", "*.wt")], jobs=1, manifest=manifest)
+if sorted(results.compiled) != sorted(sources[:2]) or len(results.current) != 4:
+    print(f"ERROR: manifest didn't skip unchanged files: {results.compiled}, {results.current}")
+    sys.exit(1)
+
+results = wtbatch.compile_tree([sources[2]], manifest=manifest, force=True)
+if results.compiled != [sources[2]]:
+    print(f"ERROR: forced compile skipped a file: {results.current}")
+    sys.exit(1)
+
+# Source maps change the output, so turning them on compiles everything again
+results = wtbatch.compile_tree([os.path.join(work, "tree")], jobs=2, manifest=manifest, map_lines=True)
+if len(results.compiled) != 6 or not os.path.isfile(sources[0][:-3] + ".py.map"):
+    print(f"ERROR: source map compile wrong: {results.compiled}")
+    sys.exit(1)
+
+# Files named explicitly must be .wt: a .py would be written over by its own output
+plain = write("plain.py", "print('keep me')\n")
+other = write("notes.txt", "x = 1\n")
+broken = write("broken.wt", "#!/usr/bin/python3\nspawn `echo unresolved`:\n    print('no return')\n")
+results = wtbatch.compile_tree([plain, other, broken], manifest=manifest)
+with open(plain) as f:
+    kept = f.read()
+if sorted(results.failed) != sorted([plain, other, broken]) or results.compiled or kept != "print('keep me')\n" \
+        or os.path.exists(os.path.join(work, "notes..py")):
+    print(f"ERROR: batch compiled a file it shouldn't have: {results.compiled}, {list(results.failed)}")
+    sys.exit(1)
+print("Batch compiles passed.\n\n")
+
+
+##########################################################################################################
+print("Testing compiler output")
+
+# golden/constructs.wt compiled, with and without the Watiba header.  Lines the baseline compiler handled compile
+# exactly as it compiled them.
+with open(os.path.join(golden, "constructs.wt")) as f:
+    source = f.read()
+for header, expected in [(True, "constructs.py"), (False, "constructs-noheader.py")]:
+    with open(os.path.join(golden, expected)) as f:
+        expected_lines = f.read().splitlines()
+    compiled_lines = compile_source(source, header=header).splitlines()
+    if compiled_lines != expected_lines:
+        for n, (got, want) in enumerate(zip(compiled_lines + [""] * len(expected_lines), expected_lines), 1):
+            if got != want:
+                print(f"ERROR: {expected} line {n} compiled to:\n    {got}\n  expected:\n    {want}")
+                break
+        else:
+            print(f"ERROR: {expected} has {len(compiled_lines)} lines, expected {len(expected_lines)}")
+        sys.exit(1)
+print("Compiler output passed.\n\n")
+
+
+##########################################################################################################
+print("Testing .wt imports")
+
+modules = os.path.join(work, "modules")
+os.makedirs(modules)
+sys.path.insert(0, modules)
+wtimport.install_import_hook()
+dont_write_bytecode, sys.dont_write_bytecode = sys.dont_write_bytecode, False
+
+
+# Import a .wt module again from scratch, and return it with the cache key its cached bytecode was written with
+def import_fresh(name):
+    sys.modules.pop(name, None)
+    module = importlib.import_module(name)
+    with open(os.path.join(modules, "__pycache__", f"{name}.{sys.implementation.cache_tag}.wt.pyc"), "rb") as f:
+        f.seek(len(wtimport.WTImportLoader.MAGIC) + len(importlib.util.MAGIC_NUMBER))
+        return module, f.read(64).decode()
+
+
+def cache_key(source):
+    return hashlib.sha256(source.encode() + b"\0" + wtcompiler.compiler_version().encode()).hexdigest()
+
+
+# A module written after the directory was listed is found
+try:
+    importlib.import_module("greeting")
+    print("ERROR: imported a .wt module that doesn't exist")
+    sys.exit(1)
+except ImportError:
+    pass
+source = "#!/usr/bin/python3\nmessage = `echo hello`.stdout[0]\n"
+write("modules/greeting.wt", source)
+importlib.invalidate_caches()
+module, key = import_fresh("greeting")
+if module.message != "hello" or key != cache_key(source):
+    print(f"ERROR: .wt import wrong: {module.message}, cached with key {key}")
+    sys.exit(1)
+
+# The cache is used while nothing changes, and rebuilt when the source changes...
+module, key = import_fresh("greeting")
+if module.message != "hello" or key != cache_key(source):
+    print(f"ERROR: cached .wt import wrong: {module.message}, cached with key {key}")
+    sys.exit(1)
+source = "#!/usr/bin/python3\nmessage = `echo changed`.stdout[0]\n"
+write("modules/greeting.wt", source)
+module, key = import_fresh("greeting")
+if module.message != "changed" or key != cache_key(source):
+    print(f"ERROR: cache not rebuilt for changed source: {module.message}, cached with key {key}")
+    sys.exit(1)
+
+# ...or the compiler changes
+real_version = wtcompiler.compiler_version()
+wtcompiler._compiler_version = "0.0.0-smoke-test"
+try:
+    module, key = import_fresh("greeting")
+    if module.message != "changed" or key != cache_key(source):
+        print(f"ERROR: cache not rebuilt for a new compiler version: cached with key {key}")
+        sys.exit(1)
+finally:
+    wtcompiler._compiler_version = real_version
+
+# A Python module of the same name is the one imported
+write("modules/greeting.py", "message = 'python'\n")
+importlib.invalidate_caches()
+sys.modules.pop("greeting", None)
+if importlib.import_module("greeting").message != "python":
+    print("ERROR: .wt module imported over a Python module of the same name")
+    sys.exit(1)
+
+wtimport.remove_import_hook()
+sys.path.remove(modules)
+sys.dont_write_bytecode = dont_write_bytecode
+print(".wt imports passed.\n\n")
+
+
+##########################################################################################################
+print("Testing watiba-run tracebacks")
+
+# The failing lines come after lines the compiler rewrites or joins, so the generated Python's line numbers differ
+# from the script's
+script = write("run/failing.wt", """#!/usr/bin/python3
+import os
+listing = `ls -l \\
+    /tmp`
+text = \"\"\"one `date`
+two\"\"\"
+p = spawn `true`:
+    return True
+p.join()
+
+def fail(n):
+    out = `echo {n}`
+    return len(out.stdout) / n
+
+fail(0)
+""")
+runner = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "watiba", "watiba-run.py")
+run = subprocess.run([sys.executable, runner, script], capture_output=True, text=True)
+expected = [f'  File "{script}", line 15, in <module>', "    fail(0)",
+            f'  File "{script}", line 13, in fail', "    return len(out.stdout) / n"]
+lines = run.stderr.split("\n")
+shown = [line for line in lines if line.startswith("  File ") or line.startswith("    ") and "^" not in line]
+if run.returncode != 1 or "ZeroDivisionError: division by zero" not in lines or shown != expected:
+    print(f"ERROR: watiba-run traceback doesn't show the script's lines (exit {run.returncode}):\n{run.stderr}")
+    sys.exit(1)
+print("watiba-run tracebacks passed.\n\n")
+
+
+##########################################################################################################
+print("Testing source maps and the profiler")
+
+script = write("profiled/prof.wt", """#!/usr/bin/python3
+import sys
+for n in range(2):
+    slept = `sleep 0.2`
+failed = `false`
+p = spawn `sleep 0.1`:
+    return True
+p.join()
+""")
+results = wtbatch.compile_tree([script], manifest=os.path.join(work, "profiled", "manifest"), map_lines=True)
+with open(script[:-3] + ".py.map") as f:
+    mapping = json.load(f)
+with open(script[:-3] + ".py") as f:
+    generated = f.read().splitlines()
+
+# Every generated line maps to its .wt line: the header to the first line, and the spawn's resolver to the lines of
+# its block, ahead of the spawn call itself
+if results.compiled != [script] or mapping != {"version": 1, "source": "prof.wt",
+                                               "lines": [1, 1, 1, 2, 3, 4, 5, 6, 7, 6, 8]} \
+        or len(generated) != len(mapping["lines"]) + 1 \
+        or generated[-1] != wtcompiler.SOURCE_MAP_COMMENT + "prof.py.map" \
+        or wtcompiler.load_source_map(script[:-3] + ".py") != (script, mapping["lines"]):
+    print(f"ERROR: source map wrong: {mapping}")
+    sys.exit(1)
+
+
+# The lines of a profile report, as (calls, failed, kind, line, failures) and the script text under each
+def profile_rows(report):
+    lines = report.splitlines()
+    rows = []
+    for n, line in enumerate(lines):
+        fields = line.split()
+        # Wall, calls, average, max, CPU, bytes and their unit, failed, kind, line, failures
+        if len(fields) >= 10 and fields[9].startswith("prof.wt:"):
+            rows.append((int(fields[1]), int(fields[7]), fields[8], fields[9], " ".join(fields[10:]),
+                         lines[n + 1].strip()))
+    return lines[0] if lines else "", rows
+
+
+# The same report whether the script is run by watiba-run or compiled with a source map and run by Python: times
+# charged to the .wt lines, hottest first, with their failures
+expected = [(2, 0, "bash", "prof.wt:4", "", "slept = `sleep 0.2`"),
+            (1, 0, "spawn", "prof.wt:6", "", "p = spawn `sleep 0.1`:"),
+            (1, 1, "bash", "prof.wt:5", "(exit 1 x1)", "failed = `false`")]
+environment = {**os.environ, "WATIBA_PROFILE": "1",
+               "PYTHONPATH": os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")}
+for command in ([sys.executable, runner, "prof.wt"], [sys.executable, "prof.py"]):
+    run = subprocess.run(command, capture_output=True, text=True, cwd=os.path.dirname(script), env=environment)
+    title, rows = profile_rows(run.stderr)
+    if run.returncode != 0 or not title.startswith("Watiba profile: 4 commands from 3 lines") or rows != expected:
+        print(f"ERROR: profile of {command[-1]} wrong:\n{run.stderr}")
+        sys.exit(1)
+print("Source maps and the profiler passed.\n\n")
+
+
+shutil.rmtree(work)
+print("Smoke Test 3 passed.")
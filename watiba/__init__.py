@@ -1,4 +1,17 @@
 from .watiba import *
 from watiba.wtpromise import *
 from watiba.wtspawncontroller import *
-from watiba.wtoutput import *
\ No newline at end of file
+from watiba.wtoutput import *
+from watiba.wtstream import *
+from watiba.wtcapture import *
+from watiba.wtsession import *
+from watiba.wtwatcher import *
+from watiba.wtcompiler import *
+from watiba.wtimport import *
+from watiba.wtrun import *
+from watiba.wtbatch import *
+from watiba.wtprofile import *
+from watiba.wtgraph import *
+from watiba.wtmetrics import *
+from watiba.wttrace import *
+from watiba.wtcache import *
\ No newline at end of file
@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+versions = ["__version__"]
+
+'''
+Watiba script runner.  Compiles a .wt script and runs it in this same Python process, with no intermediate .py
+file and no second interpreter.
+
+Examples:
+  watiba-run my_script.wt arg1 arg2
+
+The script sees its own arguments in sys.argv, its own path in __file__, and tracebacks show its line numbers.
+
+Author:
+Ray Walker
+raythonic@gmail.com
+
+'''
+import os
+import re
+import sys
+
+# Run from the source tree, this script's own directory would hide the watiba package behind watiba.py
+if os.path.isfile(os.path.join(sys.path[0], "wtrun.py")):
+    sys.path[0] = os.path.dirname(sys.path[0])
+
+from watiba.wtcompiler import WTCompilerException
+from watiba.wtrun import run_script
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("ERROR. No input file.")
+        sys.exit(0)
+
+    # the versions array is generated at build time (see this module in bin/)
+    if sys.argv[1] == "version" or sys.argv[1] == "--version":
+        for v in versions:
+            print(v)
+        sys.exit(0)
+
+    in_file = sys.argv[1]
+    if not re.match(r".*\.wt$", in_file):
+        print(f"ERROR: Input file must be type .wt.  Found {in_file}")
+        sys.exit(1)
+
+    try:
+        run_script(in_file, sys.argv[2:])
+    except WTCompilerException as ex:
+        print(ex.message, file=sys.stderr)
+        sys.exit(1)
@@ -8,21 +8,40 @@ Raythonic@gmail.com
 from subprocess import Popen, PIPE, STDOUT
 import re
 import os
+import sys
+import time
+import weakref
 import threading
 import copy
+import asyncio
 import inspect
+import contextvars
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from watiba.wtspawncontroller import WTSpawnController, WTSpawnException
 from watiba.wtpromise import WTPromise
 from watiba.wtoutput import WTOutput
+from watiba.wtstream import WTStream, kill_process_group
+from watiba.wtcapture import capture_lines, CONTEXT_MARKER
+from watiba.wtsession import WTSession
+from watiba.wtsshpool import WTSSHPool
+from watiba.wthooks import WTHookIndex
+from watiba.wtprofile import profiler, profiled
+from watiba.wtmetrics import metrics
+from watiba.wttrace import tracer, traced
+from watiba.wtcache import WTCache
+from watiba.wtgraph import WTGraph
 
 
 class WTChainException(Exception):
-    def __init__(self, message, host, command, output):
+    def __init__(self, message, host, command, output, failures=None):
         self.host = host
         self.message = message
         self.command = command
         self.output = output
 
+        # All failed hosts when a parallel chain collects its failures: {host: WTOutput, ...}
+        self.failures = failures if failures else ({host: output} if output else {})
+
 
 ###############################################################################################################
 ########################################## Watiba #############################################################
@@ -33,37 +52,174 @@ class Watiba(Exception):
 
     def __init__(self):
         self.spawn_ctlr = WTSpawnController()
-        self.parms = {"ssh-port":22}
+        self.parms = {"ssh-port": 22,
+                      "ssh-command": "ssh",  # SSH executable used for remote commands
+                      "ssh-pool": False,  # Reuse one multiplexed connection per host for remote commands
+                      "ssh-pool-max": 32,  # Most pooled connections open at once
+                      "ssh-pool-idle": 300,  # Seconds an unused pooled connection stays open
+                      "capture": "all",  # Output capture policy: "all", "head", "tail" or "spill"
+                      "capture-lines": 1000,  # Lines kept by the "head" and "tail" policies
+                      "capture-bytes": 1048576,  # Bytes held in memory by "spill" before moving output to a temp file
+                      "capture-dir": None,  # Where "spill" puts its temp files.  Default: system temp dir
+                      "session": False,  # Run commands through one long-lived shell instead of a new shell each
+                      "session-shell": "bash",  # Shell used for the session
+                      "chdir": True,  # Move Python's own CWD along with the main thread's directory context
+                      "async-post-hooks": False,  # Run post hooks in the background instead of before bash() returns
+                      "post-hook-workers": 4,  # Threads that run background post hooks
+                      "profile": os.environ.get("WATIBA_PROFILE", "") not in ("", "0"),  # Profile commands by line
+                      "profile-file": None,  # File the profile report is written to at exit.  Default: STDERR
+                      "profile-top": 20,  # Lines in the profile report
+                      "metrics": os.environ.get("WATIBA_METRICS", "") not in ("", "0"),  # Keep command metrics
+                      "metrics-file": None,  # File the metrics are written to at exit (.prom for Prometheus text)
+                      "trace": bool(os.environ.get("WATIBA_TRACE")),  # Trace spawned promises and command calls
+                      "trace-file": os.environ.get("WATIBA_TRACE") or None,  # File the trace is written to at exit
+                      "cache-ttl": 300,  # Seconds cached command output is kept, for patterns added without a TTL
+                      "cache-max": 1000,  # Most outputs cached.  The least recently used are dropped first.
+                      "cache-file": None  # File the command cache is loaded from and saved to at exit
+                      }
         self.hooks = {}
         self.hook_flags = {}
-        self.active_patterns = {}
+        self.hook_indexes = {}  # post (True/False) -> WTHookIndex, rebuilt after hooks are added or removed
+        self.post_hook_pool = None
+        self.cache = WTCache()  # Output of the commands opted in to memoization, see add_cache()
+
+        # Hook patterns running in this thread or task, for recursion guarding.  Kept per context like the directory
+        # context, so hooks running at the same time in other threads don't count.
+        self.context_patterns = contextvars.ContextVar(f"watiba_hooks_{id(self)}", default=frozenset())
+        self.shell_session = None
+        self.ssh_pool = None
+        self.async_limits = weakref.WeakKeyDictionary()  # Event loop -> (spawn-ctl "max", asyncio.Semaphore)
+
+        # Directory context.  Kept per thread (and per asyncio task) rather than in the process-wide CWD, so
+        # concurrent commands can each cd around without stepping on each other.  Spawned threads start with a
+        # copy of their spawner's context.  The main thread's context is Python's own CWD (see in_process_cwd()).
+        self.context_cwd = contextvars.ContextVar(f"watiba_cwd_{id(self)}", default=None)
+
+    # Hook patterns running in the calling thread's (or task's) context
+    @property
+    def active_patterns(self):
+        return self.context_patterns.get()
 
     # Merge in Watiba parameter changes
     def set_parms(self, args):
         self.parms = {**self.parms, **args}
 
+    # The directory context for the calling thread
+    def cwd(self):
+        if self.in_process_cwd():
+            return os.getcwd()
+        cwd = self.context_cwd.get()
+        return cwd if cwd else os.getcwd()
+
+    # Move the calling thread's directory context
+    def set_cwd(self, cwd):
+        if self.in_process_cwd():
+            os.chdir(cwd)
+        else:
+            self.context_cwd.set(cwd)
+
+    # Is the calling thread's directory context Python's CWD?  With "chdir" on, the main thread's is, so the script's
+    # own os.chdir() calls move it too.  The CWD is process-wide, so threads, and asyncio tasks (even on the main
+    # thread), keep their own.
+    def in_process_cwd(self):
+        if not self.parms["chdir"] or threading.current_thread() is not threading.main_thread():
+            return False
+        try:
+            return asyncio.current_task() is None
+        except RuntimeError:
+            # No event loop running
+            return True
+
+    # The shell session used when "session" is on.  Started on first use.
+    def session(self):
+        if not self.shell_session:
+            self.shell_session = WTSession(self.parms["session-shell"])
+        return self.shell_session
+
+    # Stop the shell session if one is running
+    def close_session(self):
+        if self.shell_session:
+            self.shell_session.close()
+            self.shell_session = None
+
     # Called by spawned thread
-    # Dir context is not kept by the spawn expression
+    # Dir context is kept by the spawned thread's own context, it does not change the spawner's
+    # Spawned commands don't use the shell session, it would run them one at a time
     # Returns WTOutput object
     def execute(self, command, host="localhost"):
-        context = False
+        context = True
         if host == "localhost":
-            return self.bash(command, context, run_post_hooks=False)
+            return self.bash(command, context, run_post_hooks=False, session=False)
         else:
             # A simple wrapper for self.bash()
             return self.ssh(command, host)
 
+    # The SSH connection pool remote commands go through, or None if "ssh-pool" is off
+    def connection_pool(self):
+        if not self.parms["ssh-pool"]:
+            return None
+
+        if not self.ssh_pool:
+            self.ssh_pool = WTSSHPool()
+
+        # Pick up any watiba-ctl changes
+        self.ssh_pool.max_connections = self.parms["ssh-pool-max"]
+        self.ssh_pool.idle = self.parms["ssh-pool-idle"]
+        self.ssh_pool.ssh = self.parms["ssh-command"]
+
+        return self.ssh_pool
+
     # Run command remotely
     # Returns WTOutput object
-    def ssh(self, command, host, context=True, port=None):
-        return self.bash(f'ssh -p {port if port else self.parms["ssh-port"]} {host} "{command}"', context)
+    @profiled("ssh")
+    @traced("ssh")
+    def ssh(self, command, host, context=True, port=None, capture=None, input=None, cache=True):
+        port = port if port else self.parms["ssh-port"]
+
+        def run():
+            pool = self.connection_pool()
+            try:
+                return self.bash(self.ssh_command(command, host, port, pool), context, capture=capture, input=input,
+                                 host=host, cache=False)
+            finally:
+                # The pooled connection is free to be evicted again
+                if pool:
+                    pool.release(host, port)
+
+        if cache and input is None and self.cache.patterns:
+            return self.memoized(command, host, context, run, port, capture)
+        return run()
+
+    # The local shell command that runs command on host
+    # pool - connection pool to route it through.  The caller releases the connection once the command is done.
+    def ssh_command(self, command, host, port=None, pool=None):
+        port = port if port else self.parms["ssh-port"]
+        options = f' {pool.options(host, port)}' if pool else ""
+        return f'{self.parms["ssh-command"]} -p {port}{options} {host} "{command}"'
 
     # command - command string to execute
     # context - track or not track current dir
     # run_post_hooks - allows spawned threads to avoid running post-hooks
+    # capture - dict of capture settings for this command only (same keys as watiba-ctl, e.g. {"capture": "tail"})
+    # session - True/False to run or not run this command in the shell session.  Default: watiba-ctl "session"
+    # input - bytes fed to the command's STDIN.  (Commands given input don't run in the shell session.)
+    # host - where the command runs, for the metrics (ssh() passes the remote host)
+    # cache - False to run the command even if it's opted in to the command cache (see add_cache())
     # Returns:
     #   WTOutput object that encapsulates stdout, stderr, exit code, etc.
-    def bash(self, command, context=True, run_post_hooks=True):
+    @profiled("bash")
+    @traced("bash")
+    def bash(self, command, context=True, run_post_hooks=True, capture=None, session=None, input=None,
+             host="localhost", cache=True):
+        if cache and input is None and self.cache.patterns:
+            return self.memoized(command, host, context,
+                                 lambda: self.run_bash(command, context, run_post_hooks, capture, session, host=host),
+                                 capture=capture)
+        return self.run_bash(command, context, run_post_hooks, capture, session, input, host)
+
+    # Runs the command for bash()
+    def run_bash(self, command, context=True, run_post_hooks=True, capture=None, session=None, input=None,
+                 host="localhost"):
 
         # In order to be thread-safe in the generated code, ALWAYS create a new output object for each command
         #  This is because in the generated code, the object reference, "_watiba_", is global and needs to be in scope
@@ -76,7 +232,9 @@ class Watiba(Exception):
         #                                           PRE-HOOKS
         ##############################################################################################################
         # Run any command hooks defined for this command
+        hook_start = time.perf_counter()
         results = self.run_hooks(command, post_hook=False)
+        out.hook_time = time.perf_counter() - hook_start
 
         # Handle any hook failures
         # All hooks are always run, but any one reporting a failure will cause the command to not be run
@@ -88,35 +246,56 @@ class Watiba(Exception):
         ##############################################################################################################
         #                                           COMMAND
         ##############################################################################################################
-        # Tack on this command to see what the current dir is after the user's command is executed
-        ctx = ' && echo "__watiba_cwd__($(pwd))_"' if context else ''
-        p = Popen(f"{command}{ctx}",
-                  shell=True,
-                  stdout=PIPE,
-                  stderr=PIPE,
-                  close_fds=True)
-        out.exit_code = p.wait()
-        out.stdout = p.stdout.read().decode('utf-8').split('\n')
-        out.stderr = p.stderr.read().decode('utf-8').split('\n')
-
-        # Are we supposed to track context?  Yes, then set Python's CWD to where the command took us
-        if context:
-            # if asked to keep CWD context, find our echo string and remove so the
-            # user doesn't see it
-            for n, o in enumerate(out.stdout):
-                m = re.match(r'^__watiba_cwd__\((\S.*)\)_$', o)
-                if m:
-                    os.chdir(m.group(1))
-                    del out.stdout[n]
-        out.cwd = os.getcwd()
+        # How much of the output are we keeping?
+        capture_parms = {**self.parms, **capture} if capture else self.parms
+
+        # Output is kept as raw bytes in the capture policy's holder, lines are decoded when accessed
+        out.stdout = capture_lines(capture_parms)
+        out.stderr = capture_lines(capture_parms)
+
+        run_start = time.perf_counter()
+        if input is None and (session if session is not None else capture_parms["session"]):
+            # The session shell reports the CWD itself, no need for the echo suffix
+            out.exit_code, cwd = self.session().run(command, out.stdout, out.stderr, context, self.cwd())
+            out.stdout.close()
+            out.stderr.close()
+
+            # The session doesn't count output as it goes, so this is what the capture policy kept of it
+            out.stdout_bytes = len(out.stdout.raw)
+            out.stderr_bytes = len(out.stderr.raw)
+            out.output_bytes = out.stdout_bytes + out.stderr_bytes
+        else:
+            # Tack on this command to see what the current dir is after the user's command is executed
+            ctx = CONTEXT_MARKER if context else ''
+            p = Popen(f"{command}{ctx}",
+                      shell=True,
+                      stdin=PIPE if input is not None else None,
+                      stdout=PIPE,
+                      stderr=PIPE,
+                      close_fds=True,
+                      cwd=self.cwd())
+            cwd = self.capture(p, out, context, input)
+            out.exit_code = p.returncode
+        out.run_time = time.perf_counter() - run_start
+
+        # Are we supposed to track context?  Yes, then move our context to where the command took us
+        if context and cwd:
+            self.set_cwd(cwd)
+        out.cwd = self.cwd()
 
 
         ##############################################################################################################
         #                                           POST-HOOKS
         ##############################################################################################################
         # Run any command post-hooks defined for this command
-        if run_post_hooks:
+        # (or start them in the background, see background_post_hooks())
+        if run_post_hooks and not self.background_post_hooks(command, out):
+            hook_start = time.perf_counter()
             results = self.run_hooks(command, post_hook=True)
+            out.hook_time += time.perf_counter() - hook_start
+
+        if self.parms["metrics"]:
+            metrics.record_output(out, host, self.parms)
 
         # Handle any post-hook failures
         # All hooks are always run, but any one reporting a failure will cause the command to not be run
@@ -127,41 +306,169 @@ class Watiba(Exception):
 
         return out
 
-    def spawn(self, command, resolver, spawn_args, host="localhost"):
-        # Get parent's local var frame
-        parent_locals = inspect.currentframe().f_back.f_locals
+    # Read the command's stdout and stderr into the output object's capture holders.
+    # Both streams are read while the command runs.  Waiting first would hang any command that fills a pipe.
+    # input - bytes to feed the command's STDIN, written by a thread of its own so a full pipe can't hang us
+    # Returns the directory found in the context marker, or None
+    def capture(self, p, out, context, input=None):
+        def writer():
+            try:
+                p.stdin.write(input)
+                p.stdin.close()
+            except BrokenPipeError:
+                # The command quit reading.  Its exit code tells the story.
+                pass
 
+        if input is not None:
+            threading.Thread(target=writer, daemon=True).start()
+
+        def reader(pipe, lines, track_context):
+            fd = pipe.fileno()
+            size = 0
+            for chunk in iter(lambda: os.read(fd, 65536), b''):
+                lines.write(chunk)
+                size += len(chunk)
+            pipe.close()
+            cwd = self.capture_done(lines, track_context)
+
+            # The context marker isn't the command's output
+            if cwd is not None:
+                size -= self.marker_size(cwd)
+            if lines is out.stdout:
+                out.stdout_bytes = size
+            else:
+                out.stderr_bytes = size
+            return cwd
+
+        # STDERR gets its own thread, STDOUT is read by this one
+        t = threading.Thread(target=reader, args=(p.stderr, out.stderr, False))
+        t.start()
+        cwd = reader(p.stdout, out.stdout, context)
+        t.join()
+        out.rusage = self.reap(p)
+        out.output_bytes = out.stdout_bytes + out.stderr_bytes
+
+        return cwd
+
+    # Wait for a command's process to exit, setting its return code as Popen.wait() would
+    # Returns the resource usage of the process (CPU time and the like), or None if it can't be had
+    @staticmethod
+    def reap(p):
+        try:
+            _, status, rusage = os.wait4(p.pid, 0)
+        except (ChildProcessError, AttributeError):
+            # Already reaped elsewhere, or no wait4() on this platform
+            p.wait()
+            return None
+
+        p.returncode = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+        return rusage
+
+    # All of a stream's output has been captured
+    # Returns the directory found in the context marker, or None
+    @staticmethod
+    def capture_done(lines, track_context):
+        cwd = None
+
+        # if asked to keep CWD context, find our marker (always the last line) and don't keep it
+        if track_context:
+            last = lines.last_line()
+            m = re.match(rb'^__watiba_cwd__\((\S.*)\)_$', last) if last else None
+            if m:
+                cwd = m.group(1).decode('utf-8', errors='surrogateescape')
+                lines.drop_last_line()
+        lines.close()
+
+        return cwd
+
+    # Bytes the context marker added to STDOUT, the newline written before it included
+    @staticmethod
+    def marker_size(cwd):
+        return len(f"\n__watiba_cwd__({cwd})_\n".encode('utf-8', errors='surrogateescape'))
+
+    # Streaming version of bash().  Nothing is buffered: lines are handed back as the command writes them.
+    # command - command string to execute
+    # context - track or not track current dir
+    # Returns:
+    #   WTStream object.  Iterate over it for ("stdout" | "stderr", line) tuples.  Its exit_code and cwd
+    #   are set when the iteration completes.
+    def bash_stream(self, command, context=True):
+        results = self.run_hooks(command, post_hook=False)
+        if results['success'] != True:
+            raise Exception(f"One or more hooks failed. Hooks reporting a problem: {', '.join(results['failed-hooks'])}")
+
+        # Called by the stream once the command has finished and its output is exhausted
+        def complete(stream):
+            # Are we supposed to track context?  Yes, then move our context to where the command took us
+            if context and stream.cwd:
+                self.set_cwd(stream.cwd)
+            stream.cwd = self.cwd()
+
+            results = self.run_hooks(command, post_hook=True)
+            if results['success'] != True:
+                raise Exception(f"One or more post-hooks failed. Hooks reporting a problem: {', '.join(results['failed-hooks'])}")
+
+        return WTStream(command, context, on_complete=complete, cwd=self.cwd()).start()
+
+    # Run a command in a thread of its own, then call its resolver
+    # after - promise, or list of promises, that must all resolve before the command starts (spawn `cmd` after [p]:)
+    # Returns the command's promise
+    def spawn(self, command, resolver, spawn_args, host="localhost", after=None):
         # Create a new promise object
         l_promise = WTPromise(command, host) if host else WTPromise(command)
 
-        # Chain our promise in if we're a child
-        if 'promise' in parent_locals \
-                and str(type(parent_locals['promise'])).find("WTPromise") >= 0 \
-                and hasattr(parent_locals['promise'], "__WTPROMISE_STAMP__") \
-                and hasattr(parent_locals['promise'], "resolved") \
-                and inspect.ismethod(getattr(parent_locals['promise'], "resolved")):
-            # Link this child promise to its parent
-            l_promise.relate(parent_locals['promise'])
-        
+        # Chain our promise in if we're a child (Get parent's local var frame)
+        self.relate_to_caller(l_promise, inspect.currentframe().f_back.f_locals)
+        if self.parms["trace"]:
+            tracer.add_promise(l_promise, self.parms)
 
         # This is run under the new thread, and under the control of wtspawncontroller.py (i.e. spawn controller calls this function)
         def run_command(promise, thread_args):
             # Get our thread id
             promise.thread_id = threading.get_ident()
 
+            # Start from the spawner's directory context as it was at spawn time
+            self.context_cwd.set(thread_args["cwd"])
+
             # Execute the command in a new thread (this is synchronously run)
-            promise.output = self.execute(thread_args["command"], thread_args["host"])
+            promise.set_running()
+            failed = True
+            try:
+                if thread_args["profile-site"]:
+                    # Charged to the spawn statement, when the command has run
+                    promise.output = profiler.measure(
+                        thread_args["profile-site"], "spawn", thread_args["command"],
+                        lambda: self.execute(thread_args["command"], thread_args["host"]), self.parms)
+                else:
+                    promise.output = self.execute(thread_args["command"], thread_args["host"])
+                self.spawn_done(promise)
+                failed = promise.output.exit_code != 0
+            except BaseException as ex:
+                promise.set_failed(ex)
+                raise
+            finally:
+                promise.set_completed(failed)
 
             # Call promise resolver
-            promise.set_resolution(thread_args["resolver"](promise, copy.copy(thread_args["spawn-args"])))
+            try:
+                resolution = thread_args["resolver"](promise, copy.copy(thread_args["spawn-args"]))
+            except BaseException as ex:
+                promise.set_failed(ex)
+                raise
+            promise.set_resolution(resolution)
 
 
         # Call wtspawncontroller.py to run the command under a new thread
         try:
-            thread_args = {"command": command, "resolver": resolver, "spawn-args": spawn_args, "host": host}
+            thread_args = {"command": command, "resolver": resolver, "spawn-args": spawn_args, "host": host,
+                           "cwd": self.cwd(),
+                           "profile-site": profiler.site(sys._getframe(1)) if self.parms["profile"] else None}
 
             # Control the threads (the controller starts the thread)
-            self.spawn_ctlr.start(l_promise, run_command, thread_args)
+            if after is not None:
+                self.spawn_after(l_promise, run_command, thread_args, after)
+            else:
+                self.spawn_ctlr.start(l_promise, run_command, thread_args)
 
         except WTSpawnException as ex:
             print(f"ERROR.  w_async thread execution failed. {ex.promise.command}")
@@ -169,6 +476,61 @@ class Watiba(Exception):
         return l_promise
     
 
+    # Start a spawned command once every promise it depends on has resolved.  It's started by the thread that
+    # resolves the last of them, but as though from the spawner (in its context).  If any of them fails, this
+    # promise fails too, without running its command.
+    def spawn_after(self, l_promise, run_command, thread_args, after):
+        l_promise.dependencies = [after] if isinstance(after, WTPromise) else list(after)
+        waiting = {"count": len(l_promise.dependencies)}
+        lock = threading.Lock()
+        context = contextvars.copy_context()
+
+        def start():
+            try:
+                self.spawn_ctlr.start(l_promise, run_command, thread_args)
+            except WTSpawnException as ex:
+                print(f"ERROR.  w_async thread execution failed. {ex.promise.command}")
+                l_promise.set_failed(ex)
+
+        def resolved(dependency):
+            with lock:
+                waiting["count"] -= 1
+                if waiting["count"] != 0:
+                    return
+            context.run(start)
+
+        def failed(dependency):
+            l_promise.set_failed(f"Dependency did not resolve: {dependency.command}")
+
+        if not l_promise.dependencies:
+            return self.spawn_ctlr.start(l_promise, run_command, thread_args)
+
+        for dependency in l_promise.dependencies:
+            dependency.on_resolved(resolved, failed)
+
+    # A spawned command has run.  Its output gets how long it waited to start: from the spawn, or from when the
+    # last promise it was after resolved.
+    def spawn_done(self, promise):
+        ready = max([promise.start_time] + [d.end_time for d in promise.dependencies if d.end_time])
+        promise.output.spawn_latency = max(0.0, promise.run_start - ready)
+        if self.parms["metrics"]:
+            metrics.record_spawn(promise.host, promise.output.spawn_latency, self.parms)
+
+    # A builder for a graph of commands, each started once the commands it depends on have resolved
+    def graph(self):
+        return WTGraph(self)
+
+    # Link a new promise to the promise of the resolver block it was spawned from, if any
+    @staticmethod
+    def relate_to_caller(l_promise, parent_locals):
+        if 'promise' in parent_locals \
+                and str(type(parent_locals['promise'])).find("WTPromise") >= 0 \
+                and hasattr(parent_locals['promise'], "__WTPROMISE_STAMP__") \
+                and hasattr(parent_locals['promise'], "resolved") \
+                and inspect.ismethod(getattr(parent_locals['promise'], "resolved")):
+            # Link this child promise to its parent
+            l_promise.relate(parent_locals['promise'])
+
     # Determine if the command pattern can be run at this time
     # Return the condition of the regex match() function
     def is_hook_runnable(self, command_regex, command, post_hook):
@@ -177,14 +539,11 @@ class Watiba(Exception):
         # Note: Doesn't matter if the command matches the pattern or not.
         if self.hook_flags[command_regex]["recursive"] == False and command_regex in self.active_patterns:
             return None
-        
-        # See if we're to run this hook before or after the command
-        # Note: Doesn't matter if the command matches the pattern or not.
-        if self.hook_flags[command_regex]["post"] != post_hook:
-            return None
+
+        # Pre and post hooks are indexed separately, so post_hook is already taken care of
 
         # Tell the caller if the command passed to us matches the regex expression
-        return re.match(command_regex, command)
+        return self.hook_flags[command_regex]["regex"].match(command)
 
 
     # Run all the command hooks
@@ -201,7 +560,58 @@ class Watiba(Exception):
         return_obj = {"success": True, "failed-hooks": []}
 
         # Loop through the hooks and run them.  Also track ones that fail (i.e. report a False return code)
-        for command_regex, functions in self.hooks.items():
+        for command_regex, func, mat, parms in self.hook_matches(command, post_hook):
+
+            # Track this pattern as an active hook (until the hook returns, even if it raises)
+            token = self.context_patterns.set(self.active_patterns | {command_regex})
+            start = time.perf_counter()
+            try:
+                # Call the hook.  The hook must return True if succeeded, False if failed
+                # A coroutine hook is run to completion on an event loop of its own
+                rc = func(mat, parms)
+                if inspect.isawaitable(rc):
+                    rc = self.run_awaitable(rc)
+            finally:
+                # Remove tracking of this pattern
+                self.context_patterns.reset(token)
+
+            self.hook_result(return_obj, func, rc)
+            self.hook_done(command, command_regex, func, post_hook, time.perf_counter() - start, rc)
+
+        return return_obj
+
+    # With watiba-ctl "async-post-hooks" on, start the command's post hooks in the background.  out.post_hooks is
+    # set to the future of their results.  A failure is added to the output's STDERR and raised by
+    # out.wait_post_hooks().
+    # Returns False if the post hooks should be run the usual way instead
+    def background_post_hooks(self, command, out):
+        if not self.parms["async-post-hooks"]:
+            return False
+
+        # Nothing to wait for if no post hook applies to this command
+        if not any(regex.match(command) for _, regex in self.hook_index(True).candidates(command)):
+            return False
+
+        def run_post_hooks():
+            results = self.run_hooks(command, post_hook=True)
+            if results['success'] != True:
+                msg = f"One or more post-hooks failed. Hooks reporting a problem: {', '.join(results['failed-hooks'])}"
+                out.stderr.append(msg)
+                raise Exception(msg)
+            return results
+
+        if not self.post_hook_pool:
+            self.post_hook_pool = ThreadPoolExecutor(max_workers=int(self.parms["post-hook-workers"]),
+                                                     thread_name_prefix="watiba-post-hooks")
+
+        # The hooks run in a copy of our context, so in our directory context and with our active hooks
+        out.post_hooks = self.post_hook_pool.submit(contextvars.copy_context().run, run_post_hooks)
+        return True
+
+    # The hooks to run for this command, as (pattern, hook function, match, hook parms)
+    def hook_matches(self, command, post_hook):
+        # Only the patterns that could match are tried
+        for command_regex, _ in self.hook_index(post_hook).candidates(command):
 
             # Are we allowed to run this hook for this command?
             mat = self.is_hook_runnable(command_regex, command, post_hook)
@@ -210,47 +620,102 @@ class Watiba(Exception):
             if mat:
                 # Yes, command has hooks.  Run them.
                 # If the hook fails track it, but keep going with the other hooks
-                for func, parms in functions.items():
+                for func, parms in list(self.hooks.get(command_regex, {}).items()):
+                    yield command_regex, func, mat, parms
 
-                    # Track this pattern as an active hook
-                    self.active_patterns[command_regex] = True
+    # The index of pre hooks (post_hook False) or post hooks (True).  Built on first use after hooks change.
+    def hook_index(self, post_hook):
+        index = self.hook_indexes.get(post_hook)
+        if index is None:
+            index = WTHookIndex([(pattern, flags["regex"]) for pattern, flags in self.hook_flags.items()
+                                 if flags["post"] == post_hook])
+            self.hook_indexes[post_hook] = index
+        return index
 
-                    # Call the hook.  The hook must return True if succeeded, False if failed
-                    rc = func(mat, parms)
+    # A hook function has returned.  Record it in the metrics and the trace, if they're on.
+    def hook_done(self, command, command_regex, func, post_hook, seconds, rc):
+        if self.parms["metrics"]:
+            metrics.record_hook(command_regex, post_hook, seconds, rc is True, self.parms)
+        if self.parms["trace"]:
+            tracer.span("hook", command_regex, seconds, {"function": func.__name__, "command": command,
+                                                         "phase": "post" if post_hook else "pre", "result": rc},
+                        self.parms)
 
-                    # Remove tracking of this pattern
-                    del self.active_patterns[command_regex]
+    # asyncio.run() wants a coroutine, not just any awaitable
+    @staticmethod
+    async def hook_awaitable(awaitable):
+        return await awaitable
 
-                    # If caller's hook didn't return a bool value, then it is marked as failed
-                    rc = False if type(rc) != bool else rc
+    # Run a coroutine hook to completion for synchronous code.  If this thread is running an event loop, that loop is
+    # stuck waiting on us, so the hook gets a loop of its own on another thread (in our context).
+    def run_awaitable(self, awaitable):
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            return asyncio.run(self.hook_awaitable(awaitable))
 
-                    # Track failed hooks
-                    if rc == False:
-                        return_obj["failed-hooks"].append(func.__name__)
-                
-                    return_obj["success"] &= rc
-        
-        return return_obj
+        with ThreadPoolExecutor(max_workers=1, thread_name_prefix="watiba-hook") as runner:
+            return runner.submit(contextvars.copy_context().run, asyncio.run,
+                                 self.hook_awaitable(awaitable)).result()
+
+    # Add a hook's return code to run_hooks()' results
+    @staticmethod
+    def hook_result(return_obj, func, rc):
+        # If caller's hook didn't return a bool value, then it is marked as failed
+        rc = False if type(rc) != bool else rc
+
+        # Track failed hooks
+        if rc == False:
+            return_obj["failed-hooks"].append(func.__name__)
+
+        return_obj["success"] &= rc
 
     # Pipe either stdout or stderr to some target host with some target command
-    def pipe(self, pipe_source, pipe_target):
+    # The output is streamed, byte for byte, into the STDIN of one remote command per target.  If chunk_lines is
+    # set, the output is sent in chunks of that many lines instead, one remote command per chunk.
+    def pipe(self, pipe_source, pipe_target, chunk_lines=0):
+        data = pipe_source.raw if hasattr(pipe_source, "raw") else "\n".join(pipe_source).encode('utf-8')
+
         # Pipe output to target host command
         for pipe_to, command in pipe_target.items():
-            for line in pipe_source:
+            for chunk in self.pipe_chunks(data, chunk_lines):
                 # The output for piped command is not kept, but is checked for the exit code
-                out = self.ssh(f'echo "{line}" | {command}', pipe_to)
+                out = self.ssh(command, pipe_to, context=False, input=chunk)
                 if out.exit_code != 0:
                     raise WTChainException(f'Piped command failed on {pipe_to}.  Error code: {out.exit_code}', pipe_to,
                                            command, out)
 
+    # Split piped output into chunks of whole lines (or just one chunk if chunk_lines isn't set)
+    @staticmethod
+    def pipe_chunks(data, chunk_lines):
+        if not chunk_lines:
+            yield data
+            return
+
+        start = 0
+        while start < len(data):
+            end = start
+            for _ in range(chunk_lines):
+                end = data.find(b'\n', end) + 1
+                if end == 0:
+                    end = len(data)
+                    break
+            yield data[start:end]
+            start = end
+
     # chain commands across various servers.  (Run sequentially and with regard to exit code.  A bad exit code causes
     # an exception to be thrown.
     #  A dictionary structure must be passed by the user's program as follows:
     #       {"hosts": ["host1", "host2", ...],  # These are the hosts to run the command on and is required
     #        "stdout": {"source-host": {"target-host1":command, "target-host2":command, ...}}, # Pipe stdout from source to target(s) (optional)
-    #        "stderr": {"source-host": {"target-host1":command, "target-host2":command, ...}}   # Pipe stderr from source to target(s) (optional)
+    #        "stderr": {"source-host": {"target-host1":command, "target-host2":command, ...}},  # Pipe stderr from source to target(s) (optional)
+    #        "parallel": N,  # Run on up to N hosts at once (optional, default 1)
+    #        "fail-fast": True,  # Parallel only.  Stop at the first failure, or False to run every host and
+    #                            #  raise one exception holding all the failures (optional, default True)
+    #        "pipe-chunk-lines": N  # Pipe output in chunks of N lines, one remote command each (optional)
     #       }
     # Returns dictionary of WTOutput objects by host name: {host:WTOutput, ...}
+    @profiled("chain")
     def chain(self, command, parms):
         output = {}
         if "hosts" not in parms:
@@ -259,6 +724,11 @@ class Watiba(Exception):
         pipe_stdout = parms["stdout"] if "stdout" in parms else {}
         pipe_stderr = parms["stderr"] if "stderr" in parms else {}
 
+        pipe_chunk = int(parms.get("pipe-chunk-lines", 0))
+
+        if int(parms.get("parallel", 1)) > 1:
+            return self.parallel_chain(command, parms, pipe_stdout, pipe_stderr, pipe_chunk)
+
         # Loop through each host and run the command on it
         for host in parms["hosts"]:
             # Run command remotely through SSH
@@ -269,16 +739,58 @@ class Watiba(Exception):
                 raise WTChainException(f'Command failed on {host}. Error code: {output[host].exit_code}', host, command,
                                        output[host])
 
-            # If we are supposed to pipe the stdout for this host, do it
-            if host in pipe_stdout:
-                self.pipe(output[host].stdout, pipe_stdout)
-
-            # If we are supposed to pipe the stderr for this host, do it
-            if host in pipe_stderr:
-                self.pipe(output[host].stderr, pipe_stderr)
+            self.chain_pipes(host, output[host], pipe_stdout, pipe_stderr, pipe_chunk)
 
         return output
 
+    # Pipe a chained host's output if it's a source in the chain's "stdout" or "stderr" arguments
+    def chain_pipes(self, host, output, pipe_stdout, pipe_stderr, pipe_chunk=0):
+        # If we are supposed to pipe the stdout for this host, do it
+        if host in pipe_stdout:
+            self.pipe(output.stdout, pipe_stdout[host], pipe_chunk)
+
+        # If we are supposed to pipe the stderr for this host, do it
+        if host in pipe_stderr:
+            self.pipe(output.stderr, pipe_stderr[host], pipe_chunk)
+
+    # chain() across up to parms["parallel"] hosts at once
+    # Output is piped for each host as its result arrives
+    def parallel_chain(self, command, parms, pipe_stdout, pipe_stderr, pipe_chunk=0):
+        output = {}
+        failures = {}
+        fail_fast = parms.get("fail-fast", True)
+
+        with ThreadPoolExecutor(max_workers=int(parms["parallel"])) as executor:
+            # Each host runs in a copy of our context so it starts in our directory context
+            futures = {executor.submit(contextvars.copy_context().run, self.ssh, command, host): host
+                       for host in parms["hosts"]}
+
+            for future in as_completed(futures):
+                host = futures[future]
+                output[host] = future.result()
+
+                if output[host].exit_code != 0:
+                    if fail_fast:
+                        # Hosts not started yet are dropped.  Leaving the with block waits for those running.
+                        for f in futures:
+                            f.cancel()
+                        raise WTChainException(f'Command failed on {host}. Error code: {output[host].exit_code}',
+                                               host, command, output[host])
+                    failures[host] = output[host]
+                    continue
+
+                self.chain_pipes(host, output[host], pipe_stdout, pipe_stderr, pipe_chunk)
+
+        if failures:
+            # Report the failures in the chain's host order
+            failures = {h: failures[h] for h in parms["hosts"] if h in failures}
+            host = next(iter(failures))
+            raise WTChainException(f'Command failed on {len(failures)} hosts: {", ".join(failures)}', host, command,
+                                   failures[host], failures)
+
+        # Return the outputs in the chain's host order
+        return {host: output[host] for host in parms["hosts"]}
+
 
     # Add a new hook.  If command pattern already exists, add the functions to it otherwise create a new pattern level.
     #  Set recursive to True to keep hook from looping because it has a matching command within it
@@ -300,8 +812,11 @@ class Watiba(Exception):
             return
         
         # At this point we know the pattern has not been defined yet, so define it
+        # The pattern is compiled once here, not for every command
+        regex = re.compile(pattern)
         self.hooks.update({pattern : {function: parms}})
-        self.hook_flags[pattern] = {"recursive": recursive, "post": post}
+        self.hook_flags[pattern] = {"recursive": recursive, "post": post, "regex": regex}
+        self.hook_indexes = {}
 
     
     # Remove a specific hook, keyed by pattern, or all hooks if no pattern is passed
@@ -311,11 +826,359 @@ class Watiba(Exception):
         if not pattern:
             self.hooks = {}
             self.hook_flags = {}
+            self.hook_indexes = {}
             return
 
         # Remove the hook for only the pattern passed
         if pattern in self.hooks:
             del self.hooks[pattern]
             del self.hook_flags[pattern]
+            self.hook_indexes = {}
             return
-        
\ No newline at end of file
+        
+
+
+    # Opt commands in to the command cache.  Their output is memoized, keyed on the command, the host (and SSH port),
+    # the capture policy and (for local commands) the directory context they run in, so later calls get it back
+    # without running the command again.
+    # Only the output of commands that exit 0 is kept, and hooks only run when the command does.
+    # pattern - regex matched against the start of the command, like a hook pattern
+    # ttl - seconds the output is kept.  Default: watiba-ctl "cache-ttl"
+    def add_cache(self, pattern, ttl=None):
+        self.cache.add_pattern(pattern, ttl)
+
+    # Opt a pattern back out of the command cache, or every pattern if none is passed
+    def remove_cache(self, pattern=None):
+        self.cache.remove_patterns(pattern)
+
+    # Drop cached output of the commands matching the regex pattern and/or run on host, or all of it if neither is
+    # passed.  Returns the number of outputs dropped.
+    def invalidate_cache(self, pattern=None, host=None):
+        return self.cache.invalidate(pattern, host)
+
+    # The command's output from the command cache if it's opted in, otherwise from run()
+    def memoized(self, command, host, context, run, port=None, capture=None):
+        ttl = self.cache.ttl(command, self.parms)
+        if ttl is None:
+            return run()
+        out, result = self.cache.fetch(self.cache_key(command, host, port, capture), ttl, run, self.parms)
+        return self.cache_done(out, host, context, result)
+
+    # (command, host, directory context, SSH port, capture policy)
+    # Remote commands don't run in the directory context, so it's only part of the key for local ones, and the port
+    # only for remote ones.  The policy's limit is part of it when the policy has one: the same command's output
+    # kept by "head" and by "tail", or by "head" with different line counts, isn't the same output.
+    def cache_key(self, command, host, port=None, capture=None):
+        capture_parms = {**self.parms, **capture} if capture else self.parms
+        policy = capture_parms["capture"]
+        if policy in ("head", "tail"):
+            policy = (policy, int(capture_parms["capture-lines"]))
+        elif policy == "spill":
+            policy = (policy, int(capture_parms["capture-bytes"]))
+
+        if host == "localhost":
+            return command, host, self.cwd(), None, policy
+        return command, host, None, int(port if port else self.parms["ssh-port"]), policy
+
+    # Move the directory context the way running the command would have, and count the request
+    def cache_done(self, out, host, context, result):
+        if out.cached:
+            if context and host == "localhost":
+                self.set_cwd(out.cwd)
+            else:
+                out.cwd = self.cwd()
+        if self.parms["metrics"]:
+            metrics.record_cache(host, result, self.parms)
+        return out
+
+
+    ####################################################################################################################
+    #                                           ASYNCIO
+    # Counterparts of bash(), ssh(), spawn() and chain() for programs driven by an asyncio event loop.  Commands run
+    # as asyncio subprocesses, so a command in flight doesn't hold a thread.  Hooks may be coroutines.
+    ####################################################################################################################
+
+    # asyncio version of bash().  (Doesn't use the shell session, which runs one command at a time.)
+    # Returns WTOutput object
+    async def abash(self, command, context=True, run_post_hooks=True, capture=None, input=None, host="localhost",
+                    cache=True):
+        if cache and input is None and self.cache.patterns:
+            return await self.amemoized(command, host, context,
+                                        lambda: self.abash(command, context, run_post_hooks, capture, host=host,
+                                                           cache=False), capture=capture)
+        out = WTOutput()
+
+        # Run any command hooks defined for this command
+        hook_start = time.perf_counter()
+        results = await self.arun_hooks(command, post_hook=False)
+        out.hook_time = time.perf_counter() - hook_start
+        if results['success'] != True:
+            msg = f"One or more hooks failed. Hooks reporting a problem: {', '.join(results['failed-hooks'])}"
+            out.stderr.append(msg)
+            raise Exception(msg)
+
+        capture_parms = {**self.parms, **capture} if capture else self.parms
+        out.stdout = capture_lines(capture_parms)
+        out.stderr = capture_lines(capture_parms)
+
+        # Tack on this command to see what the current dir is after the user's command is executed
+        # The command gets a session of its own, so cancelling the task can stop everything it starts
+        ctx = CONTEXT_MARKER if context else ''
+        run_start = time.perf_counter()
+        p = await asyncio.create_subprocess_shell(f"{command}{ctx}",
+                                                  stdin=PIPE if input is not None else None,
+                                                  stdout=PIPE,
+                                                  stderr=PIPE,
+                                                  close_fds=True,
+                                                  cwd=self.cwd(),
+                                                  start_new_session=True)
+        cwd = await self.acapture(p, out, context, input)
+        out.exit_code = p.returncode
+        out.run_time = time.perf_counter() - run_start
+
+        # Each asyncio task has its own directory context, same as a thread
+        if context and cwd:
+            self.set_cwd(cwd)
+        out.cwd = self.cwd()
+
+        # Run any command post-hooks defined for this command
+        # (or start them in the background, see background_post_hooks())
+        if run_post_hooks and not self.background_post_hooks(command, out):
+            hook_start = time.perf_counter()
+            results = await self.arun_hooks(command, post_hook=True)
+            out.hook_time += time.perf_counter() - hook_start
+
+        if self.parms["metrics"]:
+            metrics.record_output(out, host, self.parms)
+        if results['success'] != True:
+            msg = f"One or more post-hooks failed. Hooks reporting a problem: {', '.join(results['failed-hooks'])}"
+            out.stderr.append(msg)
+            raise Exception(msg)
+
+        return out
+
+    # asyncio version of capture()
+    async def acapture(self, p, out, context, input=None):
+        async def writer():
+            try:
+                p.stdin.write(input)
+                await p.stdin.drain()
+                p.stdin.close()
+            except (BrokenPipeError, ConnectionResetError):
+                # The command quit reading.  Its exit code tells the story.
+                pass
+
+        async def reader(stream, lines, track_context):
+            size = 0
+            while True:
+                chunk = await stream.read(65536)
+                if not chunk:
+                    break
+                lines.write(chunk)
+                size += len(chunk)
+            cwd = self.capture_done(lines, track_context)
+
+            # The context marker isn't the command's output
+            if cwd is not None:
+                size -= self.marker_size(cwd)
+            if lines is out.stdout:
+                out.stdout_bytes = size
+            else:
+                out.stderr_bytes = size
+            return cwd
+
+        jobs = [reader(p.stdout, out.stdout, context), reader(p.stderr, out.stderr, False)]
+        if input is not None:
+            jobs.append(writer())
+
+        try:
+            cwd = (await asyncio.gather(*jobs))[0]
+            await p.wait()
+            out.output_bytes = out.stdout_bytes + out.stderr_bytes
+        except asyncio.CancelledError:
+            # Don't leave the command running behind a cancelled task
+            if p.returncode is None:
+                kill_process_group(p)
+                await p.wait()
+            raise
+
+        return cwd
+
+    # asyncio version of ssh()
+    async def assh(self, command, host, context=True, port=None, capture=None, input=None, cache=True):
+        if cache and input is None and self.cache.patterns:
+            return await self.amemoized(command, host, context,
+                                        lambda: self.assh(command, host, context, port, capture, cache=False),
+                                        port, capture)
+
+        port = port if port else self.parms["ssh-port"]
+        pool = self.connection_pool()
+        try:
+            return await self.abash(self.ssh_command(command, host, port, pool), context, capture=capture,
+                                    input=input, host=host, cache=False)
+        finally:
+            if pool:
+                pool.release(host, port)
+
+    # asyncio version of memoized().  run returns a coroutine.
+    async def amemoized(self, command, host, context, run, port=None, capture=None):
+        ttl = self.cache.ttl(command, self.parms)
+        if ttl is None:
+            return await run()
+        out, result = await self.cache.afetch(self.cache_key(command, host, port, capture), ttl, run, self.parms)
+        return self.cache_done(out, host, context, result)
+
+    # asyncio version of execute()
+    async def aexecute(self, command, host="localhost"):
+        if host == "localhost":
+            return await self.abash(command, True, run_post_hooks=False)
+        return await self.assh(command, host)
+
+    # asyncio version of run_hooks().  Hooks that are coroutines are awaited.
+    async def arun_hooks(self, command, post_hook=False):
+        return_obj = {"success": True, "failed-hooks": []}
+
+        for command_regex, func, mat, parms in self.hook_matches(command, post_hook):
+            token = self.context_patterns.set(self.active_patterns | {command_regex})
+            start = time.perf_counter()
+            try:
+                rc = func(mat, parms)
+                if inspect.isawaitable(rc):
+                    rc = await rc
+            finally:
+                self.context_patterns.reset(token)
+
+            self.hook_result(return_obj, func, rc)
+            self.hook_done(command, command_regex, func, post_hook, time.perf_counter() - start, rc)
+
+        return return_obj
+
+    # Bounds how many aspawn() commands run at once, at spawn-ctl "max".  One bound per event loop.
+    def async_limit(self):
+        loop = asyncio.get_running_loop()
+        limit = self.async_limits.get(loop)
+        if not limit or limit[0] != self.spawn_ctlr.args["max"]:
+            limit = (self.spawn_ctlr.args["max"], asyncio.Semaphore(self.spawn_ctlr.args["max"]))
+            self.async_limits[loop] = limit
+        return limit[1]
+
+    # asyncio version of spawn().  The command runs as a task on the running event loop, not in a thread.
+    # resolver may be a coroutine function.
+    # Returns the promise right away.  Await it, or its ajoin(), to wait for resolution.
+    async def aspawn(self, command, resolver, spawn_args, host="localhost"):
+        l_promise = WTPromise(command, host) if host else WTPromise(command)
+
+        # Chain our promise in if we're a child (a resolver's frame is the caller's)
+        self.relate_to_caller(l_promise, inspect.currentframe().f_back.f_locals)
+        if self.parms["trace"]:
+            tracer.add_promise(l_promise, self.parms)
+
+        async def run_command(promise):
+            promise.thread_id = threading.get_ident()
+
+            async with self.async_limit():
+                promise.set_running()
+                failed = True
+                try:
+                    promise.output = await self.aexecute(command, host)
+                    self.spawn_done(promise)
+                    failed = promise.output.exit_code != 0
+                except BaseException as ex:
+                    promise.set_failed(ex)
+                    raise
+                finally:
+                    promise.set_completed(failed)
+
+            # Call promise resolver
+            try:
+                rc = resolver(promise, copy.copy(spawn_args))
+                if inspect.isawaitable(rc):
+                    rc = await rc
+            except BaseException as ex:
+                promise.set_failed(ex)
+                raise
+            promise.set_resolution(rc)
+
+        # The task starts with a copy of our context, so in our directory context
+        l_promise.task = asyncio.ensure_future(run_command(l_promise))
+        return l_promise
+
+    # asyncio version of chain().  Takes the same arguments.  "parallel" hosts run as tasks rather than threads.
+    async def achain(self, command, parms):
+        output = {}
+        if "hosts" not in parms:
+            raise WTChainException("No hosts in argument dict", "none", command, None)
+
+        pipe_stdout = parms["stdout"] if "stdout" in parms else {}
+        pipe_stderr = parms["stderr"] if "stderr" in parms else {}
+        pipe_chunk = int(parms.get("pipe-chunk-lines", 0))
+
+        if int(parms.get("parallel", 1)) > 1:
+            return await self.aparallel_chain(command, parms, pipe_stdout, pipe_stderr, pipe_chunk)
+
+        for host in parms["hosts"]:
+            output[host] = await self.assh(command, host)
+
+            if output[host].exit_code != 0:
+                raise WTChainException(f'Command failed on {host}. Error code: {output[host].exit_code}', host, command,
+                                       output[host])
+
+            await self.achain_pipes(host, output[host], pipe_stdout, pipe_stderr, pipe_chunk)
+
+        return output
+
+    # asyncio version of parallel_chain()
+    async def aparallel_chain(self, command, parms, pipe_stdout, pipe_stderr, pipe_chunk=0):
+        output = {}
+        failures = {}
+        fail_fast = parms.get("fail-fast", True)
+        limit = asyncio.Semaphore(int(parms["parallel"]))
+
+        async def run(host):
+            async with limit:
+                return host, await self.assh(command, host)
+
+        tasks = [asyncio.ensure_future(run(host)) for host in parms["hosts"]]
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                host, output[host] = await next_done
+
+                if output[host].exit_code != 0:
+                    if fail_fast:
+                        raise WTChainException(f'Command failed on {host}. Error code: {output[host].exit_code}',
+                                               host, command, output[host])
+                    failures[host] = output[host]
+                    continue
+
+                await self.achain_pipes(host, output[host], pipe_stdout, pipe_stderr, pipe_chunk)
+        finally:
+            # After a fail-fast failure, stop the hosts still running or waiting
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+        if failures:
+            failures = {h: failures[h] for h in parms["hosts"] if h in failures}
+            host = next(iter(failures))
+            raise WTChainException(f'Command failed on {len(failures)} hosts: {", ".join(failures)}', host, command,
+                                   failures[host], failures)
+
+        return {host: output[host] for host in parms["hosts"]}
+
+    # asyncio version of chain_pipes()
+    async def achain_pipes(self, host, output, pipe_stdout, pipe_stderr, pipe_chunk=0):
+        if host in pipe_stdout:
+            await self.apipe(output.stdout, pipe_stdout[host], pipe_chunk)
+        if host in pipe_stderr:
+            await self.apipe(output.stderr, pipe_stderr[host], pipe_chunk)
+
+    # asyncio version of pipe()
+    async def apipe(self, pipe_source, pipe_target, chunk_lines=0):
+        data = pipe_source.raw if hasattr(pipe_source, "raw") else "\n".join(pipe_source).encode('utf-8')
+
+        for pipe_to, command in pipe_target.items():
+            for chunk in self.pipe_chunks(data, chunk_lines):
+                out = await self.assh(command, pipe_to, context=False, input=chunk)
+                if out.exit_code != 0:
+                    raise WTChainException(f'Piped command failed on {pipe_to}.  Error code: {out.exit_code}',
+                                           pipe_to, command, out)
@@ -0,0 +1,176 @@
+'''
+Watiba batch compiler.  Compiles whole trees of .wt files at once, each to a .py file beside it, across a pool of
+processes.  A manifest remembers the hash of every source compiled and the compiler that compiled it, so files
+that haven't changed since are skipped.  Optionally, each .py gets a source map (.py.map) mapping its lines back
+to the .wt lines they came from.
+
+Author: Ray Walker
+Raythonic@gmail.com
+'''
+
+import os
+import glob
+import json
+import hashlib
+import functools
+from concurrent.futures import ProcessPoolExecutor
+from watiba.wtcompiler import compile_source, compiler_version, source_map, with_source_map, WTCompilerException
+
+# Default manifest file, in the current directory
+MANIFEST = ".watiba-c.manifest"
+
+
+class WTBatchResults:
+    def __init__(self):
+        self.compiled = []  # Sources compiled
+        self.current = []  # Sources skipped because their output was up to date
+        self.failed = {}  # Source -> error message
+
+
+# Expand the paths given on the command line into .wt files: directories are searched (recursively) for .wt files,
+# and anything with a wildcard in it is a glob pattern.  Files named explicitly are kept whatever their type, for
+# compile_tree() to reject.
+def find_sources(paths):
+    sources = []
+    for path in paths:
+        if os.path.isdir(path):
+            for directory, subdirectories, files in os.walk(path):
+                subdirectories[:] = sorted(d for d in subdirectories if d != "__pycache__")
+                sources += [os.path.join(directory, f) for f in sorted(files) if f.endswith(".wt")]
+        elif glob.has_magic(path):
+            sources += [f for f in sorted(glob.glob(path, recursive=True)) if f.endswith(".wt") and os.path.isfile(f)]
+        else:
+            sources.append(path)
+
+    # Each file once, in the order found
+    return list(dict.fromkeys(os.path.abspath(s) for s in sources))
+
+
+# The generated Python for a source goes beside it
+def output_path(source):
+    return f"{source[:-len('.wt')]}.py"
+
+
+def file_hash(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+# Write a file so nothing ever sees it half written: a temporary file in the same directory, renamed over the old
+def write_atomic(path, data, mode=None):
+    tmp = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp, "wb") as f:
+            f.write(data)
+        if mode is not None:
+            os.chmod(tmp, mode)
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+
+# Compile one source to its output file, and its source map if asked for.  Runs in a pool process.
+# Returns (source, source hash, output hash, error message)
+def compile_file(source, map_lines=False):
+    try:
+        with open(source, "rb") as f:
+            data = f.read()
+        line_map = []
+        python = compile_source(data.decode("utf-8"), line_map)
+
+        if map_lines:
+            map_path = f"{output_path(source)}.map"
+            write_atomic(map_path, source_map(source, output_path(source), line_map).encode("utf-8"))
+            python = with_source_map(python, map_path)
+        python = python.encode("utf-8")
+
+        # The output keeps the source's permissions, so an executable script stays executable
+        write_atomic(output_path(source), python, os.stat(source).st_mode & 0o7777)
+        return source, file_hash(data), file_hash(python), None
+    except WTCompilerException as ex:
+        return source, None, None, ex.message
+    except (OSError, UnicodeDecodeError) as ex:
+        return source, None, None, str(ex)
+
+
+def load_manifest(path):
+    try:
+        with open(path) as f:
+            manifest = json.load(f)
+        return manifest if isinstance(manifest, dict) else {}
+    except (OSError, ValueError):
+        return {}
+
+
+# Whether a source's output is up to date according to the manifest
+def is_current(entry, source_hash, version):
+    if not entry or entry.get("source") != source_hash or entry.get("compiler") != version:
+        return False
+
+    # The output must still be there, as it was written
+    try:
+        with open(entry["output"], "rb") as f:
+            return file_hash(f.read()) == entry.get("python")
+    except OSError:
+        return False
+
+
+# Note the outcome of each compile in the results and the manifest entries
+def record(results, entries, version, compiled):
+    for source, source_hash, python_hash, error in compiled:
+        if error:
+            results.failed[source] = error
+            entries.pop(source, None)
+        else:
+            results.compiled.append(source)
+            entries[source] = {"source": source_hash, "compiler": version,
+                               "output": output_path(source), "python": python_hash}
+
+
+# Compile .wt files, directories of them and glob patterns, skipping files already compiled from the same source
+# by the same compiler
+# jobs - number of processes (default: one per CPU)
+# manifest - file recording what was compiled
+# force - compile everything, whether it's up to date or not
+# map_lines - write a source map beside each output
+def compile_tree(paths, jobs=None, manifest=MANIFEST, force=False, map_lines=False):
+    results = WTBatchResults()
+
+    # Output with source maps differs from output without, so switching them on or off recompiles everything
+    version = f"{compiler_version()}+map" if map_lines else compiler_version()
+    entries = load_manifest(manifest)
+
+    # Sort out what needs compiling
+    pending = []
+    for source in find_sources(paths):
+        # Anything else would be written over by its own output, or give it an odd name
+        if not source.endswith(".wt"):
+            results.failed[source] = f"ERROR: Input file must be type .wt.  Found {source}"
+            continue
+
+        try:
+            with open(source, "rb") as f:
+                source_hash = file_hash(f.read())
+        except OSError as ex:
+            results.failed[source] = str(ex)
+            continue
+
+        if not force and is_current(entries.get(source), source_hash, version):
+            results.current.append(source)
+        else:
+            pending.append(source)
+
+    # A pool isn't worth starting for a file or two
+    jobs = jobs or os.cpu_count() or 1
+    compile_one = functools.partial(compile_file, map_lines=map_lines)
+    if len(pending) < 2 or jobs == 1:
+        record(results, entries, version, map(compile_one, pending))
+    else:
+        with ProcessPoolExecutor(max_workers=min(jobs, len(pending))) as pool:
+            record(results, entries, version,
+                   pool.map(compile_one, pending, chunksize=max(1, len(pending) // (jobs * 4))))
+
+    if results.compiled or results.failed:
+        write_atomic(manifest, json.dumps(entries, indent=1, sort_keys=True).encode("utf-8"))
+    return results
@@ -0,0 +1,252 @@
+'''
+Watiba command cache.  Memoizes the output of read-only commands (uname -r, nproc, git rev-parse HEAD...) so a
+script running the same command on the same host, from the same directory, gets the earlier output back instead of
+starting another process or SSH round trip.  Commands only come from the cache once they're opted in by pattern,
+and identical requests made while the command is running wait for its output rather than run it again.
+
+Entries expire after their time-to-live, the least recently used are dropped to stay under the size limit, and the
+cache can be kept in a file between runs.
+
+Author: Ray Walker
+Raythonic@gmail.com
+'''
+
+import os
+import re
+import json
+import time
+import atexit
+import base64
+import asyncio
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+from watiba.wtoutput import WTOutput
+from watiba.wtcapture import WTByteLines
+
+
+class WTCacheException(Exception):
+    def __init__(self, cache, message=""):
+        self.cache = cache
+        self.message = message
+
+
+class WTCache:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.patterns = {}  # Pattern -> (compiled regex, seconds to live or None for watiba-ctl "cache-ttl")
+        self.entries = OrderedDict()  # Key (Watiba.cache_key()) -> (expiry time, WTOutput), least recently used first
+        self.running = {}  # Key -> (Future of the output, thread or task running it)
+        self.generation = 0  # Bumped by invalidate(), so output of a command that was running then isn't kept
+        self.max_entries = 1000
+        self.file = None
+        self.counts = {"hits": 0, "misses": 0, "coalesced": 0}
+
+    # Opt commands matching a regex pattern in to the cache
+    # ttl - seconds their output is kept.  Default: watiba-ctl "cache-ttl"
+    def add_pattern(self, pattern, ttl=None):
+        with self.lock:
+            self.patterns[pattern] = (re.compile(pattern), ttl)
+
+    # Opt a pattern, or every pattern if none is passed, back out.  Output already cached stays until invalidated.
+    def remove_patterns(self, pattern=None):
+        with self.lock:
+            if pattern is None:
+                self.patterns = {}
+            else:
+                self.patterns.pop(pattern, None)
+
+    # Seconds to keep the command's output, or None if the command isn't opted in
+    def ttl(self, command, parms):
+        for regex, ttl in list(self.patterns.values()):
+            if regex.match(command):
+                return ttl if ttl is not None else parms["cache-ttl"]
+        return None
+
+    # Drop cached output: of commands matching a regex pattern and/or of a host, or everything if neither is passed
+    # Returns the number of entries dropped
+    def invalidate(self, pattern=None, host=None):
+        regex = re.compile(pattern) if pattern is not None else None
+        with self.lock:
+            self.generation += 1
+            keys = [key for key in self.entries
+                    if (regex is None or regex.match(key[0])) and (host is None or key[1] == host)]
+            for key in keys:
+                del self.entries[key]
+            return len(keys)
+
+    # Hit, miss and coalesced request counts, and the number of entries
+    def stats(self):
+        with self.lock:
+            return {**self.counts, "entries": len(self.entries)}
+
+    # Output of the command, from the cache or from running it
+    # key - (command, host, cwd, port, capture policy)
+    # run - function that runs the command and returns its WTOutput
+    # Returns (WTOutput, "hit", "miss" or "coalesced")
+    def fetch(self, key, ttl, run, parms):
+        result, found, generation = self.begin(key, threading.get_ident(), parms)
+        if result == "hit":
+            return found, result
+        if result == "coalesced":
+            # The same command is running for someone else.  Its output is ours too.
+            return self.copy(found.result()), result
+
+        try:
+            out = run()
+        except BaseException as ex:
+            self.fail(key, found, ex)
+            raise
+        self.finish(key, found, generation, ttl, out)
+        return out, result
+
+    # asyncio version of fetch().  run is a coroutine function.
+    async def afetch(self, key, ttl, run, parms):
+        result, found, generation = self.begin(key, asyncio.current_task(), parms)
+        if result == "hit":
+            return found, result
+        if result == "coalesced":
+            return self.copy(await asyncio.wrap_future(found)), result
+
+        try:
+            out = await run()
+        except BaseException as ex:
+            self.fail(key, found, ex)
+            raise
+        self.finish(key, found, generation, ttl, out)
+        return out, result
+
+    # Look the command up
+    # owner - the thread (or asyncio task) asking
+    # Returns one of:
+    #   ("hit", cached WTOutput, None)
+    #   ("coalesced", future, None) - the command is already running, the future gets its output
+    #   ("miss", future or None, generation) - the caller runs the command and passes its output to finish()
+    def begin(self, key, owner, parms):
+        self.configure(parms)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry and entry[0] > time.time():
+                self.entries.move_to_end(key)
+                self.counts["hits"] += 1
+                return "hit", self.copy(entry[1]), None
+            if entry:
+                del self.entries[key]
+
+            running = self.running.get(key)
+            if running and running[1] != owner:
+                self.counts["coalesced"] += 1
+                return "coalesced", running[0], None
+
+            self.counts["misses"] += 1
+            if running:
+                # A hook of the command running it again.  Waiting on ourselves would never end.
+                return "miss", None, None
+            future = Future()
+            self.running[key] = (future, owner)
+            return "miss", future, self.generation
+
+    # The command has run.  Successful output is kept, unless the cache was invalidated while it ran.  What's kept,
+    # and given to callers waiting on it, is a copy: the caller that ran the command may append to its output.
+    def finish(self, key, future, generation, ttl, out):
+        if future is None:
+            return
+        kept = self.copy(out)
+        with self.lock:
+            del self.running[key]
+            if out.exit_code == 0 and generation == self.generation and ttl > 0:
+                self.entries[key] = (time.time() + ttl, kept)
+                self.entries.move_to_end(key)
+                while len(self.entries) > self.max_entries:
+                    self.entries.popitem(last=False)
+        future.set_result(kept)
+
+    # The command raised.  Anyone waiting on it gets the exception too.
+    def fail(self, key, future, ex):
+        if future is None:
+            return
+        with self.lock:
+            del self.running[key]
+        future.set_exception(ex)
+
+    # Each caller gets its own output object, with its own line holders, so lines appended to one caller's output
+    # aren't seen by the others.  (The output bytes themselves are shared, they don't change.)  No process ran for
+    # it, so it has no resource usage or timings.
+    @staticmethod
+    def copy(out):
+        copied = WTOutput()
+        copied.__dict__.update(out.__dict__)
+        copied.stdout = out.stdout.copy()
+        copied.stderr = out.stderr.copy()
+        copied.cached = True
+        copied.rusage = None
+        copied.run_time = copied.hook_time = 0.0
+        copied.spawn_latency = None
+        copied.post_hooks = None
+        return copied
+
+    # Pick up watiba-ctl changes: the size limit, and the file the cache is kept in
+    def configure(self, parms):
+        self.max_entries = int(parms["cache-max"])
+        if parms["cache-file"] != self.file:
+            self.file = parms["cache-file"]
+            if self.file:
+                self.load(self.file)
+                atexit.register(self.save_exit_file, self.file)
+
+    def save_exit_file(self, path):
+        if self.file == path:
+            self.save(path)
+
+    # Read entries kept by an earlier run.  Expired entries are skipped, and a missing file is an empty cache.
+    def load(self, path):
+        try:
+            with open(path) as f:
+                saved = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as ex:
+            raise WTCacheException(self, f"Can't read cache file {path}: {ex}")
+
+        now = time.time()
+        with self.lock:
+            # Kept by a version of Watiba with different keys
+            if saved.get("version") != 2:
+                return
+            for entry in saved.get("entries", []):
+                if entry["expires"] <= now:
+                    continue
+                out = WTOutput()
+                out.stdout = WTByteLines(bytearray(base64.b64decode(entry["stdout"])))
+                out.stderr = WTByteLines(bytearray(base64.b64decode(entry["stderr"])))
+                out.exit_code = entry["exit_code"]
+                out.cwd = entry["out-cwd"]
+                out.stdout_bytes, out.stderr_bytes = len(out.stdout.raw), len(out.stderr.raw)
+                out.output_bytes = out.stdout_bytes + out.stderr_bytes
+                capture = entry["capture"]
+                key = (entry["command"], entry["host"], entry["cwd"], entry["port"],
+                       tuple(capture) if isinstance(capture, list) else capture)
+                if key not in self.entries:
+                    self.entries[key] = (entry["expires"], out)
+                    self.entries.move_to_end(key, last=False)
+
+    # Write the unexpired entries to a file, replacing it in one step
+    def save(self, path):
+        now = time.time()
+        with self.lock:
+            entries = [(key, expires, out) for key, (expires, out) in self.entries.items() if expires > now]
+
+        saved = {"version": 2, "entries": [
+            {"command": command, "host": host, "cwd": cwd, "port": port, "capture": capture, "expires": expires,
+             "exit_code": out.exit_code, "out-cwd": out.cwd,
+             "stdout": base64.b64encode(out.stdout.raw).decode("ascii"),
+             "stderr": base64.b64encode(out.stderr.raw).decode("ascii")}
+            for (command, host, cwd, port, capture), expires, out in entries]}
+
+        temp = f"{path}.{os.getpid()}.tmp"
+        try:
+            with open(temp, "w") as f:
+                json.dump(saved, f)
+            os.replace(temp, path)
+        except OSError as ex:
+            raise WTCacheException(self, f"Can't write cache file {path}: {ex}")
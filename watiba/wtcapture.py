@@ -0,0 +1,336 @@
+'''
+Watiba output capture policies.  Bytes-backed, list-like holders for command output lines.
+
+Output is kept as the raw bytes the command wrote.  Lines are only located and decoded when they're
+accessed, so a caller that only checks the exit code, or reads the first line, never pays for the rest.
+
+Author: Ray Walker
+Raythonic@gmail.com
+'''
+
+import os
+import mmap
+import tempfile
+from array import array
+from collections import deque
+from collections.abc import Sequence
+
+
+# Appended to a command to learn the directory it ended up in.  The marker always goes on a line of its own, even
+# when the output doesn't end in a newline: the newline before it is Watiba's, and is dropped along with it.
+CONTEXT_MARKER = " && printf '\\n__watiba_cwd__(%s)_\\n' \"$(pwd)\""
+
+
+class WTCaptureException(Exception):
+    def __init__(self, policy, message=""):
+        self.policy = policy
+        self.message = message
+
+
+# Base class for the capture policies.  Behaves like the read side of a list, plus append().
+#
+# Every holder is filled the same way while the command runs:
+#   write(data) - raw bytes as read from the command
+#   last_line() - the final line, if the output so far ends with a newline (used to find the context marker)
+#   drop_last_line() - forget the line last_line() returned (the context marker), and the newline Watiba wrote
+#                      before it
+#   close() - no more output is coming
+class WTLines(Sequence):
+    def __init__(self):
+        # Number of lines the policy threw away
+        self.dropped = 0
+
+        # Lines added by Watiba itself (e.g. hook failure messages), kept after the command's output
+        self.extra = []
+
+    def append(self, line):
+        self.extra.append(line)
+
+    # A holder of the same output that can be appended to, and read, without touching this one.  Only used once the
+    # command is done: the output bytes are shared, they don't change any more.
+    def copy(self):
+        copied = object.__new__(type(self))
+        copied.__dict__.update(self.__dict__)
+        copied.extra = list(self.extra)
+        return copied
+
+    @staticmethod
+    def decode(line):
+        return line.decode('utf-8', errors='replace')
+
+    def __eq__(self, other):
+        if isinstance(other, (list, Sequence)) and not isinstance(other, str):
+            return list(self) == list(other)
+        return NotImplemented
+
+    def __repr__(self):
+        return repr(list(self))
+
+
+# Base class for the policies that keep a fixed number of lines
+class WTBoundedLines(WTLines):
+    def __init__(self, max_lines):
+        super().__init__()
+        self.max_lines = max_lines
+        self.count = 0
+        self.partial = b''
+
+    def write(self, data):
+        lines = (self.partial + data).split(b'\n')
+        self.partial = lines.pop()
+        for line in lines:
+            self.add(line)
+
+    # The output, ending in a newline or not, always has a final line.  (Same as splitting on newlines.)  When the
+    # output ends in a newline that line is empty, and it doesn't take up one of the lines kept.
+    def close(self):
+        final_empty = self.partial == b''
+        self.add(self.partial)
+        self.partial = b''
+        self.trim(final_empty)
+        self.dropped = self.count - len(self.lines)
+
+    @property
+    def raw(self):
+        return b'\n'.join(self.lines)
+
+    def copy(self):
+        copied = super().copy()
+        copied.lines = self.lines.copy()
+        return copied
+
+    def __len__(self):
+        return len(self.lines) + len(self.extra)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+
+        if index < 0:
+            index += len(self)
+        if index >= len(self.lines):
+            return self.extra[index - len(self.lines)]
+        return self.decode(self.lines[index])
+
+    def __iter__(self):
+        for line in self.lines:
+            yield self.decode(line)
+        yield from self.extra
+
+
+# Keep only the first N lines
+class WTHeadLines(WTBoundedLines):
+    def __init__(self, max_lines):
+        super().__init__(max_lines)
+        self.lines = []
+        self.last = None
+        self.previous = None
+
+    def add(self, line):
+        self.count += 1
+        self.previous, self.last = self.last, line
+
+        # Keep one spare line in case the last one kept turns out to be the context marker
+        if len(self.lines) <= self.max_lines:
+            self.lines.append(line)
+
+    def last_line(self):
+        return self.last if self.count and not self.partial else None
+
+    # The line before the marker was only ended by Watiba's newline, so it goes back to being unfinished
+    def drop_last_line(self):
+        for _ in range(min(2, self.count)):
+            if len(self.lines) == self.count:
+                self.lines.pop()
+            self.count -= 1
+        self.partial = self.previous if self.previous is not None else b''
+
+    def trim(self, final_empty):
+        # The empty final line is only kept if every line before it was
+        del self.lines[self.max_lines + (1 if final_empty and self.count - 1 <= self.max_lines else 0):]
+
+
+# Keep only the last N lines (ring buffer)
+class WTTailLines(WTBoundedLines):
+    def __init__(self, max_lines):
+        super().__init__(max_lines)
+
+        # Two spare lines in case the last one turns out to be the context marker (the line before it goes back to
+        # being unfinished)
+        self.lines = deque(maxlen=max_lines + 2)
+
+    def add(self, line):
+        self.count += 1
+        self.lines.append(line)
+
+    def last_line(self):
+        return self.lines[-1] if self.lines and not self.partial else None
+
+    # The line before the marker was only ended by Watiba's newline, so it goes back to being unfinished
+    def drop_last_line(self):
+        self.lines.pop()
+        self.partial = self.lines.pop() if self.lines else b''
+        self.count -= 2 if self.count > 1 else 1
+
+    def trim(self, final_empty):
+        while len(self.lines) > self.max_lines + (1 if final_empty else 0):
+            self.lines.popleft()
+
+
+# Keep all the output.  Lines are found by a newline index that's built only as far as it's needed.
+class WTByteLines(WTLines):
+    def __init__(self, data=None):
+        super().__init__()
+        self.data = bytearray() if data is None else data
+        self.end = len(self.data)
+
+        # index[n] is the offset where line n starts
+        self.index = array('q', [0])
+        self.indexed = False
+        self.line_count = None
+
+    def write(self, data):
+        self.data += data
+        self.end = len(self.data)
+
+    def last_line(self):
+        if self.end == 0 or self.data[self.end - 1] != ord('\n'):
+            return None
+        start = self.data.rfind(b'\n', 0, self.end - 1) + 1
+        return bytes(self.data[start:self.end - 1])
+
+    def drop_last_line(self):
+        self.end = max(0, self.data.rfind(b'\n', 0, self.end - 1))
+
+    def close(self):
+        pass
+
+    @property
+    def raw(self):
+        return bytes(self.data[:self.end])
+
+    # The line index is built as the output is read, so each copy builds its own
+    def copy(self):
+        copied = super().copy()
+        copied.index = array('q', self.index)
+        return copied
+
+    # Extend the line index until it reaches line n or the end of the output
+    def index_to(self, n):
+        while not self.indexed and len(self.index) <= n:
+            pos = self.data.find(b'\n', self.index[-1], self.end)
+            if pos < 0:
+                self.indexed = True
+            else:
+                self.index.append(pos + 1)
+
+    # Lines in the command's output.  Counted without building the index.
+    def output_lines(self):
+        if self.line_count is None:
+            count = 0
+            # Count in slices, mmap has no count()
+            for start in range(0, self.end, 1 << 20):
+                count += self.data[start:min(start + (1 << 20), self.end)].count(b'\n')
+            self.line_count = count + 1
+        return self.line_count
+
+    def line(self, n):
+        self.index_to(n + 1)
+        start = self.index[n]
+        stop = self.index[n + 1] - 1 if n + 1 < len(self.index) else self.end
+        return self.decode(self.data[start:stop])
+
+    def __len__(self):
+        return self.output_lines() + len(self.extra)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+
+        if index < 0:
+            index += len(self)
+        if index < 0 or index >= len(self):
+            raise IndexError("output line index out of range")
+        if index >= self.output_lines():
+            return self.extra[index - self.output_lines()]
+        return self.line(index)
+
+    # Walk the output without building (or keeping) the index
+    def __iter__(self):
+        start = 0
+        while True:
+            pos = self.data.find(b'\n', start, self.end)
+            if pos < 0:
+                yield self.decode(self.data[start:self.end])
+                break
+            yield self.decode(self.data[start:pos])
+            start = pos + 1
+        yield from self.extra
+
+
+# Keep all the output in memory until it exceeds a byte threshold, then move it to a temp file.
+# Once the command completes the file is memory mapped and read just like in-memory output.
+class WTSpillLines(WTByteLines):
+    def __init__(self, max_bytes, spill_dir=None):
+        super().__init__()
+        self.max_bytes = max_bytes
+        self.spill_dir = spill_dir
+        self.file = None
+
+    # Is the output on disk?
+    def spilled(self):
+        return self.file is not None
+
+    def write(self, data):
+        if not self.file:
+            super().write(data)
+            if self.end > self.max_bytes:
+                self.file = tempfile.TemporaryFile(dir=self.spill_dir, prefix="watiba-")
+                self.file.write(self.data)
+                self.data = bytearray()
+            return
+
+        self.file.write(data)
+        self.end += len(data)
+
+    # Look for the last line in the tail of the file
+    def last_line(self):
+        if not self.file:
+            return super().last_line()
+
+        self.file.flush()
+        start = max(0, self.end - 8192)
+        tail = os.pread(self.file.fileno(), self.end - start, start)
+        if not tail.endswith(b'\n'):
+            return None
+        return tail[tail.rfind(b'\n', 0, len(tail) - 1) + 1:-1]
+
+    def drop_last_line(self):
+        if not self.file:
+            return super().drop_last_line()
+        self.end = max(0, self.end - len(self.last_line()) - 2)
+
+    def close(self):
+        if self.file:
+            self.file.flush()
+            self.data = mmap.mmap(self.file.fileno(), self.end, access=mmap.ACCESS_READ) if self.end else b''
+
+
+# Create an empty line holder for the capture policy in parms
+#   "capture" - "all" (default), "head", "tail" or "spill"
+#   "capture-lines" - lines kept by "head" and "tail"
+#   "capture-bytes" - bytes held in memory by "spill" before it moves the output to a temp file
+#   "capture-dir" - where "spill" creates its temp file (default: system temp dir)
+def capture_lines(parms):
+    policy = parms.get("capture", "all")
+
+    if policy == "all":
+        return WTByteLines()
+    if policy == "head":
+        return WTHeadLines(int(parms["capture-lines"]))
+    if policy == "tail":
+        return WTTailLines(int(parms["capture-lines"]))
+    if policy == "spill":
+        return WTSpillLines(int(parms["capture-bytes"]), parms.get("capture-dir"))
+
+    raise WTCaptureException(policy, f"Unknown capture policy: {policy}")
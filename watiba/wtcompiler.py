@@ -0,0 +1,511 @@
+'''
+Watiba compiler.  Turns Watiba statements (Python with embedded shell commands) into plain Python.
+
+Used by the watiba-c command line, and by wtimport.py to compile .wt modules on import.
+
+Author: Ray Walker
+Raythonic@gmail.com
+'''
+
+import io
+import os
+import re
+import json
+import hashlib
+import linecache
+import importlib.metadata
+
+watiba_ref = "_watiba_"
+
+# Scans a statement once for the text Watiba expressions start with.  Statements with none of it are plain Python
+# and are passed through.
+SCANNER = re.compile(r"`|spawn |spawn-ctl |watiba-ctl |hook-cmd|remove-hooks|chain\[|chain ")
+
+# Kind of Watiba expression each text the scanner finds belongs to
+KINDS = {"spawn ": "spawn", "spawn-ctl ": "ctl", "watiba-ctl ": "ctl", "hook-cmd": "hook", "remove-hooks": "remove",
+         "chain[": "chain", "chain ": "chain", "`": "backticks"}
+
+# Watiba expressions by the kind the scanner finds: (regex, generator method).  Only the kinds found in a statement
+# are tried.  When a statement has more than one kind, the first kind here wins (otherwise backticks would win over
+# spawn), and within a kind the first matching regex wins.
+EXPRESSIONS = {
+    "spawn": [
+        # p = spawn `cmd`@host args: block
+        (re.compile(r"^(\S.*)?spawn \s*`(\S.*)`@(\S.*) \s*?(\S.*)?:.*"), "spawn_generator_with_host"),
+
+        # p = spawn `cmd`@host: block
+        (re.compile(r"^(\S.*)?spawn \s*`(\S.*)`@(\S.*)\s*?(\S.*)?:.*"), "spawn_generator_with_host"),
+
+        # p = spawn `cmd` args: block
+        (re.compile(r"^(\S.*)?spawn \s*`(\S.*)`\s*?(\S.*)?:.*"), "spawn_generator")],
+
+    "ctl": [
+        # spawn-ctl {args}
+        (re.compile(r"^spawn-ctl \s*(\S.*)"), "spawn_ctl_args"),
+
+        # watbia-ctl {args}
+        (re.compile(r"^watiba-ctl \s*(\S.*)"), "watiba_ctl_args")],
+
+    "hook": [
+        # post-hook-cmd "command pattern" {function: {parms}, function: {parms}}
+        (re.compile(r".*?post-hook-cmd \s*(\S.*) (\S.*) (\S.*)"), "post_hook_generator"),
+
+        # post-hook-cmd-nr (non-recursive) "command pattern" {function: {parms}, function: {parms}}
+        (re.compile(r".*?post-hook-cmd-nr \s*(\S.*) (\S.*) (\S.*)"), "post_hook_nr_generator"),
+
+        # hook-cmd "command pattern" {function: {parms}, function: {parms}}
+        (re.compile(r".*?hook-cmd \s*(\S.*) (\S.*) (\S.*)"), "hook_generator"),
+
+        # hook-cmd-nr (non-recursive) "command pattern" {function: {parms}, function: {parms}}
+        (re.compile(r".*?hook-cmd-nr \s*(\S.*) (\S.*) (\S.*)"), "hook_nr_generator")],
+
+    "remove": [
+        # remove-hooks
+        (re.compile(r".*?remove-hooks\s.*?(\S.*)?$"), "remove_hooks_generator")],
+
+    "chain": [
+        # chain[N] `cmd` args  (run on N hosts at once)
+        (re.compile(r"^(\S.*)?chain\[\s*(\S+?)\s*\] \s*`(\S.*)` \s*(\S.*)"), "parallel_chain_generator"),
+
+        # chain {host:cmd...
+        (re.compile(r"^(\S.*)?chain \s*`(\S.*)` \s*(\S.*)"), "chain_generator")],
+
+    "backticks": [
+        # `cmd` or `cmd`@host, where host is a name or a $variable
+        (re.compile(r"([\-])?`(\S.*?)`(?:@(\$[\w.]+|[\w.@\-]+))?"), "backticks_generator")]
+}
+
+# Promises a spawn waits for, at the end of its arguments: spawn `cmd` args after [p1, p2]:
+SPAWN_AFTER = re.compile(r"(?:^|\s)after\s+(\[.*\]|[\w.]+)\s*$")
+
+# Strings, comments and backticked commands, to tell where a triple-quoted string really starts
+STRING_TOKENS = re.compile(r'"""|\'\'\'|"(?:\\.|[^"\\])*"|\'(?:\\.|[^\'\\])*\'|`[^`]*`|#')
+
+# The rest of a triple-quoted string, up to its closing quotes
+STRING_ENDS = {quotes: re.compile(r"(?:\\.|[^\\])*?" + quotes) for quotes in ('"""', "'''")}
+
+
+class WTCompilerException(Exception):
+    def __init__(self, compiler, message=""):
+        self.compiler = compiler
+        self.message = message
+
+
+# Compiles Watiba statements into Python, one statement at a time
+# sink - called with each line of generated Python (default: print it)
+# header - generate the Watiba header (import watiba, _watiba_ = ...) after the first line, which is copied as-is
+#          for its #! line.  Without it, every line is compiled and whatever runs the code provides watiba and
+#          _watiba_ (see wtrun.script_globals()).
+class Compiler:
+    def __init__(self, sink=print, header=True):
+        self.sink = sink
+
+        # The source line each line of generated Python came from, in the order they went to the sink
+        self.line_map = []
+        self.first_time = header
+        self.current_statement = ""
+        self.output = ["import watiba",
+                       f"{watiba_ref} = watiba.Watiba()"
+                       ] if header else []
+        self.resolver_count = 1
+        self.spawn_call = []
+        self.spawn_line = []  # Source line of each queued spawn call
+        self.last_stmt = ""
+        self.stmt_count = 1 if header else 0
+
+        # Source line the current statement starts on
+        self.statement_line = 1
+
+        # Statement state carried across lines: the quotes of a triple-quoted string still open, and a backticked
+        # command continued onto the next line
+        self.open_string = None
+        self.continued = None
+        self.continued_lines = 0
+
+    # Flush output and any queue spawn calls that are located after the resolver block
+    def flush(self, final=False):
+        # Statements to ignore when looking for block terminations
+        nothingness = ["#"]
+
+        # The source ended part way through a continued command.  Pass it through as it was.
+        if final and self.continued is not None:
+            self.statement_line = self.stmt_count - self.continued_lines + 1
+            self.output.append(self.continued + "\\")
+            self.output += [""] * (self.continued_lines - 1)
+            self.continued = None
+
+        if final and len(self.spawn_call) > 0:
+            if re.search("^return ", self.last_stmt.strip()):
+                # Spit out spawn calls if they're queued up
+                while len(self.spawn_call) > 0:
+                    self.emit(self.spawn_call.pop(), self.spawn_line.pop())
+            else:
+                raise WTCompilerException(self, "ERROR in flush: Resolver block not properly terminated with return.\n"
+                                                f"    Block at line {self.stmt_count} incorrectly terminated with:\n"
+                                                f"      {self.last_stmt}")
+
+        # Print our generated output.  The lines after a statement's first belong to its continued lines, and
+        # the Watiba header belongs to the first line.
+        if not self.first_time:
+            line = self.statement_line
+            while len(self.output) > 0:
+                self.emit(self.output.pop(0), min(line, self.stmt_count))
+                line += 1
+
+            if len(self.current_statement.strip()) > 0:
+                self.last_stmt = self.current_statement if self.current_statement.lstrip()[
+                                                               0] not in nothingness else self.last_stmt
+
+    # Send a line of generated Python to the sink
+    # line - the source line it was generated from
+    def emit(self, text, line):
+        self.line_map.append(line)
+        self.sink(text)
+
+    # Generate command hook
+    def hook_generator(self, parms):
+        self.output.append(f'{parms["indentation"]}{watiba_ref}.add_hook('
+            f'{parms["match"].group(1).strip()},' 
+            f'{parms["match"].group(2).strip()},' 
+            f'{parms["match"].group(3).strip()},' 
+            'recursive=True, post=False)')
+    
+    # Generate command non-recursive hook
+    def hook_nr_generator(self, parms):
+        self.output.append(f'{parms["indentation"]}{watiba_ref}.add_hook('
+            f'{parms["match"].group(1).strip()},' 
+            f'{parms["match"].group(2).strip()},' 
+            f'{parms["match"].group(3).strip()},' 
+            'recursive=False, post=False)')
+
+    # Generate post-command hook
+    def post_hook_generator(self, parms):
+        self.output.append(f'{parms["indentation"]}{watiba_ref}.add_hook('
+            f'{parms["match"].group(1).strip()},' 
+            f'{parms["match"].group(2).strip()},' 
+            f'{parms["match"].group(3).strip()},' 
+            'recursive=True, post=True)')
+    
+    # Generate post_command non-recursive hook
+    def post_hook_nr_generator(self, parms):
+        self.output.append(f'{parms["indentation"]}{watiba_ref}.add_hook('
+            f'{parms["match"].group(1).strip()},' 
+            f'{parms["match"].group(2).strip()},' 
+            f'{parms["match"].group(3).strip()},' 
+            'recursive=False, post=True)')
+    
+
+
+    # Generate removal of command hooks
+    def remove_hooks_generator(self, parms):
+        if len(parms["match"].groups()) >  0 and parms["match"].group(1) != None:
+            self.output.append(f'{parms["indentation"]}{watiba_ref}.remove_hooks({parms["match"].group(1).strip()})')
+            return
+        
+        self.output.append(f'{parms["indentation"]}{watiba_ref}.remove_hooks()')
+
+    # Generate chain command
+    def chain_generator(self, parms):
+        assignment = parms["match"].group(1) if parms["match"].group(1) else ""
+        quote_type = "'" if "'" not in parms["match"].group(2) else '"'
+        cmd = f'{quote_type}{parms["match"].group(2)}{quote_type}' if parms["match"].group(2)[0] != "$" else parms[
+            "match"].group(2).replace("$", "")
+        args = parms["match"].group(3)
+
+        self.output.append(f'{parms["indentation"]}{assignment}{watiba_ref}.chain({cmd}, {args})')
+
+    # Generate parallel chain command.  The parallel count is merged into the chain's args
+    def parallel_chain_generator(self, parms):
+        assignment = parms["match"].group(1) if parms["match"].group(1) else ""
+        parallel = parms["match"].group(2).replace("$", "")
+        quote_type = "'" if "'" not in parms["match"].group(3) else '"'
+        cmd = f'{quote_type}{parms["match"].group(3)}{quote_type}' if parms["match"].group(3)[0] != "$" else parms[
+            "match"].group(3).replace("$", "")
+        args = parms["match"].group(4)
+
+        self.output.append(
+            f'{parms["indentation"]}{assignment}{watiba_ref}.chain({cmd}, {{**{args}, "parallel": {parallel}}})')
+
+    # Set spawn controller args
+    def spawn_ctl_args(self, parms):
+        self.output.append(f'{parms["indentation"]}{watiba_ref}.spawn_ctlr.set_parms({parms["match"].group(1)})')
+
+    # Set watiba control args
+    def watiba_ctl_args(self, parms):
+        self.output.append(f'{parms["indentation"]}{watiba_ref}.set_parms({parms["match"].group(1)})')
+
+    # Handle spawn code blocks (with host specified)
+    def spawn_generator_with_host(self, parms):
+        # Host names have no spaces, so anything after one is arguments the host pattern took in
+        host, _, rest = parms["match"].group(3).partition(" ")
+        args = " ".join(a for a in (rest.strip(), parms["match"].group(4)) if a)
+        self.spawn_generator(parms, host=host, args=args)
+
+    # Handle spawn code blocks
+    def spawn_generator(self, parms, host=None, args=None):
+        hostname = host if host else "localhost"
+        assign_idx = 1
+        cmd_idx = 2
+        args = parms["match"].group(3) if not host else args
+
+        # Build the spawn call that will be located just after the resolver block
+        quote_style = "'" if "'" not in parms["match"].group(cmd_idx) else '"'
+
+        # extract the command and if it's a variable, remove the $ and no quotes, otherwise in quotes
+        cmd = parms["match"].group(cmd_idx)[1:] if parms["match"].group(cmd_idx)[
+                                                       0] == "$" else f'{quote_style}{parms["match"].group(cmd_idx)}{quote_style}'
+        # Build the next resolver method name
+        resolver_name = f"__watiba_resolver_{self.resolver_count}__"
+        self.resolver_count += 1
+
+        # Include promise return if there's an assignment on the stmt
+        promise_assign = parms["match"].group(assign_idx) if parms["match"].group(assign_idx) else ""
+
+        # Promises to wait for (spawn `cmd` args after [p1, p2]:)
+        after = SPAWN_AFTER.search(args) if args else None
+        dependencies = f", after={after.group(1)}" if after else ""
+        args = args[:after.start()].strip() if after else args
+
+        # Add in args if there's any
+        resolver_args = args if args else "{}"
+
+        h = f'"{hostname}"' if hostname[0] != "$" else hostname
+        h = h.replace("$", "") if h and h[0] == "$" else h
+
+        # Queue up async call which is executed (spit out) at the end of the w_spawn block
+        self.spawn_call.append(
+            f'{parms["indentation"]}{promise_assign}{watiba_ref}.spawn({cmd}, {resolver_name}, {resolver_args}, {h}'
+            f'{dependencies})')
+        self.spawn_line.append(self.statement_line)
+
+        # Convert spawn `cmd`: statement to proper Python function definition
+        self.output.append(f'{parms["indentation"]}def {resolver_name}(promise, args):')
+
+    # Generator for `cmd` expressions
+    def backticks_generator(self, parms):
+        s = str(parms["statement"])
+        regex = parms["pattern"]
+
+        # Replace ALL the backticked shell commands with Watiba function calls, in one pass over the statement.  The
+        # calls contain no backticks, so the search for the next command carries on from the end of the last one.
+        # The first match was made on the stripped statement.
+        m = parms["match"]
+        offset = len(s) - len(s.lstrip())
+        generated = []
+        end = 0
+        while m:
+            # This flag control Watiba's CWD tracking
+            context = False if m.group(1) == "-" else True
+            cmd = m.group(2)
+            host = m.group(3)
+
+            # Replace the backticked commands with a Watiba function call
+            if cmd[0] == "$":
+                cmd = cmd[1:]
+            else:
+                quote_style = "'" if cmd.find("'") < 0 else '"'
+                cmd = f"{quote_style}{cmd}{quote_style}"
+
+            # The replaced text runs from the dash, if there is one, to the closing backtick or the host
+            generated.append(s[end:m.start() + offset])
+            if not host:
+                generated.append(f"{watiba_ref}.bash({cmd}, {context})")
+            else:
+                host = host[1:] if host[0] == "$" else f'"{host}"'
+                generated.append(f"{watiba_ref}.ssh({cmd}, {host}, {context})")
+            end = m.end() + offset
+
+            # Test for more backticked commands
+            m = regex.search(s, end)
+            offset = 0
+
+        generated.append(s[end:])
+        self.output.append("".join(generated))
+
+    # Compile the passed statement (one line of source)
+    def compile(self, stmt):
+        # If this is the first statement to compile, keep it to generate the #! version header stuff...
+        if self.first_time:
+            self.output.insert(0, stmt)
+            self.first_time = False
+
+            # It may open a triple-quoted string (a module docstring) like any other line
+            self.open_string = self.string_state(stmt, None)
+            return
+
+        # Lines of a triple-quoted string are string text, not Watiba statements, and pass through untouched
+        if self.open_string or "'''" in stmt or '"""' in stmt:
+            in_string = self.open_string is not None
+            self.open_string = self.string_state(stmt, self.open_string)
+            if in_string:
+                self.stmt_count += 1
+                self.statement_line = self.stmt_count
+                self.output.append(stmt)
+                return
+
+        # A backticked command continued onto the next line with a backslash, like in bash.  The lines are compiled
+        # as one statement.
+        if self.continued is not None:
+            stmt = self.continued + stmt.lstrip()
+            self.continued = None
+        if stmt.endswith("\\") and stmt.count("`") % 2 == 1:
+            self.continued = stmt[:-1]
+            self.continued_lines += 1
+            self.stmt_count += 1
+            return
+
+        self.statement_line = self.stmt_count + 1 - self.continued_lines
+        self.compile_statement(stmt)
+
+        # Blank lines in place of continued lines, so the generated lines still line up with the source lines
+        if self.continued_lines:
+            self.output += [""] * self.continued_lines
+            self.continued_lines = 0
+
+    # The quotes of the triple-quoted string still open at the end of the line (None if there isn't one)
+    # quotes - the quotes of the string open at the start of the line
+    @staticmethod
+    def string_state(line, quotes):
+        pos = 0
+        while True:
+            if quotes:
+                m = STRING_ENDS[quotes].match(line, pos)
+                if not m:
+                    return quotes
+                quotes = None
+            else:
+                m = STRING_TOKENS.search(line, pos)
+                if not m or m.group() == "#":
+                    return None
+                if m.group() in STRING_ENDS:
+                    quotes = m.group()
+            pos = m.end()
+
+    # Compile one whole statement
+    def compile_statement(self, stmt):
+        # Track our current statement
+        self.current_statement = stmt
+
+        # Copy the statement to a local variable
+        s = str(stmt)
+        self.stmt_count += 1
+
+        # Spit out spawn call if it's queued up (on block breaks)
+        if self.spawn_call:
+            # Indention level of current statement
+            stmt_level = len(s) - len(s.lstrip()) if len(s.strip()) > 0 and s.lstrip()[0] != "#" else -1
+
+            # Indention level of last spawn expression
+            spawn_level = len(self.spawn_call[-1]) - len(self.spawn_call[-1].lstrip())
+
+            # If we're on an indention change and there's valid levels to compare,
+            #   check if we're done with the resolver block
+            resolver_level_completed = stmt_level == spawn_level if stmt_level != -1 else False
+
+            # If done with the resolver block, did it terminate with a resolve value?
+            if resolver_level_completed:
+                if re.search("^return ", self.last_stmt.strip()):
+                    self.emit(self.spawn_call.pop(), self.spawn_line.pop())
+                else:
+                    raise WTCompilerException(self, "ERROR: Resolver block not properly terminated with return.\n"
+                                                    f"    Block at line {self.stmt_count} incorrectly terminated with:\n"
+                                                    f"      {self.last_stmt}")
+
+        # One scan of the statement finds the kinds of Watiba expression it may hold.  Most statements are plain Python.
+        stripped = s.strip()
+        found = SCANNER.findall(stripped)
+        if not found:
+            self.output.append(stmt)
+            return
+        kinds = {KINDS[text] for text in found}
+
+        # Try only the expressions of those kinds
+        for kind, expressions in EXPRESSIONS.items():
+            if kind not in kinds:
+                continue
+            for regex, generator in expressions:
+                m = regex.search(stripped)
+
+                # We have a Watiba expression. Generate the code.
+                if m:
+                    return getattr(self, generator)(
+                        {"match": m,
+                         "statement": s,
+                         "pattern": regex,
+                         "indentation": stmt[0:len(stmt) - len(stmt.lstrip())]
+                         })
+
+        self.output.append(stmt)
+
+
+# Compile Watiba source text.  Returns the generated Python source.
+# line_map - optional list, extended with the source line number of each generated line
+# header - generate the Watiba header after the first line (see Compiler)
+def compile_source(source, line_map=None, header=True):
+    lines = []
+    c = Compiler(sink=lines.append, header=header)
+
+    # Same as reading the source from a file, line by line
+    for statement in io.StringIO(source):
+        # Compile this line of input
+        c.compile(statement.rstrip())
+
+        # Collect the output of the compiler
+        c.flush()
+
+    # Flush out any queued spawn statement calls
+    c.flush(final=True)
+
+    if line_map is not None:
+        line_map += c.line_map
+    return "\n".join(lines) + "\n"
+
+
+# Generated Python that has a source map ends with this comment, naming the map file beside it
+SOURCE_MAP_COMMENT = "# watiba-source-map: "
+
+
+# The source map of some generated Python: the .wt source it came from (relative to the Python's directory) and
+# the source line number of each generated line
+def source_map(source_path, python_path, line_map):
+    return json.dumps({"version": 1,
+                       "source": os.path.relpath(source_path, os.path.dirname(os.path.abspath(python_path))),
+                       "lines": line_map})
+
+
+# Generated Python, with the comment pointing at its source map added to the end
+def with_source_map(python, map_path):
+    return f"{python}{SOURCE_MAP_COMMENT}{os.path.basename(map_path)}\n"
+
+
+# Read the source map of a generated Python file.  Returns (source path, line map), or None if it hasn't one.
+def load_source_map(python_path):
+    lines = linecache.getlines(python_path)
+    if not lines or not lines[-1].startswith(SOURCE_MAP_COMMENT):
+        return None
+
+    directory = os.path.dirname(os.path.abspath(python_path))
+    try:
+        with open(os.path.join(directory, lines[-1][len(SOURCE_MAP_COMMENT):].strip())) as f:
+            mapping = json.load(f)
+        return os.path.normpath(os.path.join(directory, mapping["source"])), mapping["lines"]
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+
+
+# Identifies the compiler that generated some code: the package version, plus a hash of this module so a changed
+# compiler is noticed even without a new version number
+def compiler_version():
+    global _compiler_version
+    if not _compiler_version:
+        try:
+            version = importlib.metadata.version("watiba")
+        except importlib.metadata.PackageNotFoundError:
+            version = "dev"
+
+        with open(__file__, "rb") as f:
+            _compiler_version = f"{version}-{hashlib.sha1(f.read()).hexdigest()[:12]}"
+    return _compiler_version
+
+
+_compiler_version = None
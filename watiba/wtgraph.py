@@ -0,0 +1,178 @@
+'''
+Watiba command graph.  Runs a set of commands where some must wait for others (a build or deploy pipeline, say):
+each command starts as soon as every command it depends on has resolved, so independent branches run side by
+side, up to the spawn controller's limits.  Afterwards the critical path, the chain of commands that decided
+how long the whole graph took, can be reported.
+
+    g = _watiba_.graph()
+    g.add("build", "make all")
+    g.add("test", "make test", after=["build"])
+    g.add("docs", "make docs", after=["build"])
+    g.add("deploy", "./deploy.sh", after=["test", "docs"], host="prod1")
+    g.run().join().report()
+
+Author: Ray Walker
+Raythonic@gmail.com
+'''
+
+import sys
+import time
+import threading
+from watiba.wtpromise import WTPromise
+
+
+class WTGraphException(Exception):
+    def __init__(self, graph, message=""):
+        self.graph = graph
+        self.message = message
+
+
+class WTGraph:
+    def __init__(self, watiba):
+        self.watiba = watiba
+        self.nodes = {}  # Name -> {"command", "after", "host", "resolver", "args"}, in the order added
+        self.promises = {}  # Name -> promise, once running
+        self.status = {}  # Name -> "resolved", "failed" or "skipped" (a command it depended on failed)
+        self.done = threading.Condition()
+        self.start_time = None
+        self.end_time = None
+
+    # Add a command to the graph
+    # name - the node's name, used by other nodes' "after"
+    # command - shell command
+    # after - names of the nodes that must resolve before this one starts
+    # host - where to run the command
+    # resolver - resolver function (promise, args) as in spawn.  Default: resolved if the command's exit code is 0.
+    #            In a graph, a resolver that returns False fails the node, and every node after it is skipped.
+    # args - the resolver's args
+    # Returns the graph, so adds can be chained
+    def add(self, name, command, after=(), host="localhost", resolver=None, args=None):
+        if self.promises:
+            raise WTGraphException(self, f"Can't add {name}, the graph is already running")
+        if name in self.nodes:
+            raise WTGraphException(self, f"Duplicate node name: {name}")
+
+        self.nodes[name] = {"command": command, "after": [after] if isinstance(after, str) else list(after),
+                            "host": host, "resolver": resolver, "args": args if args is not None else {}}
+        return self
+
+    # The nodes in an order that puts every node after the nodes it depends on
+    def order(self):
+        waiting = {}
+        dependents = {name: [] for name in self.nodes}
+        for name, node in self.nodes.items():
+            for dependency in node["after"]:
+                if dependency not in self.nodes:
+                    raise WTGraphException(self, f"Node {name} is after {dependency}, which isn't in the graph")
+                dependents[dependency].append(name)
+            waiting[name] = len(set(node["after"]))
+
+        ready = [name for name, count in waiting.items() if count == 0]
+        order = []
+        while ready:
+            name = ready.pop(0)
+            order.append(name)
+            for dependent in dict.fromkeys(dependents[name]):
+                waiting[dependent] -= 1
+                if waiting[dependent] == 0:
+                    ready.append(dependent)
+
+        if len(order) < len(self.nodes):
+            cycle = [name for name in self.nodes if waiting[name] > 0]
+            raise WTGraphException(self, f"Dependency cycle among nodes: {', '.join(cycle)}")
+        return order
+
+    # Start the graph.  Nodes that depend on nothing start right away, the rest as their dependencies resolve.
+    # Returns the graph
+    def run(self):
+        if self.promises:
+            raise WTGraphException(self, "The graph is already running")
+
+        self.start_time = time.time()
+        if not self.nodes:
+            self.end_time = self.start_time
+
+        # (Not "promise": spawn() would take a local of that name for the promise of a resolver block spawning it)
+        for name in self.order():
+            node = self.nodes[name]
+            spawned = self.watiba.spawn(node["command"], self.resolver(node["resolver"]), node["args"], node["host"],
+                                        after=[self.promises[d] for d in dict.fromkeys(node["after"])])
+            self.promises[name] = spawned
+            spawned.on_resolved(lambda p, n=name: self.finish(n, "resolved"),
+                                lambda p, n=name: self.finish(n, "failed" if p.run_start else "skipped"))
+        return self
+
+    # A node's resolver, which fails the node if the command isn't resolved
+    @staticmethod
+    def resolver(user_resolver):
+        def resolve(promise, args):
+            if user_resolver:
+                resolution = user_resolver(promise, args)
+            else:
+                resolution = promise.output.exit_code == 0
+            if resolution is not True:
+                promise.set_failed(f"Exit code {promise.output.exit_code}" if not user_resolver
+                                   else "Resolver did not resolve the promise")
+            return resolution is True
+        return resolve
+
+    # A node has resolved or failed
+    def finish(self, name, status):
+        with self.done:
+            self.status[name] = status
+            if len(self.status) == len(self.nodes):
+                self.end_time = time.time()
+                self.done.notify_all()
+
+    # Whether every node has resolved or failed
+    def finished(self):
+        return len(self.status) == len(self.nodes)
+
+    # Wait for every node to resolve or fail.  Raises WTGraphException if it takes longer than the timeout.
+    # args - {"timeout": seconds}, as promise join()
+    # Returns the graph
+    def join(self, args={}):
+        with self.done:
+            if not self.done.wait_for(self.finished, WTPromise.wait_timeout(args)):
+                raise WTGraphException(self, "Graph not finished by expiration period")
+        return self
+
+    # Names of the nodes with a status: "resolved", "failed" or "skipped"
+    def nodes_with(self, status):
+        with self.done:
+            return [name for name in self.nodes if self.status.get(name) == status]
+
+    # The nodes that decided how long the graph took: from the node that finished last, back through the
+    # dependency that held each node up the longest.  Returns the node names in the order they ran.
+    def critical_path(self):
+        finished = [name for name in self.nodes if self.promises.get(name) and self.promises[name].end_time]
+        if not finished:
+            return []
+
+        names = {id(promise): name for name, promise in self.promises.items()}
+        last = max(finished, key=lambda name: self.promises[name].end_time)
+        return [names[id(p)] for p in self.promises[last].critical_path()]
+
+    # Print the outcome of the graph and its critical path
+    def report(self, file=sys.stderr):
+        resolved, failed, skipped = self.nodes_with("resolved"), self.nodes_with("failed"), self.nodes_with("skipped")
+        elapsed = (self.end_time if self.end_time else time.time()) - self.start_time if self.start_time else 0
+        print(f"Graph: {len(self.nodes)} nodes, {len(resolved)} resolved, {len(failed)} failed, "
+              f"{len(skipped)} skipped, {elapsed:.3f}s", file=file)
+
+        path = self.critical_path()
+        if path:
+            print("Critical path:", file=file)
+            print(f"{'Start(s)':>10} {'Wait(s)':>9} {'Run(s)':>9}  Node", file=file)
+            for name in path:
+                promise = self.promises[name]
+                ready = max([d.end_time for d in promise.dependencies] + [self.start_time])
+                started = promise.run_start if promise.run_start else promise.end_time
+                print(f"{started - self.start_time:10.3f} {started - ready:9.3f} {promise.end_time - started:9.3f}  "
+                      f"{name} ({promise.command})", file=file)
+
+        for name in failed:
+            print(f"Failed: {name}: {self.promises[name].failure}", file=file)
+        if skipped:
+            print(f"Skipped: {', '.join(skipped)}", file=file)
+        return self
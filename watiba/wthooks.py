@@ -0,0 +1,88 @@
+'''
+Watiba hook index.  Narrows the hook patterns down to those that could match a command, so a command that
+matches no hooks is turned away without trying every pattern.
+
+Author: Ray Walker
+Raythonic@gmail.com
+'''
+
+import re
+
+# Pattern characters that end a literal prefix
+SPECIAL = set(".^$*+?{}[]\\|()")
+
+# Patterns that can't be merged into one alternation: backreferences and conditionals (group numbers shift once
+# merged), named groups (names may clash) and inline flags (only allowed at the very start)
+UNCOMBINABLE = re.compile(r'\\[1-9]|\(\?P[<=]|\(\?<[^=!]|\(\?\(|\(\?[aiLmsux]+\)')
+
+
+# The hooks of one kind (pre or post), indexed so a command is only tried against patterns that could match it:
+#   - patterns that start with literal text are looked up by that text
+#   - the rest are merged into one regex of alternatives, so if none of them match it takes one pass to find out
+class WTHookIndex:
+    def __init__(self, patterns):
+        # [(pattern, compiled regex)] in the order hooks run
+        self.patterns = patterns
+
+        # Literal prefix -> [position in patterns], and the prefix lengths to look up
+        self.prefixes = {}
+        self.prefix_lengths = []
+
+        # Positions of patterns with no literal prefix, merged into self.combined
+        self.combined_positions = []
+
+        # Positions of patterns with no literal prefix that can't be merged.  Always tried on their own.
+        self.fallback = []
+
+        combinable = []
+        for position, (pattern, regex) in enumerate(patterns):
+            prefix = self.literal_prefix(pattern)
+            if prefix:
+                self.prefixes.setdefault(prefix, []).append(position)
+            elif UNCOMBINABLE.search(pattern):
+                self.fallback.append(position)
+            else:
+                self.combined_positions.append(position)
+                combinable.append(pattern)
+        self.prefix_lengths = sorted({len(prefix) for prefix in self.prefixes})
+
+        try:
+            self.combined = re.compile("|".join(f"(?:{p})" for p in combinable)) if combinable else None
+        except re.error:
+            # Something in a pattern didn't survive being merged.  Try them on their own.
+            self.combined = None
+            self.fallback = sorted(self.fallback + self.combined_positions)
+            self.combined_positions = []
+
+    # The literal text every match of the pattern starts with ("" if there isn't any)
+    @staticmethod
+    def literal_prefix(pattern):
+        # An alternation anywhere means the pattern may start more than one way
+        if "|" in pattern:
+            return ""
+
+        prefix = []
+        for c in pattern.lstrip("^"):
+            if c in SPECIAL:
+                # A quantifier makes the character before it optional or repeated
+                if c in "*?{" and prefix:
+                    prefix.pop()
+                break
+            prefix.append(c)
+        return "".join(prefix)
+
+    # The (pattern, compiled regex) pairs that could match the command, in the order hooks run
+    def candidates(self, command):
+        positions = []
+        for length in self.prefix_lengths:
+            if length > len(command):
+                break
+            positions += self.prefixes.get(command[:length], ())
+
+        if self.combined is not None and self.combined.match(command):
+            positions += self.combined_positions
+        positions += self.fallback
+
+        if not positions:
+            return []
+        return [self.patterns[p] for p in sorted(positions)]
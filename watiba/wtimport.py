@@ -0,0 +1,188 @@
+'''
+Watiba import hook.  Lets Python import .wt modules directly: they're compiled on import, and the generated
+Python and its bytecode are cached in __pycache__ so later imports skip the compile.
+
+    import watiba
+    watiba.install_import_hook()
+    import my_tools        # finds my_tools.wt on sys.path
+
+The cache is keyed on a hash of the .wt source plus the compiler version, so it's rebuilt whenever either
+changes and never goes stale because of file times.
+
+Author: Ray Walker
+Raythonic@gmail.com
+'''
+
+import os
+import sys
+import marshal
+import hashlib
+import importlib.abc
+import importlib.util
+import importlib.machinery
+from watiba.wtcompiler import compile_source, compiler_version, source_map, with_source_map
+from watiba.wtrun import script_globals
+
+
+# Finds .wt modules and packages (directories with an __init__.wt) on sys.path or a package's __path__
+class WTImportFinder(importlib.abc.MetaPathFinder):
+    def __init__(self):
+        self.listings = {}  # Directory -> (its modification time, the names in it)
+
+    def find_spec(self, fullname, path, target=None):
+        name = fullname.rpartition(".")[2]
+        wt_name = f"{name}.wt"
+
+        for entry in path if path is not None else sys.path:
+            entry = entry if entry else os.getcwd()
+            names = self.listing(entry) if isinstance(entry, str) else None
+
+            # Most imports are of Python modules, and most directories have nothing of the name at all
+            if not names or (name not in names and wt_name not in names):
+                continue
+
+            # A Python module or package earlier on the path, or beside the .wt, is the one imported
+            if self.python_module(entry, name, names):
+                return None
+
+            package = os.path.join(entry, name, "__init__.wt")
+            if name in names and os.path.isfile(package):
+                return importlib.util.spec_from_file_location(fullname, package,
+                                                              loader=WTImportLoader(fullname, package),
+                                                              submodule_search_locations=[os.path.dirname(package)])
+
+            module = os.path.join(entry, wt_name)
+            if wt_name in names and os.path.isfile(module):
+                return importlib.util.spec_from_file_location(fullname, module,
+                                                              loader=WTImportLoader(fullname, module))
+        return None
+
+    # The names in a directory, listed again only when the directory changes.  None if it isn't a directory.
+    def listing(self, entry):
+        try:
+            mtime = os.stat(entry).st_mtime_ns
+        except (OSError, ValueError):
+            return None
+        cached = self.listings.get(entry)
+        if cached and cached[0] == mtime:
+            return cached[1]
+        try:
+            names = frozenset(os.listdir(entry))
+        except (OSError, ValueError):
+            return None
+        self.listings[entry] = (mtime, names)
+        return names
+
+    # Forget the directory listings.  Called by importlib.invalidate_caches(), for files written within the
+    # directory's time stamp resolution.
+    def invalidate_caches(self):
+        self.listings = {}
+
+    # Whether a regular Python module or package of this name is in the directory
+    @staticmethod
+    def python_module(entry, name, names):
+        for suffix in importlib.machinery.all_suffixes():
+            if name + suffix in names or \
+                    (name in names and os.path.isfile(os.path.join(entry, name, "__init__" + suffix))):
+                return True
+        return False
+
+
+# Compiles a .wt module, or loads it from the cache
+class WTImportLoader(importlib.abc.Loader):
+    # Marks a Watiba cache file, and the version of its layout
+    MAGIC = b"WTC1"
+
+    def __init__(self, fullname, path):
+        self.fullname = fullname
+        self.path = path
+
+    def create_module(self, spec):
+        # Default module creation
+        return None
+
+    def exec_module(self, module):
+        exec(self.get_code(self.fullname), script_globals(module.__dict__))
+
+    def get_filename(self, fullname):
+        return self.path
+
+    # The generated Python source
+    def get_source(self, fullname):
+        with open(self.path, "rb") as f:
+            python = compile_source(importlib.util.decode_source(f.read()), header=False)
+        return with_source_map(python, f"{self.cache_paths()[1]}.map")
+
+    # Where the generated Python and bytecode for this module are cached
+    def cache_paths(self):
+        base, _ = os.path.splitext(os.path.basename(self.path))
+        cache_dir = os.path.join(os.path.dirname(self.path), "__pycache__")
+        name = f"{base}.{sys.implementation.cache_tag}.wt"
+        return cache_dir, os.path.join(cache_dir, f"{name}.py"), os.path.join(cache_dir, f"{name}.pyc")
+
+    def get_code(self, fullname):
+        with open(self.path, "rb") as f:
+            source = f.read()
+
+        key = hashlib.sha256(source + b"\0" + compiler_version().encode()).hexdigest().encode()
+        cache_dir, py_path, pyc_path = self.cache_paths()
+
+        # Cache hit: the bytecode was generated from this exact source by this exact compiler
+        try:
+            with open(pyc_path, "rb") as f:
+                data = f.read()
+            header = header_bytes(self.MAGIC, key)
+            if data.startswith(header):
+                return marshal.loads(data[len(header):])
+        except (OSError, ValueError, EOFError, TypeError):
+            pass
+
+        # Compile.  The code is attributed to the cached .py, so tracebacks show the generated lines, and the .py's
+        # source map leads back to the .wt lines.
+        line_map = []
+        python = with_source_map(compile_source(importlib.util.decode_source(source), line_map, header=False), f"{py_path}.map")
+        code = compile(python, py_path, "exec", dont_inherit=True)
+
+        if not sys.dont_write_bytecode:
+            try:
+                os.makedirs(cache_dir, exist_ok=True)
+                self.write_atomic(f"{py_path}.map", source_map(self.path, py_path, line_map).encode("utf-8"))
+                self.write_atomic(py_path, python.encode("utf-8"))
+                self.write_atomic(pyc_path, header_bytes(self.MAGIC, key) + marshal.dumps(code))
+            except OSError:
+                # Read-only or otherwise unwritable location.  The module still imports, just without the cache.
+                pass
+
+        return code
+
+    # Write a cache file so a concurrent import never sees it half written
+    @staticmethod
+    def write_atomic(path, data):
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+
+
+# Header of a cache bytecode file: Watiba's marker, Python's bytecode magic number and the cache key
+def header_bytes(magic, key):
+    return magic + importlib.util.MAGIC_NUMBER + key + b"\n"
+
+
+_finder = WTImportFinder()
+
+
+# Let import find .wt modules.  The finder goes ahead of Python's path finder, or a directory holding only an
+# __init__.wt would be taken for a namespace package, but it steps aside for regular Python modules.
+def install_import_hook():
+    if _finder not in sys.meta_path:
+        position = sys.meta_path.index(importlib.machinery.PathFinder) \
+            if importlib.machinery.PathFinder in sys.meta_path else len(sys.meta_path)
+        sys.meta_path.insert(position, _finder)
+    return _finder
+
+
+# Stop import from finding .wt modules
+def remove_import_hook():
+    if _finder in sys.meta_path:
+        sys.meta_path.remove(_finder)
@@ -0,0 +1,188 @@
+'''
+Watiba metrics.  A process-wide registry of counters, gauges and histograms for the commands Watiba runs, labelled
+by host and by hook pattern, so it can be seen where shell time goes in a long-running program.  It can be dumped
+as JSON, or as a Prometheus text file for node_exporter's textfile collector (or anything else that reads the
+Prometheus text format).
+
+Turned on with watiba-ctl {"metrics": True}, or by setting WATIBA_METRICS=1 in the environment.
+
+Author: Ray Walker
+Raythonic@gmail.com
+'''
+
+import os
+import json
+import atexit
+import bisect
+import threading
+
+# Histogram bucket upper bounds, in seconds
+BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60, 300)
+
+# Every metric the registry keeps: name -> (type, help)
+METRICS = {
+    "watiba_commands_total": ("counter", "Commands run, by host and status (ok or failed)"),
+    "watiba_command_seconds": ("histogram", "Time commands ran, hooks not included"),
+    "watiba_command_cpu_seconds_total": ("counter", "CPU time of command processes, by mode (user or system)"),
+    "watiba_command_max_rss_bytes": ("gauge", "Largest resident set size of any command process"),
+    "watiba_output_bytes_total": ("counter", "Bytes of output commands wrote, by stream"),
+    "watiba_spawn_latency_seconds": ("histogram", "Time from spawn to the command starting, queueing included"),
+    "watiba_hook_seconds": ("histogram", "Time hook functions ran, by pattern and phase (pre or post)"),
+    "watiba_hook_failures_total": ("counter", "Hook functions that didn't return True, by pattern and phase"),
+    "watiba_cache_requests_total": ("counter", "Commands opted in to the command cache, by host and result "
+                                               "(hit, miss or coalesced)"),
+}
+
+
+class WTMetricsException(Exception):
+    def __init__(self, metrics, message=""):
+        self.metrics = metrics
+        self.message = message
+
+
+class WTMetrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.values = {}  # (name, labels as sorted tuple of pairs) -> number, or histogram dict
+        self.file = None  # Written at exit, if set
+        self.registered = False
+
+    # Add to a counter
+    def count(self, name, labels, value=1):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+    # Raise a gauge to the value, if it's higher
+    def maximum(self, name, labels, value):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.values[key] = max(self.values.get(key, value), value)
+
+    # Add a sample to a histogram
+    def observe(self, name, labels, value):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.values.get(key)
+            if not histogram:
+                histogram = self.values[key] = {"buckets": [0] * len(BUCKETS), "count": 0, "sum": 0.0}
+            position = bisect.bisect_left(BUCKETS, value)
+            if position < len(BUCKETS):
+                histogram["buckets"][position] += 1
+            histogram["count"] += 1
+            histogram["sum"] += value
+
+    # Record a command's output object
+    # parms - the Watiba parameters (the file written at exit is taken from them)
+    def record_output(self, out, host, parms):
+        labels = {"host": host}
+        self.count("watiba_commands_total", {**labels, "status": "ok" if out.exit_code == 0 else "failed"})
+        self.observe("watiba_command_seconds", labels, out.run_time)
+        self.count("watiba_output_bytes_total", {**labels, "stream": "stdout"}, out.stdout_bytes)
+        self.count("watiba_output_bytes_total", {**labels, "stream": "stderr"}, out.stderr_bytes)
+        if out.rusage:
+            self.count("watiba_command_cpu_seconds_total", {**labels, "mode": "user"}, out.user_cpu)
+            self.count("watiba_command_cpu_seconds_total", {**labels, "mode": "system"}, out.sys_cpu)
+            self.maximum("watiba_command_max_rss_bytes", labels, out.peak_rss)
+        self.write_at_exit(parms)
+
+    # Record a hook function's call
+    def record_hook(self, pattern, post_hook, seconds, success, parms):
+        labels = {"pattern": pattern, "phase": "post" if post_hook else "pre"}
+        self.observe("watiba_hook_seconds", labels, seconds)
+        if not success:
+            self.count("watiba_hook_failures_total", labels)
+        self.write_at_exit(parms)
+
+    # Record how long a spawned command waited to start
+    def record_spawn(self, host, latency, parms):
+        self.observe("watiba_spawn_latency_seconds", {"host": host}, latency)
+        self.write_at_exit(parms)
+
+    # Record a request for a command opted in to the command cache
+    def record_cache(self, host, result, parms):
+        self.count("watiba_cache_requests_total", {"host": host, "result": result})
+        self.write_at_exit(parms)
+
+    # Pick up watiba-ctl "metrics-file", to be written when the program exits
+    def write_at_exit(self, parms):
+        self.file = parms["metrics-file"]
+        if self.file and not self.registered:
+            atexit.register(self.write_exit_file)
+            self.registered = True
+
+    def write_exit_file(self):
+        if self.file:
+            self.write(self.file)
+
+    # Forget every metric
+    def reset(self):
+        with self.lock:
+            self.values = {}
+
+    # The metrics as a dict: {name: {"type", "help", "samples": [{"labels", "value"}, ...]}}.  A histogram
+    # sample's value is {"count", "sum", "buckets": {upper bound: cumulative count, ...}}.
+    def to_dict(self):
+        with self.lock:
+            values = [(name, labels, dict(value, buckets=list(value["buckets"])) if isinstance(value, dict)
+                       else value) for (name, labels), value in self.values.items()]
+
+        result = {}
+        for name, labels, value in sorted(values, key=lambda v: (v[0], v[1])):
+            kind, description = METRICS[name]
+            metric = result.setdefault(name, {"type": kind, "help": description, "samples": []})
+            if kind == "histogram":
+                total = 0
+                buckets = {}
+                for bound, count in zip(BUCKETS, value["buckets"]):
+                    total += count
+                    buckets[str(bound)] = total
+                buckets["+Inf"] = value["count"]
+                value = {"count": value["count"], "sum": value["sum"], "buckets": buckets}
+            metric["samples"].append({"labels": dict(labels), "value": value})
+        return result
+
+    def json(self):
+        return json.dumps(self.to_dict(), indent=2)
+
+    # The metrics in the Prometheus text exposition format
+    def prometheus(self):
+        lines = []
+        for name, metric in self.to_dict().items():
+            lines.append(f"# HELP {name} {metric['help']}")
+            lines.append(f"# TYPE {name} {metric['type']}")
+            for sample in metric["samples"]:
+                labels, value = sample["labels"], sample["value"]
+                if metric["type"] != "histogram":
+                    lines.append(f"{name}{label_text(labels)} {value}")
+                    continue
+                for bound, count in value["buckets"].items():
+                    lines.append(f"{name}_bucket{label_text({**labels, 'le': bound})} {count}")
+                lines.append(f"{name}_sum{label_text(labels)} {value['sum']}")
+                lines.append(f"{name}_count{label_text(labels)} {value['count']}")
+        return "\n".join(lines) + "\n" if lines else ""
+
+    # Write the metrics to a file: Prometheus text if it's named .prom, otherwise JSON.  The file is replaced in
+    # one step, so a collector never reads half of it.
+    def write(self, path):
+        text = self.prometheus() if path.endswith(".prom") else self.json()
+        temp = f"{path}.{os.getpid()}.tmp"
+        try:
+            with open(temp, "w") as f:
+                f.write(text)
+            os.replace(temp, path)
+        except OSError as ex:
+            raise WTMetricsException(self, f"Can't write metrics to {path}: {ex}")
+
+
+# Prometheus labels: {name="value",...}, with the value's backslashes, quotes and newlines escaped
+def label_text(labels):
+    if not labels:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+               for value in labels.values())
+    return "{" + ",".join(f'{name}="{value}"' for name, value in zip(labels, escaped)) + "}"
+
+
+# The registry every Watiba object records to
+metrics = WTMetrics()
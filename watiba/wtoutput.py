@@ -1,7 +1,59 @@
+import sys
+
+
 # The object returned to the caller of _watiba_ for command results
 class WTOutput(Exception):
     def __init__(self):
         self.stdout = []
         self.stderr = []
         self.exit_code = 0
-        self.cwd = "."
\ No newline at end of file
+        self.cwd = "."
+
+        # Resource usage of the command's process, from os.wait4() (None when it ran in the shell session)
+        self.rusage = None
+
+        # Bytes of output the command wrote to STDOUT and STDERR (in the shell session, the bytes kept of it)
+        self.output_bytes = 0
+        self.stdout_bytes = 0
+        self.stderr_bytes = 0
+
+        # Timings, in seconds
+        self.run_time = 0.0  # From starting the command to its exit, hooks not included
+        self.hook_time = 0.0  # Pre and post hooks (post hooks running in the background aren't counted)
+        self.spawn_latency = None  # Spawned commands only: from spawn to the command starting, queueing included
+
+        # True when the output came from the command cache (or from an identical command running at the same time)
+        # rather than from running the command
+        self.cached = False
+
+        # Future of the post hooks' results when they run in the background (watiba-ctl "async-post-hooks")
+        self.post_hooks = None
+
+    # User CPU seconds of the command's process (None when it ran in the shell session)
+    @property
+    def user_cpu(self):
+        return self.rusage.ru_utime if self.rusage else None
+
+    # System CPU seconds of the command's process
+    @property
+    def sys_cpu(self):
+        return self.rusage.ru_stime if self.rusage else None
+
+    # Peak resident set size of the command's process, in bytes
+    @property
+    def peak_rss(self):
+        if not self.rusage:
+            return None
+        return self.rusage.ru_maxrss * (1 if sys.platform == "darwin" else 1024)
+
+    # STDOUT exactly as the command wrote it, as bytes.  Use this for binary output.
+    @property
+    def raw(self):
+        if hasattr(self.stdout, "raw"):
+            return self.stdout.raw
+        return "\n".join(self.stdout).encode('utf-8')
+
+    # Wait for post hooks running in the background, if any.  Raises the exception bash() would have raised had
+    # they run before it returned.
+    def wait_post_hooks(self, timeout=None):
+        return self.post_hooks.result(timeout) if self.post_hooks else None
@@ -0,0 +1,195 @@
+'''
+Watiba profiler.  Times the shell commands a script runs and charges them to the line of the script that ran
+them: wall time, CPU time of the command's processes, bytes of output and exit codes.  At exit, the lines are
+printed hottest first.
+
+Turned on with watiba-ctl {"profile": True}, or by setting WATIBA_PROFILE=1 in the environment.  Lines of
+generated Python are reported as .wt lines when the generated code has a source map (watiba-c --source-map,
+the import hook), or when the script was run with watiba-run.
+
+Author: Ray Walker
+Raythonic@gmail.com
+'''
+
+import os
+import sys
+import time
+import atexit
+import functools
+import threading
+import linecache
+import contextvars
+from collections import Counter
+from watiba.wtcompiler import load_source_map
+
+# Outputs of the commands run under the profiled call in progress.  Set while one is running, so the calls it
+# makes itself (ssh() calls bash(), chain() calls ssh(), hooks run commands...) are charged to it, not counted twice.
+collected = contextvars.ContextVar("watiba_profile", default=None)
+
+
+class WTProfiler:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.sites = {}  # (file, line) -> stats
+        self.file = None  # Report destination, None for STDERR
+        self.top = 20  # Lines in the report
+        self.registered = False
+
+    # Where a profiled call was made from
+    @staticmethod
+    def site(frame):
+        return frame.f_code.co_filename, frame.f_lineno
+
+    # Run a command call, charging its time and the commands it ran to the site it was called from
+    # run - function making the call
+    # parms - the Watiba parameters (the report settings are taken from them)
+    def measure(self, site, kind, command, run, parms):
+        outputs = []
+        token = collected.set(outputs)
+        result = None
+        start = time.perf_counter()
+        try:
+            result = run()
+            return result
+        finally:
+            wall = time.perf_counter() - start
+            collected.reset(token)
+            self.file = parms["profile-file"]
+            self.top = parms["profile-top"]
+            self.record(site, kind, command, wall, outputs, result)
+
+    def record(self, site, kind, command, wall, outputs, result):
+        # The exit code that stands for the call: the command's own, or the first failure of the commands it ran
+        if hasattr(result, "exit_code"):
+            exit_code = result.exit_code
+        elif outputs:
+            exit_code = next((o.exit_code for o in outputs if o.exit_code != 0), 0)
+        else:
+            exit_code = None  # Raised before running anything
+
+        cpu = sum(o.rusage.ru_utime + o.rusage.ru_stime for o in outputs if o.rusage)
+        size = sum(o.output_bytes for o in outputs)
+
+        with self.lock:
+            stats = self.sites.get(site)
+            if not stats:
+                stats = self.sites[site] = {"kind": kind, "command": command, "calls": 0, "wall": 0.0, "max": 0.0,
+                                            "cpu": 0.0, "bytes": 0, "exit-codes": Counter()}
+                if not self.registered:
+                    atexit.register(self.report)
+                    self.registered = True
+
+            stats["calls"] += 1
+            stats["wall"] += wall
+            stats["max"] = max(stats["max"], wall)
+            stats["cpu"] += cpu
+            stats["bytes"] += size
+            stats["exit-codes"][exit_code] += 1
+
+    # The statistics per script line, hottest (most wall time) first.  Lines of generated Python are mapped to
+    # the .wt lines they came from where there's a source map to do it with.
+    # Returns list of dicts: file, line, kind, command, calls, wall, max, cpu, bytes, failed, exit-codes
+    def stats(self):
+        with self.lock:
+            sites = [(site, {**stats, "exit-codes": Counter(stats["exit-codes"])})
+                     for site, stats in self.sites.items()]
+
+        maps = {}
+        lines = {}
+        for (filename, line), stats in sites:
+            if filename not in maps:
+                maps[filename] = load_source_map(filename) if not filename.endswith(".wt") else None
+            if maps[filename]:
+                source, line_map = maps[filename]
+                filename, line = source, line_map[line - 1] if 0 < line <= len(line_map) else line
+
+            # A statement the compiler turned into several lines comes back together
+            total = lines.get((filename, line))
+            if not total:
+                lines[(filename, line)] = {"file": filename, "line": line, **stats}
+                continue
+            for key in ("calls", "wall", "cpu", "bytes"):
+                total[key] += stats[key]
+            total["max"] = max(total["max"], stats["max"])
+            total["exit-codes"] += stats["exit-codes"]
+
+        for stats in lines.values():
+            stats["failed"] = sum(n for code, n in stats["exit-codes"].items() if code != 0)
+        return sorted(lines.values(), key=lambda s: s["wall"], reverse=True)
+
+    # Forget everything profiled so far
+    def reset(self):
+        with self.lock:
+            self.sites = {}
+
+    # Print the hottest lines
+    def report(self, file=None, top=None):
+        stats = self.stats()
+        if not stats:
+            return
+
+        top = top if top is not None else self.top
+        destination = file if file is not None else self.file
+        if isinstance(destination, str):
+            with open(destination, "w") as f:
+                self.write_report(f, stats, top)
+        else:
+            self.write_report(destination if destination else sys.stderr, stats, top)
+
+    @staticmethod
+    def write_report(f, stats, top):
+        print(f"Watiba profile: {sum(s['calls'] for s in stats)} commands from {len(stats)} lines, "
+              f"{sum(s['wall'] for s in stats):.3f}s", file=f)
+        print(f"{'Wall(s)':>9} {'Calls':>6} {'Avg(ms)':>9} {'Max(ms)':>9} {'CPU(s)':>8} {'Bytes':>9} "
+              f"{'Failed':>6}  {'Kind':<6} Line", file=f)
+
+        for s in stats[:top]:
+            failures = ", ".join(f"exit {code} x{n}" if code is not None else f"raised x{n}"
+                                 for code, n in sorted(s["exit-codes"].items(), key=lambda c: str(c[0]))
+                                 if code != 0)
+            print(f"{s['wall']:9.3f} {s['calls']:6} {s['wall'] / s['calls'] * 1000:9.1f} {s['max'] * 1000:9.1f} "
+                  f"{s['cpu']:8.3f} {size_text(s['bytes']):>9} {s['failed']:6}  {s['kind']:<6} "
+                  f"{os.path.relpath(s['file'])}:{s['line']}" + (f"  ({failures})" if failures else ""), file=f)
+
+            # The script's own text for the line, or else the command as run
+            text = linecache.getline(s["file"], s["line"]).strip() or s["command"]
+            print(f"{'':>9} {text if len(text) <= 100 else text[:97] + '...'}", file=f)
+
+        if len(stats) > top:
+            print(f"... {len(stats) - top} more lines", file=f)
+
+
+# Bytes, in the largest unit that keeps the number under 1024
+def size_text(size):
+    for unit in ("B", "KB", "MB", "GB"):
+        if size < 1024 or unit == "GB":
+            return f"{size:.0f} {unit}" if unit == "B" else f"{size:.1f} {unit}"
+        size /= 1024
+
+
+# The profiler every Watiba object reports to, so a script gets one report however many it creates
+profiler = WTProfiler()
+
+
+# Profile a Watiba command method (bash, ssh, chain...).  With profiling off it's a straight call.
+# kind - name shown in the report
+def profiled(kind):
+    def decorate(method):
+        @functools.wraps(method)
+        def call(watiba, command, *args, **kwargs):
+            outputs = collected.get()
+            if outputs is None:
+                if not watiba.parms["profile"]:
+                    return method(watiba, command, *args, **kwargs)
+
+                # Charge the call, and everything it runs, to the line that called it
+                return profiler.measure(profiler.site(sys._getframe(1)), kind, command,
+                                        lambda: call(watiba, command, *args, **kwargs), watiba.parms)
+
+            # Running on behalf of a profiled call.  Every command ends up in bash(), so that's where it's collected.
+            result = method(watiba, command, *args, **kwargs)
+            if kind == "bash":
+                outputs.append(result)
+            return result
+        return call
+    return decorate
@@ -7,8 +7,11 @@ Raythonic@gmail.com
 
 import sys
 import time
+import asyncio
 import threading
+import traceback
 from watiba.wtoutput import WTOutput
+from watiba.wtwatcher import WTWatch, watch_scheduler
 
 
 class WTWaitException(Exception):
@@ -25,18 +28,48 @@ class WTKillException(Exception):
 
 # The object returned for Watbia thread spawns
 class WTPromise(Exception):
+    # Guards resolution state and the tree stats.  Shared by all promise trees since a promise can be
+    # related to a parent after it's created.
+    tree_lock = threading.RLock()
+
     def __init__(self, command, host="localhost"):
         self.output = None
         self.host = host
         self.resolution = False
+        self.done = threading.Condition(WTPromise.tree_lock)  # Notified as this subtree's promises resolve
+        self.async_waiters = []  # (event loop, future, predicate) for ajoin() and await
+        self.task = None  # asyncio task running the command, for promises from Watiba.aspawn()
+
+        # Counts for the whole tree, kept by its root.  Kept current as promises are related, run and resolve, so
+        # tree statistics never need a walk of the tree, and an update costs the same however deep the tree is.
+        #   total - promises
+        #   resolved - resolved promises
+        #   running - commands executing now
+        #   failed - commands that completed with a non-zero exit code
+        # own - the same counts for just this promise, for the statistics of a subtree (see tree_stats())
+        self.stats = {"total": 1, "resolved": 0, "running": 0, "failed": 0}
+        self.own = dict(self.stats)
+
+        # This promise, if it's unresolved, plus its children whose subtrees aren't fully resolved.  Zero once the
+        # whole subtree has resolved.  A promise resolving only changes its ancestors' counts as far up as subtrees
+        # become fully resolved.
+        self.pending = 1
         self.start_time = time.time()
         self.end_time = None
+        self.run_start = None  # When the command started running, and when it completed
+        self.run_end = None
+        self.failure = None  # Why the promise can never resolve (see set_failed())
+        self.declined = False  # The resolver returned without resolving the promise
+        self.dependencies = []  # Promises that had to resolve before the command could start (spawn ... after)
+        self.callbacks = []  # (on resolved, on failed) functions, see on_resolved()
         self.thread = None
         self.thread_id = None
         self.killed = False
-        self.watcher = None
+        self.watcher = None  # Most recent watch
+        self.watches = []  # Watches to cancel once resolved
         self.children = []
         self.parent = None
+        self.root = self
         self.command = command
         self.depth = 0
         self.__WTPROMISE_STAMP__ = True
@@ -54,7 +87,145 @@ class WTPromise(Exception):
     # The OR is to ensure we don't override a resolved promise from a race condition!
     # once some thread marks it resolved, it's resolved.
     def set_resolution(self, resolution):
-        self.resolution |= resolution if type(resolution) == "bool" else print(f"ERROR: Watiba resolver block returned non-bool value: {type(resolution)}")
+        if not isinstance(resolution, bool):
+            print(f"ERROR: Watiba resolver block returned non-bool value: {type(resolution)}")
+            resolution = False
+
+        with self.tree_lock:
+            if self.resolution:
+                return
+
+            if not resolution:
+                # The resolver returned without resolving.  The promise may still be resolved later (e.g. by a
+                # child's resolve_parent()), but spawns waiting to start after it give up now, not wait forever.
+                self.declined = True
+                callbacks, self.callbacks = self.callbacks, []
+            else:
+                callbacks = None
+
+        if callbacks is not None:
+            self.run_callbacks([failed for _, failed in callbacks if failed])
+            return
+
+        with self.tree_lock:
+            if self.resolution:
+                return
+            self.resolution = True
+            self.end_time = self.end_time if self.end_time else time.time()
+            self.tally(resolved=1)
+
+            for watch in self.watches:
+                watch.cancel()
+
+            # Wake wait() on this promise, and join() on any promise whose subtree is now fully resolved
+            self.done.notify_all()
+            self.notify_async()
+            self.settle(-1)
+
+            callbacks, self.callbacks = self.callbacks, []
+
+        # Called outside the lock, they're free to spawn, resolve or wait on other promises
+        self.run_callbacks([resolved for resolved, _ in callbacks])
+
+    # Getter to check whether the promise failed (see set_failed())
+    def failed(self):
+        return self.failure is not None
+
+    # Mark the promise as one that will never resolve: its command or resolver raised, or a promise it had to wait
+    # for failed.  Calls the on failed callbacks.  join() and wait() still wait for resolution, "await promise"
+    # raises the failure.
+    # reason - the exception, or a message
+    def set_failed(self, reason):
+        with self.tree_lock:
+            if self.resolution or self.failure is not None:
+                return
+            self.failure = reason
+            self.end_time = time.time()
+            callbacks, self.callbacks = self.callbacks, []
+            self.notify_async()
+
+        self.run_callbacks([failed for _, failed in callbacks if failed])
+
+    # Call callback(promise) when this promise resolves, or on_failed(promise) if it fails or its resolver returns
+    # without resolving it.  Called right away if that has already happened.  Callbacks run on the thread that
+    # resolved (or failed) the promise.
+    def on_resolved(self, callback, on_failed=None):
+        with self.tree_lock:
+            if not self.resolution and self.failure is None and not self.declined:
+                self.callbacks.append((callback, on_failed))
+                return
+
+        self.run_callbacks([callback] if self.resolution else [on_failed] if on_failed else [])
+
+    def run_callbacks(self, callbacks):
+        for callback in callbacks:
+            try:
+                callback(self)
+            except Exception:
+                # Like an uncaught exception in a thread: reported, and the other callbacks still run
+                traceback.print_exc()
+
+    # The chain of dependencies that held this promise up the longest: each promise's slowest dependency (the
+    # last to resolve), back to one that depended on nothing.  Ends with this promise.
+    def critical_path(self):
+        path = [self]
+        while path[-1].dependencies:
+            path.append(max(path[-1].dependencies, key=lambda p: p.end_time if p.end_time else float("inf")))
+        return path[::-1]
+
+    # Wake asyncio waiters whose condition is now met.  They may be on any thread's event loop.
+    def notify_async(self):
+        for waiter in [w for w in self.async_waiters if w[2]()]:
+            self.async_waiters.remove(waiter)
+            loop, future, _ = waiter
+            loop.call_soon_threadsafe(self.wake, future)
+
+    @staticmethod
+    def wake(future):
+        if not future.done():
+            future.set_result(True)
+
+    # Unresolved promises in this promise's subtree
+    def unresolved(self):
+        stats = self.tree_stats(start_at_top=False)
+        return stats["total"] - stats["resolved"]
+
+    # Is every promise in this promise's subtree resolved?
+    def subtree_resolved(self):
+        return self.pending == 0
+
+    # Add to this promise's counts, and its tree's
+    def tally(self, **counts):
+        with self.tree_lock:
+            stats = self.root.stats
+            for name, count in counts.items():
+                self.own[name] += count
+                stats[name] += count
+
+    # Change this promise's pending count.  A subtree that's now fully resolved (or no longer is) changes its
+    # parent's count in turn, and so on up.  join() waiting on a subtree now fully resolved is woken.
+    def settle(self, change):
+        node = self
+        while node:
+            was_resolved = node.pending == 0
+            node.pending += change
+            if (node.pending == 0) == was_resolved:
+                return
+            if not was_resolved:
+                node.done.notify_all()
+                node.notify_async()
+            change = 1 if was_resolved else -1
+            node = node.parent
+
+    # The promise's command has started
+    def set_running(self):
+        self.run_start = time.time()
+        self.tally(running=1)
+
+    # The promise's command has completed
+    def set_completed(self, failed=False):
+        self.run_end = time.time()
+        self.tally(running=-1, failed=1 if failed else 0)
 
 
     ####################################################################################################################
@@ -78,45 +249,56 @@ class WTPromise(Exception):
 
     # Count this promise's children
     def child_counter(self, child, count, resolved_only=False):
-        # Count 1 if not counting just resolved, otherwise only count it if it's resolved
-        count += 1 if not resolved_only or child.resolved() else 0
-
-        # Count these children (descend)
-        for c in child.children:
-            count = self.child_counter(c, count, resolved_only)
-
-        return count
+        return count + child.tree_stats(start_at_top=False)["resolved" if resolved_only else "total"]
 
     # Count promise tree size
     # Set resolved_only to True to only count resolved promises in the tree
     def spawn_count(self, resolved_only=False, start_at_top=True):
-        # Start with this promise
-        p = self
-
-        # Walk to the top of the tree
-        while start_at_top and p.parent:
-            p = p.parent
-
-        # Count this promise
-        count = 1 if not resolved_only or p.resolved() else 0
-
-        # Now do a descending count down the tree
-        for child in p.children:
-            count = self.child_counter(child, count, resolved_only)
-
-        return count
+        return self.tree_stats(start_at_top)["resolved" if resolved_only else "total"]
 
     # Count resolve promises in tree
     def resolved_count(self, start_at_top=True):
-        # Full tree count?
-        return self.spawn_count(resolved_only=True, start_at_top=True)
+        return self.spawn_count(resolved_only=True, start_at_top=start_at_top)
+
+    # Snapshot of the stats for the whole tree, or for this promise's subtree.  The whole tree's are kept, a
+    # subtree's (other than the whole tree) are added up from its promises.
+    def tree_stats(self, start_at_top=True):
+        with self.tree_lock:
+            if start_at_top or self.root is self:
+                return dict(self.root.stats)
+
+            stats = {name: 0 for name in self.own}
+            nodes = [self]
+            while nodes:
+                node = nodes.pop()
+                for name, count in node.own.items():
+                    stats[name] += count
+                nodes.extend(node.children)
+            return stats
 
     # Encapsulate setting relating parent/child promises
     def relate(self, parent_promise):
-        # Link child to parent
-        self.parent = parent_promise
-        self.depth = self.parent.depth + 1
-        self.parent.children.append(self)
+        with self.tree_lock:
+            # Link child to parent
+            self.parent = parent_promise
+            self.depth = self.parent.depth + 1
+            self.parent.children.append(self)
+
+            # The parent's tree now has this subtree's promises too
+            for name, count in self.tree_stats(start_at_top=False).items():
+                self.parent.root.stats[name] += count
+
+            # Everything in this subtree now shares the parent's root.  (A new promise has no children, so this is
+            # only a walk when a whole tree is related.)
+            nodes = [self]
+            while nodes:
+                node = nodes.pop()
+                node.root = self.parent.root
+                nodes.extend(node.children)
+
+            # An unresolved subtree keeps the parent's from being fully resolved
+            if self.pending:
+                self.parent.settle(1)
 
     # Check the resolved state of nodes in promise tree.
     # Returns True of all nodes (promises) in tree or a subtree, starting from the position given,
@@ -124,21 +306,10 @@ class WTPromise(Exception):
     def tree_resolved(self, position_node=None):
         # If we're not given a position in the tree to start from
         #   start at the root promise.
-        starting_node = self if not position_node else position_node
-        while not position_node and starting_node.parent:
-            starting_node = starting_node.parent
-
-        # Start at the tree node we're supposed to
-        position_node = starting_node
-
-        # Check the node we're on
-        total_resolved = position_node.resolved()
+        starting_node = position_node if position_node else self.root
 
-        # Now recursively check the children.  If anyone returns unresolved,
-        # then the final result will be unresolved (False)
-        for child in position_node.children:
-            total_resolved &= self.tree_resolved(child)
-        return total_resolved
+        # Every subtree keeps count of whether it's fully resolved
+        return starting_node.subtree_resolved()
 
     # Mostly for debugging.  Will document later if it seems necessary
     def tree_dump(self, p=None, dashes="", header=True):
@@ -151,77 +322,106 @@ class WTPromise(Exception):
             # Replace just the first 4 spaces with line, then reverse it so line is on right side
             return d.replace("    ", "---|", 1)[::-1]
 
-        # If not given a starting point, set up to start at root
-        n = self if not p else p
-
-        # If position in tree not passed, find root promise
-        while not p and n.parent:
-            n = n.parent
-
-        # Set out starting position
-        p = n
-
-        # Calculate the execution time of the command related to this promise
-        execution_time = round(p.end_time - p.start_time, 4) if p.end_time else round(time.time() - p.start_time, 4)
-
-        # Print dump output
-        print("{}+ {}: `{}` ({}, {}, {})".format(dashes,
-                                             "root" if p.depth < 1 else p.depth,
-                                             p.command,
-                                             "Resolved" if p.resolved() else "Unresolved",
-                                             f"Execution time: {execution_time} seconds",
-                                             f"Thread id: {p.thread_id}"
-                                             ), file=sys.stderr)
-
-        for child in p.children:
-            self.tree_dump(child, indent(dashes), header)
+        # If not given a starting point, start at the root promise
+        # Walked with a stack rather than recursion so deep trees don't hit the recursion limit
+        nodes = [(p if p else self.root, dashes)]
+        while nodes:
+            p, dashes = nodes.pop()
+
+            # Calculate the execution time of the command related to this promise
+            execution_time = round(p.end_time - p.start_time, 4) if p.end_time else round(time.time() - p.start_time, 4)
+
+            # Print dump output
+            print("{}+ {}: `{}` ({}, {}, {})".format(dashes,
+                                                 "root" if p.depth < 1 else p.depth,
+                                                 p.command,
+                                                 "Resolved" if p.resolved() else "Unresolved",
+                                                 f"Execution time: {execution_time} seconds",
+                                                 f"Thread id: {p.thread_id}"
+                                                 ), file=sys.stderr)
+
+            # Children go on the stack in reverse so they print in order
+            nodes.extend((child, indent(dashes)) for child in reversed(p.children))
+
+    # Seconds join() or wait() may block, None for no limit.
+    # "timeout" is in seconds.  The older "expire" counts "sleep" periods (default .5 seconds).
+    @staticmethod
+    def wait_timeout(args):
+        if "timeout" in args:
+            return float(args["timeout"])
+        if "expire" in args and int(args["expire"]) > 0:
+            return int(args["expire"]) * float(args["sleep"] if "sleep" in args else .5)
+        return None
+
+    # Block until predicate() is true or the timeout passes
+    def wait_until(self, predicate, args):
+        with self.done:
+            completed = self.done.wait_for(predicate, self.wait_timeout(args))
+
+        if not completed:
+            self.tree_dump()
+            raise WTWaitException(self, "Join exceeded expiration period")
 
     # Wait until this promise and all its children down the tree are ALL resolved
     def join(self, args={}):
-        sleep_time = int(args["sleep"]) if "sleep" in args else .5
-        expiration = int(args["expire"]) if "expire" in args else -1
-
-        # Pause until promise or promises resolved
-        while not self.tree_resolved(self):
-            time.sleep(sleep_time)
-            if expiration != -1:
-                expiration -= 1
-                if expiration == 0:
-                    self.tree_dump()
-                    raise WTWaitException(self, "Join exceeded expiration period")
+        self.wait_until(self.subtree_resolved, args)
 
     # Wait on just this promise
     def wait(self, args={}):
-        sleep_time = int(args["sleep"]) if "sleep" in args else .5
-        expiration = int(args["expire"]) if "expire" in args else -1
-
-        # Pause until promise or promises resolved
-        while not self.resolved():
-            time.sleep(sleep_time)
-            if expiration != -1:
-                expiration -= 1
-                if expiration == 0:
-                    self.tree_dump()
-                    raise WTWaitException(self, "Join exceeded expiration period")
-
-    # Establish a watcher thread for this promise
+        self.wait_until(self.resolved, args)
+
+    # asyncio version of wait_until().  Suspends the calling task instead of blocking the thread.
+    async def async_wait_until(self, predicate, args):
+        with self.tree_lock:
+            if predicate():
+                return
+            waiter = (asyncio.get_running_loop(), asyncio.get_running_loop().create_future(), predicate)
+            self.async_waiters.append(waiter)
+
+        try:
+            await asyncio.wait_for(waiter[1], self.wait_timeout(args))
+        except asyncio.TimeoutError:
+            with self.tree_lock:
+                if waiter in self.async_waiters:
+                    self.async_waiters.remove(waiter)
+            self.tree_dump()
+            raise WTWaitException(self, "Join exceeded expiration period")
+
+    # asyncio version of join()
+    async def ajoin(self, args={}):
+        await self.async_wait_until(self.subtree_resolved, args)
+
+    # asyncio version of wait().  Raises the failure if the promise fails (see set_failed()).
+    async def async_wait(self, args={}):
+        await self.async_wait_until(lambda: self.resolution or self.failure is not None, args)
+        if self.resolution:
+            return self.output
+
+        # The aspawn() task raised the same exception.  It's been seen now, so asyncio needn't report it.
+        if self.task is not None and self.task.get_loop() is asyncio.get_running_loop():
+            await asyncio.wait([self.task])
+            if not self.task.cancelled():
+                self.task.exception()
+        if isinstance(self.failure, BaseException):
+            raise self.failure
+        raise WTWaitException(self, f"Promise failed: {self.failure}")
+
+    # "await promise" waits on just this promise, and gives back its command's output
+    def __await__(self):
+        return self.async_wait().__await__()
+
+    # Establish a watcher for this promise
     # Does not pause like join or wait.
     #  Calls back user's method, specified in "notify" argument, if promise hasn't completed in time
     def watch(self, watcher_method, args={}):
-        # Thread function.  Wraps watcher notification method.
-        def watcher(promise, watcher_method, args):
-            sleep_time = int(args["sleep"]) if "sleep" in args else .250
-            expiration = int(args["expire"]) * 4 if "expire" in args else 60
-
-            # Sleep in 1 second chunks so if resolved we end quickly
-            while expiration > 0 and not promise.resolved():
-                time.sleep(sleep_time)
-                expiration -= 1
-
-            # Call the user's watcher if promise still not resolved
-            if not self.resolved():
-                watcher_method(promise, args)
-
-        # Spawn a watcher thread
-        self.watcher = threading.Thread(target=watcher, args=(self, watcher_method, args))
-        self.watcher.start()
+        expiration = float(args["expire"]) if "expire" in args else 15
+
+        with self.tree_lock:
+            # Nothing to watch for
+            if self.resolution:
+                return None
+
+            self.watcher = WTWatch(self, watcher_method, args, expiration)
+            self.watches.append(self.watcher)
+
+        return watch_scheduler.add(self.watcher)
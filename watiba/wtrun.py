@@ -0,0 +1,86 @@
+'''
+Watiba script runner.  Compiles a .wt script in memory and runs it in the same Python process, instead of
+writing the generated Python out with watiba-c and starting a second interpreter to run it.
+
+The script runs as __main__ with its own sys.argv and __file__, and its tracebacks show .wt line numbers.
+
+Author: Ray Walker
+Raythonic@gmail.com
+'''
+
+import os
+import ast
+import sys
+import types
+import traceback
+import importlib.util
+from watiba.wtcompiler import compile_source, watiba_ref
+
+
+# Compile a .wt script into a code object whose line numbers are the script's own
+def compile_script(path):
+    with open(path, "rb") as f:
+        source = importlib.util.decode_source(f.read())
+
+    line_map = []
+    python = compile_source(source, line_map, header=False)
+    tree = ast.parse(python, path)
+    remap_lines(tree, python.split("\n"), source.split("\n"), line_map)
+    return compile(tree, os.path.abspath(path), "exec", dont_inherit=True)
+
+
+# What compiled code expects to find in its globals, in place of the header watiba-c generates (the header would
+# have to go after the first line, and a docstring, code or a __future__ import can be there)
+def script_globals(namespace):
+    import watiba
+
+    namespace["watiba"] = watiba
+    namespace[watiba_ref] = watiba.Watiba()
+    return namespace
+
+
+# Move every node of the generated Python's syntax tree to the source line it came from.  On lines the compiler
+# rewrote, the columns no longer mean anything in the source, so the node is given the whole line.
+def remap_lines(tree, python_lines, source_lines, line_map):
+    for node in ast.walk(tree):
+        if getattr(node, "lineno", None) is None:
+            continue
+
+        start, end = node.lineno, node.end_lineno or node.lineno
+        node.lineno, node.end_lineno = line_map[start - 1], max(line_map[end - 1], line_map[start - 1])
+
+        rewritten = python_lines[start - 1] != source_lines[node.lineno - 1] or \
+            python_lines[end - 1] != source_lines[node.end_lineno - 1]
+        if rewritten:
+            first, last = source_lines[node.lineno - 1], source_lines[node.end_lineno - 1]
+            node.col_offset = len(first) - len(first.lstrip())
+            node.end_col_offset = len(last.encode("utf-8"))
+
+
+# Run a .wt script as __main__, the way Python runs a .py script
+# path - the .wt script
+# args - its command line arguments
+def run_script(path, args):
+    code = compile_script(path)
+
+    # The script's view of the world: its own arguments, and imports from its own directory first
+    sys.argv = [path] + list(args)
+    sys.path[0] = os.path.dirname(os.path.abspath(path))
+
+    main = types.ModuleType("__main__")
+    main.__file__ = os.path.abspath(path)
+    main.__builtins__ = __builtins__
+    script_globals(main.__dict__)
+    sys.modules["__main__"] = main
+
+    try:
+        exec(code, main.__dict__)
+    except (SystemExit, KeyboardInterrupt):
+        raise
+    except BaseException as ex:
+        # Start the traceback at the script, leaving out this runner
+        tb = ex.__traceback__
+        while tb and tb.tb_frame.f_code is not code:
+            tb = tb.tb_next
+        traceback.print_exception(type(ex), ex, tb or ex.__traceback__)
+        sys.exit(1)
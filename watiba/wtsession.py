@@ -0,0 +1,127 @@
+'''
+Watiba shell session class.  Keeps one long-lived bash process and runs commands through it, so
+commands don't each pay for starting a new shell.
+
+Author: Ray Walker
+Raythonic@gmail.com
+'''
+
+import os
+import uuid
+import shlex
+import selectors
+import threading
+from subprocess import Popen, PIPE
+
+
+class WTSessionException(Exception):
+    def __init__(self, session, message=""):
+        self.session = session
+        self.message = message
+
+
+# Each command is framed on the session's stdin, and the shell answers with a marker line on each of
+# stdout and stderr once the command is done:
+#   stdout: \n<token> <exit code> <cwd>\n
+#   stderr: \n<token>\n
+# The token is unique per command so command output can't be mistaken for the marker.
+class WTSession:
+    def __init__(self, shell="bash"):
+        self.shell = shell
+        self.process = None
+
+        # One command at a time per session
+        self.lock = threading.Lock()
+
+    def alive(self):
+        return self.process is not None and self.process.poll() is None
+
+    def start(self):
+        self.process = Popen([self.shell, "--noprofile", "--norc"],
+                             stdin=PIPE,
+                             stdout=PIPE,
+                             stderr=PIPE,
+                             close_fds=True,
+                             bufsize=0)
+
+    def close(self):
+        if self.alive():
+            self.process.stdin.close()
+            self.process.wait()
+        self.process = None
+
+    # Run one command in the session
+    # command - command string to execute
+    # stdout, stderr - capture holders (see wtcapture.py) that receive the command's output
+    # context - False runs the command in a subshell so a cd (or export) doesn't outlive it
+    # cwd - directory the command starts in
+    # Returns (exit code, cwd after the command)
+    def run(self, command, stdout, stderr, context=True, cwd=None):
+        with self.lock:
+            if not self.alive():
+                self.start()
+
+            token = f"__watiba_{uuid.uuid4().hex}__"
+            run = f"{{ eval {shlex.quote(command)}; }}" if context else f"( eval {shlex.quote(command)} )"
+            script = (f"cd -- {shlex.quote(cwd if cwd else os.getcwd())} 2>/dev/null; "
+                      f"{run} </dev/null; __watiba_rc=$?; "
+                      f"printf '\\n%s %d %s\\n' {token} $__watiba_rc \"$PWD\"; "
+                      f"printf '\\n%s\\n' {token} >&2\n")
+
+            try:
+                self.process.stdin.write(script.encode('utf-8', errors='surrogateescape'))
+            except BrokenPipeError:
+                raise WTSessionException(self, "Shell session ended unexpectedly")
+
+            return self.read_frames(token.encode(), stdout, stderr)
+
+    # Read both streams until each has delivered its marker, feeding everything before it to the holders
+    def read_frames(self, token, stdout, stderr):
+        marker = b'\n' + token
+        streams = {self.process.stdout.fileno(): {"lines": stdout, "pending": b''},
+                   self.process.stderr.fileno(): {"lines": stderr, "pending": b''}}
+        status = None
+        ended = False
+
+        sel = selectors.DefaultSelector()
+        for fd in streams:
+            sel.register(fd, selectors.EVENT_READ)
+
+        while len(sel.get_map()) > 0:
+            for key, _ in sel.select():
+                stream = streams[key.fd]
+                chunk = os.read(key.fd, 65536)
+
+                # The shell went away (e.g. the command ran "exit")
+                if not chunk:
+                    stream["lines"].write(stream["pending"])
+                    sel.unregister(key.fd)
+                    ended = True
+                    continue
+
+                data = stream["pending"] + chunk
+                idx = data.find(marker)
+                if idx < 0:
+                    # Hold back just enough to catch a marker split across reads
+                    stream["lines"].write(data[:-len(marker)])
+                    stream["pending"] = data[-len(marker):]
+                    continue
+
+                # Marker found, but wait for the rest of its line
+                end = data.find(b'\n', idx + len(marker))
+                if end < 0:
+                    stream["pending"] = data
+                    continue
+
+                stream["lines"].write(data[:idx])
+                if key.fd == self.process.stdout.fileno():
+                    status = data[idx + len(marker):end].strip().split(b' ', 1)
+                sel.unregister(key.fd)
+        sel.close()
+
+        if ended or status is None:
+            exit_code = self.process.wait()
+            self.process = None
+            return exit_code, None
+
+        return int(status[0]), status[1].decode('utf-8', errors='surrogateescape') if len(status) > 1 else None
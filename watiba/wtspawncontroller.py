@@ -7,6 +7,9 @@ Raythonic@gmail.com
 
 import time
 import threading
+import traceback
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
 
 
 class WTSpawnException(Exception):
@@ -18,18 +21,47 @@ class WTSpawnException(Exception):
 class WTSpawnController():
     def __init__(self):
         self.promises = []
+        self.lock = threading.Lock()  # Guards promises.  Spawns with dependencies start from other threads.
         self.args = {"max": 10,  # Max number of threads allowed before slowdown mode
                      "sleep-floor": .125,  # Starting sleep value
                      "sleep-ceiling": 3,  # Maximum sleep value
                      "sleep-increment": .125,  # Incremental sleep value
                      "expire": -1,  # Default: no expiration
                      "error": self.default_error,  # Default error callback,
-                     "hosts": ["localhost"]  # Where to run the command. Default locally
+                     "hosts": ["localhost"],  # Where to run the command. Default locally
+                     "pool-size": 0,  # Worker threads.  Default: 0, a new thread per spawn
+                     "queue-depth": 1000,  # Spawns allowed to wait for a free worker before spawning blocks
+                     "queue-timeout": -1  # Seconds a spawn may block on a full queue.  Default: no timeout
                      }
 
-    # clean out any promises that have resolved
+        # Worker pool backend (only used when "pool-size" is set)
+        self.pool = None
+        self.pool_size = 0
+        self.pending = 0  # Spawns queued or running on the pool
+        self.pool_cond = threading.Condition()
+        self.worker = threading.local()
+
+    # clean out any promises that have resolved (or failed, they never will)
     def promises_gc(self):
-        self.promises = [p for p in self.promises if not p.resolved()]
+        with self.lock:
+            self.promises = [p for p in self.promises if not p.resolved() and not p.failed()]
+
+    # Track the promise if there's room for it under "max".  Returns False if there isn't.
+    # Checked and claimed in one step: spawns that wait on other promises are started from many threads at once.
+    def track(self, promise):
+        with self.lock:
+            # Clean out any resolved promises, this controller is only for the long running ones
+            self.promises = [p for p in self.promises if not p.resolved() and not p.failed()]
+            if len(self.promises) >= self.args["max"]:
+                return False
+            self.promises.append(promise)
+            return True
+
+    # Stop tracking a promise that was never started
+    def untrack(self, promise):
+        with self.lock:
+            if promise in self.promises:
+                self.promises.remove(promise)
 
     def default_error(self, promise, promise_count):
         print(f"ERROR: Maximum promise/thread count reached: {promise_count}")
@@ -39,32 +71,44 @@ class WTSpawnController():
 
     # Start a thread belonging to the passed promise
     def start(self, promise, thread_callback, thread_args):
-        track_promise = True
-        ex_count = self.args["expire"]
-        loop_counter = 0
-        sleep_value = self.args["sleep-floor"]
+        # Don't start the new thread (or queue it for a worker) until we're below the threshold
+        if not self.slowdown(promise):
+            return self.args["error"](promise, len(self.promises) + 1)
 
-        # Clean out any resolved promises, this controller is only for the long running ones
-        self.promises_gc()
+        if self.args["pool-size"] > 0:
+            return self.pool_start(promise, thread_callback, thread_args)
 
-        # Check to see if we somehow are already tracking this promise (shouldn't happen)
-        for p in self.promises:
-            if p.resolved():
-                track_promise = False
+        '''
+        The "kill switch" is there in case the user's app wants to pre-emptively stop this command from running.
+          How the user can access the promise before this start, takes some doing.  But since the promise 
+          is inserted into the promise tree before we get here, there is early access to it.  But that requires 
+          the user to be walking the tree in an unconventional way.
+          
+          So, the kill() method was added to the promise to allow sophisticated thread management in the user's app.
+        '''
+        # Run the command and call the resolver if some other process out there didn't kill it first
+        if not promise.killed:
+            try:
+                # The thread runs in a copy of the spawner's context (Watiba's directory context lives there)
+                promise.thread = threading.Thread(target=contextvars.copy_context().run,
+                                                  args=(thread_callback, promise, thread_args,))
+                promise.thread.start()
+            except Exception as ex:
+                raise ex
 
-        # Add this promise to our tracking list
-        if track_promise:
-            self.promises.append(promise)
+    # Slowdown mode: wait until the promise can be tracked under "max".  Returns False if "expire" ran out first.
+    def slowdown(self, promise):
+        ex_count = self.args["expire"]
+        loop_counter = 0
+        sleep_value = self.args["sleep-floor"]
 
-        # Don't start the new thread until we're below the threshold
-        # This is slowdown mode...
-        while len(self.promises) > self.args["max"]:
+        while not self.track(promise):
             time.sleep(sleep_value)
 
             # Expiration countdown.  If set (not -1) and hits zero, call error handling routine
             ex_count -= 1 if ex_count > -1 else 0
             if ex_count == 0:
-                return self.args["error"](promise, len(self.promises))
+                return False
 
             # Every third cycle, bump the sleep time up 1/8 second  (slowing down the loop incrementally)
             # Once the increment hits the sleep value, stay at sleep value
@@ -73,24 +117,69 @@ class WTSpawnController():
                     "sleep-ceiling"] else self.args["sleep-ceiling"]
 
             loop_counter += 1
-            self.promises_gc()
-        
-
-        '''
-        The "kill switch" is there in case the user's app wants to pre-emptively stop this command from running.
-          How the user can access the promise before this start, takes some doing.  But since the promise 
-          is inserted into the promise tree before we get here, there is early access to it.  But that requires 
-          the user to be walking the tree in an unconventional way.
-          
-          So, the kill() method was added to the promise to allow sophisticated thread management in the user's app.
-        '''
-        # Run the command and call the resolver if some other process out there didn't kill it first
-        if not promise.killed:
-            try:
-                promise.thread = threading.Thread(target=thread_callback, args=(promise, thread_args,))
-                promise.thread.start()
-            except Exception as ex:
-                raise ex
+        return True
+
+    # Queue the promise's command on the worker pool.  Blocks while the queue is full.
+    def pool_start(self, promise, thread_callback, thread_args):
+        if not self.pool_admit():
+            self.untrack(promise)
+            return self.args["error"](promise, self.pending)
+
+        # Each job runs in a copy of the spawner's context, same as a thread per spawn
+        job = (contextvars.copy_context().run, self.pool_run, promise, thread_callback, thread_args)
+
+        # A resolver spawning more commands runs on a worker.  Queued behind it, they could wait forever for a
+        # worker if it (and every other worker) joins them, so they get an overflow thread of their own.
+        if getattr(self.worker, "busy", False):
+            threading.Thread(target=job[0], args=job[1:], name="watiba-spawn-overflow").start()
+        else:
+            self.get_pool().submit(*job)
+
+    # Wait for room in the queue.  Returns False if "queue-timeout" ran out first.
+    def pool_admit(self):
+        timeout = self.args["queue-timeout"]
+        deadline = time.monotonic() + timeout if timeout >= 0 else None
+
+        with self.pool_cond:
+            # A resolver spawning more commands runs on a worker.  Never make it wait for the queue, the
+            # room it's waiting for may only come from itself.
+            if not getattr(self.worker, "busy", False):
+                while self.pending >= self.args["pool-size"] + self.args["queue-depth"]:
+                    remaining = deadline - time.monotonic() if deadline is not None else None
+                    if remaining is not None and remaining <= 0:
+                        return False
+                    self.pool_cond.wait(remaining)
+
+            self.pending += 1
+            return True
+
+    # The pool, (re)built if spawn-ctl changed "pool-size"
+    def get_pool(self):
+        with self.pool_cond:
+            if self.pool is None or self.pool_size != self.args["pool-size"]:
+                # Jobs already on an old pool still run to completion
+                if self.pool:
+                    self.pool.shutdown(wait=False)
+                self.pool_size = self.args["pool-size"]
+                self.pool = ThreadPoolExecutor(max_workers=self.pool_size, thread_name_prefix="watiba-spawn")
+            return self.pool
+
+    # Worker function.  Runs one spawned command, then frees its place in the queue.
+    def pool_run(self, promise, thread_callback, thread_args):
+        self.worker.busy = True
+        try:
+            # See the "kill switch" note in start()
+            if not promise.killed:
+                promise.thread = threading.current_thread()
+                thread_callback(promise, thread_args)
+        except Exception:
+            # Report it the way an uncaught exception in a thread would be, and keep the worker
+            traceback.print_exc()
+        finally:
+            self.worker.busy = False
+            with self.pool_cond:
+                self.pending -= 1
+                self.pool_cond.notify()
 
     # Merge in parameters settings
     def set_parms(self, parms):
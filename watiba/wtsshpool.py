@@ -0,0 +1,133 @@
+'''
+Watiba SSH connection pool.  Keeps one multiplexed master connection per (user, host, port) so remote
+commands after the first don't each pay for a new TCP connection, key exchange and authentication.
+
+The multiplexing itself is OpenSSH's ControlMaster.  The pool decides which masters may exist, evicts
+them when they've been idle too long or when there are too many, and cleans up at exit.  A master with a
+command still running over it is never evicted: closing it would kill the command.
+
+Author: Ray Walker
+Raythonic@gmail.com
+'''
+
+import os
+import time
+import atexit
+import shutil
+import hashlib
+import tempfile
+import threading
+from collections import OrderedDict
+from subprocess import run, DEVNULL
+
+
+class WTSSHPool:
+    def __init__(self, max_connections=32, idle=300, ssh="ssh"):
+        self.max_connections = max_connections  # Most master connections kept open at once
+        self.idle = idle  # Seconds a master is kept open without being used
+        self.ssh = ssh  # SSH executable
+
+        # (user, host, port) -> time last used, least recently used first
+        self.masters = OrderedDict()
+        self.in_use = {}  # (user, host, port) -> commands running over the master
+        self.closing = set()  # (user, host, port) of masters being told to exit
+        self.lock = threading.Lock()
+        self.closed = threading.Condition(self.lock)  # Notified when a master has exited
+        self.control_dir = None
+        atexit.register(self.close)
+
+    # Split "user@host" into its parts
+    @staticmethod
+    def key(host, port):
+        user, _, hostname = host.rpartition("@")
+        return user, hostname, int(port)
+
+    # Unix socket for a master connection.  Hashed to stay under the socket path length limit.
+    def control_path(self, key):
+        if not self.control_dir:
+            self.control_dir = tempfile.mkdtemp(prefix="watiba-ssh-")
+        name = hashlib.sha1(repr(key).encode()).hexdigest()[:16]
+        return os.path.join(self.control_dir, name)
+
+    # SSH options that route a command through the pooled master for this host.  The master counts as in use
+    # until release() is called for the command.
+    def options(self, host, port):
+        key = self.key(host, port)
+        evicted = []
+
+        with self.lock:
+            # A master still exiting would take the command down with it.  Wait for it to be gone.
+            while key in self.closing:
+                self.closed.wait()
+            now = time.time()
+
+            # Evict masters that have sat idle
+            for k, last_used in list(self.masters.items()):
+                if now - last_used > self.idle and not self.in_use.get(k):
+                    evicted.append(self.evict(k))
+
+            # Make room for a new master by evicting the least recently used one that's not in use.  If they're
+            # all in use, there are more masters than the maximum until some are released.
+            if key not in self.masters:
+                idle = [k for k in self.masters if not self.in_use.get(k)]
+                while len(self.masters) >= self.max_connections and idle:
+                    evicted.append(self.evict(idle.pop(0)))
+
+            self.masters[key] = now
+            self.masters.move_to_end(key)
+            self.in_use[key] = self.in_use.get(key, 0) + 1
+            path = self.control_path(key)
+
+        # Telling a master to exit is a process of its own.  Other commands don't wait on the lock for it.
+        for k, control_path in evicted:
+            self.close_master(k, control_path)
+
+        # The first command to a host becomes the master (ControlMaster=auto), and the master exits by
+        # itself once it's been idle (ControlPersist), even if this process dies without cleaning up.
+        return f"-o ControlMaster=auto -o ControlPath={path} -o ControlPersist={int(self.idle)}"
+
+    # A command given options() for this host is done with the master
+    def release(self, host, port):
+        key = self.key(host, port)
+        with self.lock:
+            if self.in_use.get(key, 0) > 1:
+                self.in_use[key] -= 1
+            else:
+                self.in_use.pop(key, None)
+
+            # Idle time counts from when the master was last used, not when the command started
+            if key in self.masters:
+                self.masters[key] = time.time()
+
+    # Drop a master from the pool, to be closed with close_master() once the lock is released.  Called with the
+    # lock held.
+    # Returns (key, control path)
+    def evict(self, key):
+        del self.masters[key]
+        self.closing.add(key)
+        return key, self.control_path(key)
+
+    # Tell a master connection evicted from the pool to exit
+    def close_master(self, key, path):
+        user, hostname, port = key
+        try:
+            if os.path.exists(path):
+                run([self.ssh, "-O", "exit", "-o", f"ControlPath={path}", "-p", str(port),
+                     f"{user}@{hostname}" if user else hostname],
+                    stdout=DEVNULL, stderr=DEVNULL)
+        finally:
+            with self.lock:
+                self.closing.discard(key)
+                self.closed.notify_all()
+
+    # Close every master connection
+    def close(self):
+        with self.lock:
+            evicted = [self.evict(key) for key in list(self.masters)]
+        for key, path in evicted:
+            self.close_master(key, path)
+
+        with self.lock:
+            if self.control_dir and not self.masters:
+                shutil.rmtree(self.control_dir, ignore_errors=True)
+                self.control_dir = None
@@ -0,0 +1,136 @@
+'''
+Watiba stream class.  Runs a shell command and hands its output lines back as they arrive.
+
+Author: Ray Walker
+Raythonic@gmail.com
+'''
+
+import os
+import re
+import queue
+import signal
+import threading
+from subprocess import Popen, PIPE
+from watiba.wtcapture import CONTEXT_MARKER
+
+
+# Kill a command started in a session of its own, along with everything it started.  Killing only the shell would
+# leave its children running, holding the output pipes open.
+def kill_process_group(process):
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+
+
+# The object returned by Watiba.bash_stream()
+# Iterate over it to receive ("stdout" | "stderr", line) tuples while the command is still running.
+# exit_code and cwd are set once the iteration completes.
+class WTStream:
+    def __init__(self, command, context=True, on_complete=None, queue_depth=1024, cwd=None):
+        self.command = command
+        self.context = context
+        self.start_cwd = cwd
+        self.exit_code = None
+        self.cwd = None
+        self.process = None
+        self.completed = False
+
+        # Called with this stream object once the command has finished and all output is read
+        self.on_complete = on_complete
+
+        # Lines handed over from the reader threads.  The queue is bounded so a command that writes
+        # faster than the caller reads is paused by the pipe instead of growing memory.
+        self.lines = queue.Queue(maxsize=queue_depth)
+        self.open_streams = 0
+
+    # Start the command and one reader thread per output stream
+    # The command gets a session of its own, so close() can stop everything it starts
+    def start(self):
+        # Tack on this command to see what the current dir is after the user's command is executed
+        ctx = CONTEXT_MARKER if self.context else ''
+        self.process = Popen(f"{self.command}{ctx}",
+                             shell=True,
+                             stdout=PIPE,
+                             stderr=PIPE,
+                             close_fds=True,
+                             cwd=self.start_cwd,
+                             start_new_session=True)
+
+        for name, pipe in (("stdout", self.process.stdout), ("stderr", self.process.stderr)):
+            threading.Thread(target=self.reader, args=(name, pipe), daemon=True).start()
+            self.open_streams += 1
+
+        return self
+
+    # Thread function.  Reads one stream line by line until the command closes it.
+    def reader(self, name, pipe):
+        for raw in iter(pipe.readline, b''):
+            self.lines.put((name, raw))
+        pipe.close()
+
+        # Tell the iterator this stream is done
+        self.lines.put((name, None))
+
+    def __iter__(self):
+        # An empty STDOUT line is held back until the next one shows whether it was the newline Watiba
+        # writes before its marker
+        held = False
+        try:
+            while self.open_streams > 0:
+                name, raw = self.lines.get()
+                if raw is None:
+                    self.open_streams -= 1
+                    if held and name == "stdout":
+                        held = False
+                        yield "stdout", ""
+                    continue
+
+                line = raw.decode('utf-8', errors='replace').rstrip('\n')
+
+                # If asked to keep CWD context, find our marker and keep it from the user
+                if self.context and name == "stdout":
+                    m = re.match(r'^__watiba_cwd__\((\S.*)\)_$', line)
+                    if m:
+                        self.cwd = m.group(1)
+                        held = False
+                        continue
+                    if held:
+                        yield "stdout", ""
+                    held = line == ""
+                    if held:
+                        continue
+
+                yield name, line
+
+            self.exit_code = self.process.wait()
+            self.completed = True
+            if self.on_complete:
+                self.on_complete(self)
+        finally:
+            # The caller stopped iterating early, so don't leave the command or readers behind
+            if not self.completed:
+                self.close()
+
+    # Stop the command if it's still running and release the reader threads
+    def close(self):
+        if not self.process or self.completed:
+            return
+
+        if self.process.poll() is None:
+            kill_process_group(self.process)
+
+        # Readers may be blocked on a full queue, so drain until both have finished
+        while self.open_streams > 0:
+            name, raw = self.lines.get()
+            if raw is None:
+                self.open_streams -= 1
+
+        self.exit_code = self.process.wait()
+        self.completed = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
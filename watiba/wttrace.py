@@ -0,0 +1,239 @@
+'''
+Watiba tracing.  Exports a promise tree, and optionally every bash(), ssh() and hook call, as Chrome trace-event
+JSON, to be loaded into a trace viewer (chrome://tracing, https://ui.perfetto.dev, speedscope...).  Each thread gets
+a track with the commands and resolvers it ran, so stragglers and idle workers stand out, and the time spawned
+commands spent waiting (on the spawn controller's slowdown mode, a full worker pool or the promises they were
+after) shows as its own bars.
+
+    watiba.tracer.write("run.json", promise)
+
+Turned on for the whole program with watiba-ctl {"trace": True, "trace-file": "run.json"}, or by setting
+WATIBA_TRACE=run.json in the environment: every spawned promise and every call is then traced and written at exit.
+
+Author: Ray Walker
+Raythonic@gmail.com
+'''
+
+import os
+import json
+import time
+import atexit
+import functools
+import threading
+from collections import deque
+
+
+class WTTraceException(Exception):
+    def __init__(self, tracer, message=""):
+        self.tracer = tracer
+        self.message = message
+
+
+class WTTracer:
+    def __init__(self, max_events=1000000):
+        self.lock = threading.Lock()
+        self.calls = deque(maxlen=max_events)  # Trace events of the calls traced so far, oldest dropped first
+
+        # When tracing every spawn: a spawned promise of each tree still running (by the id of its root), and the
+        # trace events of the trees that have fully resolved, oldest dropped first.  Finished trees aren't kept, so
+        # a long running program doesn't hold on to every promise it ever spawned.
+        self.promises = {}
+        self.finished = deque(maxlen=max_events)
+        self.numbered = 0  # Promises numbered in the finished events
+        self.sweep_at = 64  # Move finished trees to their events once this many trees are kept
+        self.thread_names = {}  # Thread id -> name, of the threads calls were traced on
+        self.file = None  # Written at exit, if set
+        self.registered = False
+
+    # Record a call that has just returned
+    # kind - "bash", "ssh", "hook"...
+    # name - what the call ran (the command, or the hook's pattern)
+    # seconds - how long it took
+    # args - details shown for the call in the viewer
+    def span(self, kind, name, seconds, args, parms):
+        thread = threading.current_thread()
+        event = {"name": name, "cat": kind, "ph": "X", "ts": (time.time() - seconds) * 1e6, "dur": seconds * 1e6,
+                 "pid": os.getpid(), "tid": thread.ident, "args": args}
+        with self.lock:
+            self.calls.append(event)
+            self.thread_names[thread.ident] = thread.name
+        self.write_at_exit(parms)
+
+    # Keep a spawned promise, to be traced with its tree when the trace is written
+    def add_promise(self, promise, parms):
+        with self.lock:
+            self.promises.setdefault(id(promise.root), promise)
+            if len(self.promises) >= self.sweep_at:
+                self.sweep()
+        self.write_at_exit(parms)
+
+    # Trace the trees that have fully resolved, and let go of them.  Trees are only checked once the number kept
+    # has doubled since the last check, so adding promises stays cheap.  Called with the lock held.
+    def sweep(self):
+        running = {}
+        for promise in self.promises.values():
+            root = promise.root
+            if root.tree_resolved():
+                self.finished.extend(promise_events(root, self.numbered + 1))
+                self.numbered += root.tree_stats()["total"]
+            else:
+                running.setdefault(id(root), promise)
+        self.promises = running
+        self.sweep_at = max(64, len(running) * 2)
+
+    # Pick up watiba-ctl "trace-file", to be written when the program exits
+    def write_at_exit(self, parms):
+        self.file = parms["trace-file"]
+        if self.file and not self.registered:
+            atexit.register(self.write_exit_file)
+            self.registered = True
+
+    def write_exit_file(self):
+        if self.file:
+            self.write(self.file)
+
+    # Forget everything traced so far
+    def reset(self):
+        with self.lock:
+            self.calls.clear()
+            self.promises = {}
+            self.finished.clear()
+            self.numbered = 0
+            self.sweep_at = 64
+            self.thread_names = {}
+
+    # The trace events
+    # promises - a promise, or list of them, whose whole trees are traced.  Default: the promises spawned while
+    #            tracing was on.
+    # calls - include the bash(), ssh() and hook calls traced
+    # Returns list of trace-event dicts
+    def events(self, promises=None, calls=True):
+        with self.lock:
+            first = 1
+            events = list(self.calls) if calls else []
+            if promises is None:
+                promises = list(self.promises.values())
+                events += self.finished
+                first = self.numbered + 1
+            names = dict(self.thread_names)
+
+        events += promise_events(promises, first)
+
+        # Name the tracks.  Threads still running have their own names, the others go by what they ran.
+        names.update((t.ident, t.name) for t in threading.enumerate())
+        pid = os.getpid()
+        metadata = [{"name": "process_name", "ph": "M", "pid": pid, "tid": 0, "args": {"name": "watiba"}}]
+        for tid in dict.fromkeys(e["tid"] for e in events):
+            metadata.append({"name": "thread_name", "ph": "M", "pid": pid, "tid": tid,
+                             "args": {"name": names.get(tid, f"spawn thread {tid}")}})
+        return metadata + sorted(events, key=lambda e: e["ts"])
+
+    # The trace as a JSON document
+    def json(self, promises=None, calls=True):
+        return json.dumps({"traceEvents": self.events(promises, calls), "displayTimeUnit": "ms"})
+
+    # Write the trace to a file
+    def write(self, path, promises=None, calls=True):
+        try:
+            with open(path, "w") as f:
+                f.write(self.json(promises, calls))
+        except OSError as ex:
+            raise WTTraceException(self, f"Can't write trace to {path}: {ex}")
+
+
+# The trace events of the promise trees the promises belong to
+# first - number given to the first promise (numbers tie a promise's events together)
+# Each spawned command is a bar on the track of the thread that ran it, followed by its resolver.  Time spent waiting
+# on the promises it was after, and then waiting to start, are separate bars of their own.
+def promise_events(promises, first=1):
+    roots = {}
+    for promise in [promises] if hasattr(promises, "root") else promises:
+        roots[id(promise.root)] = promise.root
+
+    events = []
+    ids = {}
+    pid = os.getpid()
+    now = time.time()
+    nodes = list(reversed(roots.values()))
+    while nodes:
+        promise = nodes.pop()
+        nodes.extend(reversed(promise.children))
+        ids[id(promise)] = len(ids) + first
+        number = ids[id(promise)]
+
+        args = {"command": promise.command, "host": promise.host, "promise": number, "depth": promise.depth,
+                "resolved": promise.resolved()}
+        if promise.parent:
+            args["parent"] = ids.get(id(promise.parent))
+        if promise.output is not None:
+            args["exit_code"] = promise.output.exit_code
+        if promise.failure is not None:
+            args["failure"] = str(promise.failure)
+        name = promise.command if len(promise.command) <= 80 else promise.command[:77] + "..."
+
+        # Waiting on the promises it was after, then for the spawn controller to start it
+        ready = max([promise.start_time] + [d.end_time for d in promise.dependencies if d.end_time])
+        started = promise.run_start if promise.run_start else (now if not promise.failed() else ready)
+        tid = promise.thread_id if promise.thread_id else threading.main_thread().ident
+        if promise.dependencies:
+            events += wait_events("after", f"after: {name}", number, promise.start_time, ready, tid, args)
+        events += wait_events("queued", f"queued: {name}", number, ready, started, tid, args)
+        if not promise.run_start:
+            continue
+
+        # The command, then the resolver.  Tasks of aspawn() share their thread, so they're drawn as async bars.
+        ended = promise.run_end if promise.run_end else now
+        resolved = promise.end_time if promise.end_time and promise.end_time >= ended else None
+        if promise.task is not None:
+            events += wait_events("spawn", name, number, promise.run_start, ended, tid, args)
+            if resolved:
+                events += wait_events("resolver", "resolver", number, ended, resolved, tid, args)
+            continue
+
+        events.append({"name": name, "cat": "spawn", "ph": "X", "ts": promise.run_start * 1e6,
+                       "dur": (ended - promise.run_start) * 1e6, "pid": pid, "tid": tid, "args": args})
+        if resolved:
+            events.append({"name": "resolver", "cat": "resolver", "ph": "X", "ts": ended * 1e6,
+                           "dur": (resolved - ended) * 1e6, "pid": pid, "tid": tid, "args": {"promise": number}})
+    return events
+
+
+# A bar for a span of time that may overlap others on its thread (an async event pair)
+def wait_events(kind, name, number, start, end, tid, args):
+    if end <= start:
+        return []
+    event = {"name": name, "cat": kind, "id": number, "pid": os.getpid(), "tid": tid}
+    return [{**event, "ph": "b", "ts": start * 1e6, "args": args}, {**event, "ph": "e", "ts": end * 1e6}]
+
+
+# The tracer every Watiba object records to
+tracer = WTTracer()
+
+
+# Trace a Watiba command method (bash, ssh...).  With tracing off it's a straight call.
+# kind - the call's category in the trace
+def traced(kind):
+    def decorate(method):
+        @functools.wraps(method)
+        def call(watiba, command, *args, **kwargs):
+            if not watiba.parms["trace"]:
+                return method(watiba, command, *args, **kwargs)
+
+            host = args[0] if kind == "ssh" and args else kwargs.get("host", "localhost")
+            result = None
+            start = time.perf_counter()
+            try:
+                result = method(watiba, command, *args, **kwargs)
+                return result
+            finally:
+                details = {"host": host}
+                if hasattr(result, "exit_code"):
+                    details["exit_code"] = result.exit_code
+                    details["cwd"] = result.cwd
+                    if result.cached:
+                        details["cached"] = True
+                elif result is None:
+                    details["raised"] = True
+                tracer.span(kind, command, time.perf_counter() - start, details, watiba.parms)
+        return call
+    return decorate
@@ -0,0 +1,140 @@
+'''
+Watiba promise watcher scheduler.  One thread keeps every promise watch in a heap ordered by deadline,
+sleeps until the earliest one is due, and has a small pool of threads call the watcher method if that promise
+still isn't resolved.
+
+Author: Ray Walker
+Raythonic@gmail.com
+'''
+
+import time
+import heapq
+import itertools
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+# Threads calling watcher methods.  Watchers due while all of them are busy wait their turn.
+WATCHER_WORKERS = 8
+
+# Cancelled watches are left in the heap until they come due, unless they outnumber the live ones in a heap at least
+# this big
+COMPACT_SIZE = 64
+
+
+# One watch() on a promise
+class WTWatch:
+    def __init__(self, promise, watcher_method, args, expire):
+        self.promise = promise
+        self.watcher_method = watcher_method
+        self.args = args
+        self.deadline = time.monotonic() + expire
+        self.cancelled = False
+        self.scheduler = None  # The scheduler whose heap it's in, while it's there
+        self.discarded = False  # Counted by the scheduler as cancelled
+
+    # Stop this watch from firing.  The scheduler discards it when it comes due, or sooner (see discard()).
+    def cancel(self):
+        self.cancelled = True
+        scheduler = self.scheduler
+        if scheduler:
+            scheduler.discard(self)
+
+
+class WTWatchScheduler:
+    def __init__(self):
+        # (deadline, sequence, watch), earliest deadline first.  The sequence keeps equal deadlines in order.
+        self.watches = []
+        self.sequence = itertools.count()
+        self.cancelled = 0  # Cancelled watches still in the heap
+        self.cond = threading.Condition()
+        self.thread = None
+        self.workers = None
+
+    # Schedule a watch, starting the scheduler thread the first time
+    def add(self, watch):
+        with self.cond:
+            heapq.heappush(self.watches, (watch.deadline, next(self.sequence), watch))
+            watch.scheduler = self
+            if not self.thread:
+                self.workers = ThreadPoolExecutor(max_workers=WATCHER_WORKERS, thread_name_prefix="watiba-watch")
+
+                # Daemon so pending watches don't keep the process alive on their own
+                self.thread = threading.Thread(target=self.run, name="watiba-watcher", daemon=True)
+                self.thread.start()
+
+            # Wake the scheduler if this watch is now the earliest
+            if self.watches[0][2] is watch:
+                self.cond.notify()
+
+        # Cancelled while it was being added
+        if watch.cancelled:
+            self.discard(watch)
+        return watch
+
+    # Count a cancelled watch, and rebuild the heap without cancelled watches once they're most of it.  A watch
+    # outliving a promise that resolves quickly would otherwise stay in the heap until its deadline.
+    def discard(self, watch):
+        with self.cond:
+            if watch.scheduler is not self or watch.discarded:
+                return
+            watch.discarded = True
+            self.cancelled += 1
+            if len(self.watches) >= COMPACT_SIZE and self.cancelled * 2 > len(self.watches):
+                for _, _, dropped in self.watches:
+                    if dropped.cancelled:
+                        dropped.scheduler = None
+                self.watches = [entry for entry in self.watches if not entry[2].cancelled]
+                heapq.heapify(self.watches)
+                self.cancelled = 0
+
+    # Take the earliest watch off the heap
+    def pop(self):
+        watch = heapq.heappop(self.watches)[2]
+        if watch.discarded:
+            self.cancelled -= 1
+        watch.scheduler = None
+        return watch
+
+    # Take the next watch off the heap once it's due
+    def next_due(self):
+        with self.cond:
+            while True:
+                # Drop watches cancelled by their promise resolving
+                while self.watches and self.watches[0][2].cancelled:
+                    self.pop()
+
+                if not self.watches:
+                    self.cond.wait()
+                    continue
+
+                delay = self.watches[0][0] - time.monotonic()
+                if delay <= 0:
+                    return self.pop()
+                self.cond.wait(delay)
+
+    # Thread function
+    def run(self):
+        while True:
+            watch = self.next_due()
+
+            # Call the user's watcher if promise still not resolved.  It's called on one of the worker threads so a
+            # slow watcher can't hold up the ones due after it.
+            if not watch.cancelled and not watch.promise.resolved():
+                try:
+                    self.workers.submit(self.call, watch)
+                except RuntimeError:
+                    # The interpreter is shutting down
+                    return
+
+    # Call a watcher method, reporting an exception from it like an uncaught one in a thread of its own
+    @staticmethod
+    def call(watch):
+        try:
+            watch.watcher_method(watch.promise, watch.args)
+        except Exception:
+            traceback.print_exc()
+
+
+# Shared by all promises
+watch_scheduler = WTWatchScheduler()